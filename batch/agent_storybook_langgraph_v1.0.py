@@ -22,10 +22,13 @@ from langgraph.prebuilt import ToolNode
 # 确保我们能从batch目录中导入其他模块
 import cloudinary_util, generate_storybooks, generate_stories
 from logger_config import get_logger
-from task_manager import Task_manager
+from task_manager import get_task_manager
 from dotenv import load_dotenv
 import subprocess
 from local_llm_util import Local_llm
+import json_constraint
+import llm_cache
+from functools import partial
 
 load_dotenv()
 logger = get_logger(__name__)
@@ -34,7 +37,7 @@ sample_pic = os.path.join(SAMPLE_PIC_4_STORYBOOK, "gqj1.jpg")
 
 llm = Local_llm(llm_name="google/gemma-3-270m-it")
 
-tm = Task_manager()
+tm = get_task_manager()
 OK_msg = "执行成功"
 NG_msg = "执行失败"
 
@@ -47,7 +50,13 @@ def generate_stories_tool(story_topic: str) -> str:
     logger.info(f"[Tool] 正在为主题 '{story_topic}' 生成故事...")
 
     generated_stories = generate_stories.generate_stories_by_generation_func(
-        topic=story_topic, number_of_stories=1, generation_func=llm.invoke_query_format1
+        topic=story_topic,
+        number_of_stories=1,
+        generation_func=llm_cache.cached(
+            partial(llm.invoke_query_format1, json_schema=json_constraint.stories_schema(1)),
+            model=llm.llm_name,
+            validate=generate_stories.has_stories,
+        ),
     )
     if generated_stories:
         tm.insert_task(generated_stories, pic=sample_pic)
@@ -65,16 +74,14 @@ def generate_images_tool() -> str:
     """为任务管理器中的故事生成图片"""
     # """为任务管理器中的故事生成图片。这是流程的第二步。"""
     logger.info("[Tool] 正在生成图片...")
-    tasks = tm.read_df_from_csv()
     result = False
-    target_tasks = tasks.query("is_target == 1 and generate_storybook != 1")
+    target_tasks = tm.read_target_tasks("generate_storybook")
     for _, task in target_tasks.iterrows():
         prompt, id, pic = task["text"], task["id"], task["pic"]
         res = generate_storybooks.run(prompt=prompt, id=id, pic=pic)
         result = result or res
         if res:
-            tasks.loc[tasks["id"] == id, "generate_storybook"] = 1
-            tm.update_task(tasks)
+            tm.mark(id, "generate_storybook", 1)
             logger.info(f"成功为故事ID {target_tasks['id']} 生成图片。")
     return OK_msg if result else NG_msg
     # return OK_msg.format("请上传已生成的图片") if result else NG_msg
@@ -100,6 +107,7 @@ def update_d1_database_tool() -> str:
     # """更新数据库。这是流程的最后一步。"""
     """更新数据库"""
     logger.info("[Tool] 正在更新数据库...")
+    tm.flush()
     result = subprocess.run(
         ["node", "batch/post_stories.js"],
         capture_output=True,
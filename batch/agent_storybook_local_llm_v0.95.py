@@ -27,7 +27,7 @@ import generate_storybooks
 import generate_stories
 from logger_config import get_logger
 from local_llm_util import Local_llm
-from task_manager import Task_manager
+from task_manager import get_task_manager
 from dotenv import load_dotenv
 import subprocess
 
@@ -37,10 +37,11 @@ SAMPLE_PIC_4_STORYBOOK = os.getenv("SAMPLE_PIC_4_STORYBOOK")
 sample_pic = os.path.join(SAMPLE_PIC_4_STORYBOOK, "gqj1.jpg")
 
 # --- 初始化工具和模型 ---
-llm = Local_llm(llm_name="google/gemma-3-1b-it")
+# 270m 起草、1b 验证，输出质量和只用 1b 相同
+llm = Local_llm(llm_name="google/gemma-3-1b-it", draft_llm_name="google/gemma-3-270m-it")
 # llm = Local_llm(llm_name="google/gemma-3-270m-it")
 
-tm = Task_manager()
+tm = get_task_manager()
 
 OK_msg = "执行成功，{}。"
 NG_msg = "执行失败，终止后续处理。"
@@ -107,16 +108,14 @@ def generate_stories_tool(story_topic: str) -> str:
 def generate_images_tool(input: str) -> str:
     """为任务管理器中的故事生成图片。这是流程的第二步。"""
     logger.info("[Tool] 正在生成图片...")
-    tasks = tm.read_df_from_csv()
     result = False
-    target_tasks = tasks.query("is_target == 1 and generate_storybook != 1")
+    target_tasks = tm.read_target_tasks("generate_storybook")
     for _, task in target_tasks.iterrows():
         prompt, id, pic = task["text"], task["id"], task["pic"]
         res = generate_storybooks.run(prompt=prompt, id=id, pic=pic)
         result = result or res
         if res:
-            tasks.loc[tasks["id"] == id, "generate_storybook"] = 1
-            tm.update_task(tasks)
+            tm.mark(id, "generate_storybook", 1)
             logger.info(f"成功为故事ID {target_tasks['id']} 生成图片。")
     return OK_msg.format("请上传已生成的图片") if result else NG_msg
 
@@ -138,6 +137,7 @@ def upload_images_to_cloudinary_tool(input: str) -> str:
 def update_d1_database_tool(input: str) -> str:
     """更新数据库。这是流程的最后一步。"""
     logger.info("[Tool] 正在更新数据库...")
+    tm.flush()
     result = subprocess.run(
         ["node", "batch/post_stories.js"],
         capture_output=True,
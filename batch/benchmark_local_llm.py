@@ -0,0 +1,104 @@
+"""
+本地模型各推理模式的速度和内存对比。
+每个 (模型, 模式) 在单独的子进程里运行，峰值内存互不影响。
+
+    python benchmark_local_llm.py
+"""
+
+import os, sys, json, time, subprocess
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 参与对比的模型和推理模式，用逗号分隔
+BENCHMARK_MODELS = os.getenv("BENCHMARK_MODELS", "google/gemma-3-270m-it,google/gemma-3-1b-it")
+BENCHMARK_MODES = os.getenv("BENCHMARK_MODES", "fp32,bf16,int8")
+# 每次生成的 token 数和重复次数
+BENCHMARK_NEW_TOKENS = int(os.getenv("BENCHMARK_NEW_TOKENS", "128"))
+BENCHMARK_RUNS = int(os.getenv("BENCHMARK_RUNS", "3"))
+
+PROMPT = [{"role": "user", "content": "写一个关于一只勇敢的小猫的小故事。"}]
+
+
+def run_one(model_name, mode):
+    """在当前进程里测一个 (模型, 模式)，返回结果 dict"""
+    import torch
+    from local_llm_util import Local_llm
+
+    llm = Local_llm(llm_name=model_name, device="cpu", mode=mode, use_prefix_cache=False)
+    tokenizer = llm.tokenizer
+    model = llm.model
+    input_ids = tokenizer.apply_chat_template(PROMPT, add_generation_prompt=True, return_tensors="pt")
+
+    def generate():
+        with torch.inference_mode():
+            outputs = model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=BENCHMARK_NEW_TOKENS,
+                min_new_tokens=BENCHMARK_NEW_TOKENS,
+                do_sample=False,
+            )
+        return outputs.shape[-1] - input_ids.shape[-1]
+
+    # 第一次生成包含 torch.compile 等预热时间，不计入结果
+    generate()
+    tokens, start = 0, time.perf_counter()
+    for _ in range(BENCHMARK_RUNS):
+        tokens += generate()
+    elapsed = time.perf_counter() - start
+    return {
+        "model": model_name,
+        "mode": mode,
+        "threads": torch.get_num_threads(),
+        "tokens_per_sec": round(tokens / elapsed, 2),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def peak_rss_mb():
+    """当前进程的峰值内存(MB)，取不到时返回 None"""
+    try:
+        # resource 只有 Unix 上有
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        # Windows 上的峰值工作集
+        return round(getattr(info, "peak_wset", info.rss) / 1024 / 1024, 1)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss 在 macOS 上的单位是字节，Linux 上是 KB
+    return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+def main():
+    results = []
+    for model_name in BENCHMARK_MODELS.split(","):
+        for mode in BENCHMARK_MODES.split(","):
+            print(f"正在测试 {model_name} ({mode}) ...")
+            proc = subprocess.run(
+                [sys.executable, __file__, model_name, mode],
+                capture_output=True,
+                text=True,
+            )
+            if proc.returncode != 0:
+                print(f"测试失败: {proc.stderr.strip().splitlines()[-1:]}")
+                continue
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    print(f"\n{'model':<28}{'mode':<6}{'threads':>8}{'tokens/s':>10}{'peak RSS(MB)':>14}")
+    for r in results:
+        # 没有 resource 也没有 psutil 时取不到峰值内存
+        peak = r["peak_rss_mb"] if r["peak_rss_mb"] is not None else "n/a"
+        print(f"{r['model']:<28}{r['mode']:<6}{r['threads']:>8}{r['tokens_per_sec']:>10}{peak:>14}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        # 子进程: 测一个 (模型, 模式)，最后一行输出 JSON
+        print(json.dumps(run_one(sys.argv[1], sys.argv[2])))
+    else:
+        main()
@@ -1,5 +1,6 @@
-import shutil, os, glob, re
+import shutil, os, glob, re, time, random, json, hashlib, threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import cloudinary, datetime
 import cloudinary.api
 import cloudinary.uploader
@@ -25,6 +26,222 @@ DONE_MD_PREFIX = os.getenv("DONE_MD_PREFIX")
 CLOUDINARY_ROOT_FOLDER = os.getenv("CLOUDINARY_FOLDER")
 
 max_results = 1000
+# Admin API 每页最多返回 500 条
+PAGE_SIZE = 500
+# Cloudinary 资源列表的本地缓存，默认放在 DONE_MD_PATH 旁边
+RESOURCE_CACHE_PATH = os.getenv("RESOURCE_CACHE_PATH")
+# 缓存有效期(秒)，过期后只增量获取新上传的资源
+RESOURCE_CACHE_TTL = int(os.getenv("RESOURCE_CACHE_TTL", "600"))
+# 超过这个时间(秒)后全量刷新，增量刷新发现不了删除和改名
+RESOURCE_CACHE_FULL_TTL = int(os.getenv("RESOURCE_CACHE_FULL_TTL", "86400"))
+# 批量改名时同时执行的改名数
+RENAME_CONCURRENCY = int(os.getenv("RENAME_CONCURRENCY", "4"))
+# 同时上传的文件数，1 表示和以前一样逐个上传
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "1"))
+# 每个文件上传失败后的重试次数
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "3"))
+# 记录已上传文件的清单，默认放在 DONE_MD_PATH 旁边
+UPLOAD_MANIFEST_PATH = os.getenv("UPLOAD_MANIFEST_PATH")
+
+
+class Upload_manifest:
+    """
+    已上传文件的本地清单 (JSONL)，按 public_id 记录上传成功的文件内容哈希。
+    重新运行时只上传新的或内容有变化的文件，不需要调用 Cloudinary 的列表接口，
+    上传到一半失败的组也可以从中断的地方继续。
+    """
+
+    def __init__(self, path=None):
+        self.path = path or UPLOAD_MANIFEST_PATH or os.path.join(
+            os.path.dirname(DONE_MD_PATH), "upload_manifest.jsonl"
+        )
+        self.entries = {}
+        self._lock = threading.Lock()
+        # 上次写到一半中断时最后一行没有换行，下一条记录要另起一行
+        self._needs_newline = False
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                content = f.read()
+            self._needs_newline = bool(content) and not content.endswith("\n")
+            for line in content.splitlines():
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.entries[entry["public_id"]] = entry["sha256"]
+
+    @staticmethod
+    def file_hash(path):
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def public_id(options):
+        return f"{options['folder']}/{options['public_id']}"
+
+    def is_uploaded(self, public_id, sha256):
+        return self.entries.get(public_id) == sha256
+
+    def record(self, public_id, sha256, file):
+        """上传成功后调用，立即追加到清单文件"""
+        entry = {
+            "public_id": public_id,
+            "sha256": sha256,
+            "file": os.path.basename(file),
+            "uploaded_at": str(datetime.datetime.now()),
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._needs_newline:
+                line = "\n" + line
+                self._needs_newline = False
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[public_id] = sha256
+
+    def pending_uploads(self, plan):
+        """从上传计划中去掉已经上传过且内容没变的文件，返回 (文件, 参数, 哈希) 的列表"""
+        pending = []
+        for f, options in plan:
+            sha256 = self.file_hash(f)
+            if not self.is_uploaded(self.public_id(options), sha256):
+                pending.append((f, options, sha256))
+        return pending
+
+
+def fetch_all_pages(list_func, *args, **kwargs):
+    """按 next_cursor 翻页，取回列表接口的全部资源"""
+    resources, cursor = [], None
+    while True:
+        params = dict(kwargs, max_results=PAGE_SIZE)
+        if cursor:
+            params["next_cursor"] = cursor
+        response = list_func(*args, **params)
+        resources.extend(response.get("resources", []))
+        cursor = response.get("next_cursor")
+        if not cursor:
+            return resources
+
+
+def search_all_pages(expression):
+    """用 Search API 按 next_cursor 翻页，取回符合条件的全部资源"""
+    resources, cursor = [], None
+    while True:
+        search = cloudinary.Search().expression(expression).max_results(PAGE_SIZE)
+        if cursor:
+            search = search.next_cursor(cursor)
+        response = search.execute()
+        resources.extend(response.get("resources", []))
+        cursor = response.get("next_cursor")
+        if not cursor:
+            return resources
+
+
+class Resource_inventory:
+    """
+    Cloudinary 资源列表的本地缓存 (JSON)。
+    列表接口会按 next_cursor 取完所有页；缓存在 RESOURCE_CACHE_TTL 内直接使用，
+    过期后只用 Search API 增量获取新上传的资源，超过 RESOURCE_CACHE_FULL_TTL 再全量刷新。
+
+    kind 可以是:
+        "asset_folder": resources_by_asset_folder(name) 的结果
+        "upload": resources(type="upload") 的结果，name 不使用
+    """
+
+    def __init__(self, path=None, ttl=RESOURCE_CACHE_TTL, full_ttl=RESOURCE_CACHE_FULL_TTL):
+        self.path = path or RESOURCE_CACHE_PATH or os.path.join(
+            os.path.dirname(DONE_MD_PATH), "cloudinary_resources.json"
+        )
+        self.ttl = ttl
+        self.full_ttl = full_ttl
+        self._lock = threading.Lock()
+        self.cache = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.cache = json.load(f)
+            except json.JSONDecodeError:
+                logger.warning(f"资源缓存 '{self.path}' 已损坏，将重新获取。")
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.cache, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _fetch_full(self, kind, name):
+        if kind == "asset_folder":
+            return fetch_all_pages(cloudinary.api.resources_by_asset_folder, name)
+        return fetch_all_pages(cloudinary.api.resources, type="upload")
+
+    def _fetch_since(self, kind, name, since):
+        # 往前多取一分钟，避免两边的时钟误差漏掉资源
+        uploaded_after = datetime.datetime.fromtimestamp(
+            since - 60, datetime.timezone.utc
+        ).strftime("%Y-%m-%dT%H:%M:%S")
+        if kind == "asset_folder":
+            expression = f'asset_folder="{name}" AND uploaded_at>"{uploaded_after}"'
+        else:
+            expression = f'type=upload AND uploaded_at>"{uploaded_after}"'
+        return search_all_pages(expression)
+
+    def list(self, kind, name="", refresh=False):
+        """
+        返回资源列表。
+
+        Args:
+            kind (str): "asset_folder" 或 "upload"。
+            name (str): kind 为 "asset_folder" 时的文件夹名。
+            refresh (bool): True 时忽略缓存，全量刷新。
+
+        Returns:
+            list[dict]: 资源列表。
+        """
+        key = f"{kind}:{name}"
+        now = time.time()
+        with self._lock:
+            entry = self.cache.get(key)
+            if entry and not refresh and now - entry["refreshed_at"] < self.ttl:
+                return list(entry["resources"].values())
+
+            if entry and not refresh and now - entry["full_at"] < self.full_ttl:
+                new_resources = self._fetch_since(kind, name, entry["refreshed_at"])
+                logger.debug(f"增量获取 '{key}' 的资源 {len(new_resources)} 个。")
+            else:
+                new_resources = self._fetch_full(kind, name)
+                logger.debug(f"全量获取 '{key}' 的资源 {len(new_resources)} 个。")
+                entry = {"full_at": now, "resources": {}}
+            for res in new_resources:
+                entry["resources"][res["public_id"]] = res
+            entry["refreshed_at"] = now
+            self.cache[key] = entry
+            self._save()
+            return list(entry["resources"].values())
+
+    def invalidate(self, kind=None, name=""):
+        """资源有变化(例如改名)后调用，下次 list 时全量刷新"""
+        with self._lock:
+            if kind is None:
+                self.cache = {}
+            else:
+                self.cache.pop(f"{kind}:{name}", None)
+            self._save()
+
+
+_inventory = None
+
+
+def get_inventory():
+    """返回进程内共用的 Resource_inventory"""
+    global _inventory
+    if _inventory is None:
+        _inventory = Resource_inventory()
+    return _inventory
 
 
 def get_cloudinary_comic_count():
@@ -33,10 +250,8 @@ def get_cloudinary_comic_count():
         f"正在从 Cloudinary 的 '{CLOUDINARY_ROOT_FOLDER}' 文件夹获取文件列表..."
     )
 
-    resources = cloudinary.api.resources_by_asset_folder(
-        "comic1", max_results=max_results
-    )
-    return len(resources.get("resources", []))
+    resources = get_inventory().list("asset_folder", "comic1")
+    return len(resources)
 
 
 def get_cloudinary_comic_covers():
@@ -45,14 +260,12 @@ def get_cloudinary_comic_covers():
         f"正在从 Cloudinary 的 '{CLOUDINARY_ROOT_FOLDER}' 文件夹获取文件列表..."
     )
 
-    resources = cloudinary.api.resources_by_asset_folder(
-        "comic1", max_results=max_results
-    )
+    resources = get_inventory().list("asset_folder", "comic1")
 
     # 我们只关心在 comic1 根目录下的文件, 形如 "comic1/a-1.jpg"
     # 排除子文件夹里的文件, 形如 "comic1/a/a-1.jpg"
     cover_files = set()
-    for res in resources.get("resources", []):
+    for res in resources:
         # public_id = res.get("public_id")
         # public_id 减去根目录前缀后，如果不包含'/'，说明它在根目录
         # if "/" not in public_id[len(CLOUDINARY_ROOT_FOLDER) + 1 :]:
@@ -65,13 +278,21 @@ def get_cloudinary_comic_covers():
     return cover_files
 
 
+def list_group_files(group_dir):
+    """
+    返回一组要上传的图片。
+    image_pipeline 编码时先写 <文件>.tmp 再替换，编码到一半中断会留下 .tmp 文件，不能当成页面上传。
+    """
+    return [f for f in glob.glob(os.path.join(group_dir, "*")) if not f.endswith(".tmp")]
+
+
 def group_local_files():
     """分组本地 notdone 文件夹中的图片"""
     logger.debug(f"正在扫描本地文件夹: {NOTDONE_PATH}")
     local_folds = glob.glob(os.path.join(NOTDONE_PATH, "*"))
     grouped = {}
     for f in local_folds:
-        local_files = glob.glob(os.path.join(f, "*"))
+        local_files = list_group_files(f)
         # group_name = os.path.basename(f)
         # grouped[group_name] = local_files
         grouped[f] = local_files
@@ -99,78 +320,250 @@ def move_group_to_done(group_files, group_name):
         shutil.move(f, os.path.join(target_fold, os.path.basename(f)))
 
 
-def multi_rename_remote_cloudinary_assets():
+def call_with_retry(func, *args, retries=UPLOAD_RETRIES, backoff=1, **kwargs):
+    """调用 Cloudinary 接口，失败时按指数退避(加随机抖动)重试"""
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait = backoff * 2**attempt + random.uniform(0, backoff)
+            logger.warning(f"调用 {func.__name__}{args} 失败({e})，{wait:.1f}秒后重试...")
+            time.sleep(wait)
+
+
+def upload_with_retry(file, retries=UPLOAD_RETRIES, backoff=1, **options):
+    """上传一个文件，失败时按指数退避(加随机抖动)重试"""
+    return call_with_retry(
+        cloudinary.uploader.upload, file, retries=retries, backoff=backoff, **options
+    )
+
+
+def plan_group_uploads(group_name, files):
     """
-    Renames folders and files in Cloudinary according to the specified rules.
+    生成一组文件的上传计划。
+    第一个文件作为封面上传到根目录，其余文件上传到 comic1/group_name 子文件夹。
+
+    Returns:
+        list[tuple[str, dict]]: (本地文件, cloudinary.uploader.upload 的参数) 的列表。
+    """
+    files = sorted(files)
+    plan = [(files[0], {"folder": CLOUDINARY_ROOT_FOLDER, "public_id": group_name})]
+    subfolder = f"{CLOUDINARY_ROOT_FOLDER}/{group_name}"
+    for f in files[1:]:
+        filename = os.path.basename(f)
+        plan.append((f, {"folder": subfolder, "public_id": os.path.splitext(filename)[0]}))
+    return plan
+
+
+def finish_group(group_name_full, group_name):
+    """一组文件全部上传成功后，移动本地文件并更新 done.md"""
+    logger.debug("  移动本地文件到完成目录")
+    move_group_folder_to_done(group_name_full, group_name)
+
+    logger.debug(f"  更新 '{DONE_MD_PATH}' 文件")
+    with open(DONE_MD_PATH, "a", encoding="utf-8") as md_file:
+        md_file.write(f"{group_name},")
+    logger.debug(f"--- 组 '{group_name}' 处理完成 ---")
+
+
+def upload_groups_concurrently(groups, manifest, max_workers=UPLOAD_CONCURRENCY):
+    """
+    用线程池同时上传多个组的文件。
+    一个组只有在所有文件都上传成功后才会移动到 DONE_PATH 并写入 DONE_MD_PATH，
+    有文件失败的组留在原地，下次运行时重新处理。
+
+    Args:
+        groups (list[tuple[str, str, list]]): (组目录, 组名, 待上传列表) 的列表，
+            待上传列表是 Upload_manifest.pending_uploads 的返回值。
+        manifest (Upload_manifest): 每个文件上传成功后记录到这个清单。
+        max_workers (int): 同时上传的文件数。
+
+    Returns:
+        list[str]: 上传成功的组名。
+    """
+    remaining, failed, uploaded = {}, set(), []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_group = {}
+        for group_name_full, group_name, pending in groups:
+            remaining[group_name_full] = len(pending)
+            for f, options, sha256 in pending:
+                future = executor.submit(upload_with_retry, f, **options)
+                future_to_group[future] = (group_name_full, group_name, f, options, sha256)
+
+        # 在当前线程里收集结果，移动文件和写 done.md 都不会并发执行
+        for future in as_completed(future_to_group):
+            group_name_full, group_name, f, options, sha256 = future_to_group[future]
+            try:
+                future.result()
+                manifest.record(Upload_manifest.public_id(options), sha256, f)
+                logger.debug(f"    - 上传 {os.path.basename(f)} 完成")
+            except Exception as e:
+                logger.error(f"上传 {f} 失败: {e}")
+                failed.add(group_name_full)
+            remaining[group_name_full] -= 1
+            if remaining[group_name_full]:
+                continue
+            if group_name_full in failed:
+                logger.error(f"组 '{group_name}' 有文件上传失败，保留在本地等待下次上传。")
+            else:
+                finish_group(group_name_full, group_name)
+                uploaded.append(group_name)
+    return uploaded
+
+
+def plan_asset_rename(asset):
+    """
+    按规则计算一个资源的新名字。
     - Folders are padded with leading zeros to 4 digits.
     - Filenames are padded to the format XXXX-YYY.jpg.
+
+    Returns:
+        tuple[str, str, str] | None: (public_id, new_public_id, new_display_name)，不需要改名时返回 None。
     """
-    # Get all assets. You might need to handle pagination for large number of assets.
-    # This example gets up to 500 assets.
-    # To get all assets, you will need to use the `next_cursor` for pagination.
-    response = cloudinary.api.resources(type="upload", max_results=500)
-    assets = response.get("resources", [])
-
-    # To fetch all assets, you can use a loop like this:
-    # next_cursor = response.get('next_cursor')
-    # while next_cursor:
-    #     response = cloudinary.api.resources(type="upload", max_results=500, next_cursor=next_cursor)
-    #     assets.extend(response.get('resources', []))
-    #     next_cursor = response.get('next_cursor')
-
-    for asset in assets:
-        public_id = asset["public_id"]
-
-        # This regex assumes a folder structure like "folder_number/file_number-file_number"
-        # e.g. "29/9-13"
-        match = re.match(r"([1-9a-z]+\/)(\d+)/(\d+)-(\d+)", public_id)
-
-        if match:
-            prefie = match.group(1)
-            folder_num_str = match.group(2)
-            file_num1_str = match.group(3)
-            file_num2_str = match.group(4)
-
-            # New names with padding
-            new_folder = f"{int(folder_num_str):04d}"
-            new_filename_part1 = f"{int(file_num1_str):04d}"
-            new_filename_part2 = f"{int(file_num2_str):03d}"
-
-            new_public_id = (
-                f"{prefie}{new_folder}/{new_filename_part1}-{new_filename_part2}"
-            )
-            new_display_name = (
-                f"{new_filename_part1}-{new_filename_part2}.{asset['format']}"
-            )
+    public_id = asset["public_id"]
+
+    # This regex assumes a folder structure like "folder_number/file_number-file_number"
+    # e.g. "29/9-13"
+    match = re.match(r"([1-9a-z]+\/)(\d+)/(\d+)-(\d+)", public_id)
+    if match:
+        prefie = match.group(1)
+        new_folder = f"{int(match.group(2)):04d}"
+        new_filename_part1 = f"{int(match.group(3)):04d}"
+        new_filename_part2 = f"{int(match.group(4)):03d}"
+
+        new_public_id = f"{prefie}{new_folder}/{new_filename_part1}-{new_filename_part2}"
+        new_display_name = f"{new_filename_part1}-{new_filename_part2}.{asset['format']}"
+    else:
+        match2 = re.match(r"([1-9a-z]+\/)(\d+)", public_id)
+        if not match2:
+            return None
+        prefie = match2.group(1)
+        new_filename_part1 = f"{int(match2.group(2)):04d}"
 
-            if public_id != new_public_id:
-                print(f"Renaming {public_id} to {new_public_id}@{new_display_name}")
-                try:
-                    cloudinary.uploader.rename(public_id, new_public_id)
-                    cloudinary.api.update(new_public_id, display_name=new_display_name)
-                except Exception as e:
-                    print(f"Error renaming {public_id}: {e}")
-        else:
-            match2 = re.match(r"([1-9a-z]+\/)(\d+)", public_id)
-            prefie = match2.group(1)
-            file_num1_str = match2.group(2)
+        new_public_id = f"{prefie}{new_filename_part1}"
+        new_display_name = f"{new_filename_part1}.{asset['format']}"
 
-            new_filename_part1 = f"{int(file_num1_str):04d}"
+    if public_id == new_public_id:
+        return None
+    return public_id, new_public_id, new_display_name
 
-            new_public_id = f"{prefie}{new_filename_part1}"
-            new_display_name = f"{new_filename_part1}.{asset['format']}"
-            if public_id != new_public_id:
-                print(f"Renaming {public_id} to {new_public_id}@{new_display_name}")
-                try:
-                    cloudinary.uploader.rename(public_id, new_public_id)
-                    cloudinary.api.update(new_public_id, display_name=new_display_name)
-                except Exception as e:
-                    print(f"Error renaming {public_id}: {e}")
+
+class Rename_checkpoint:
+    """
+    批量改名的进度记录 (JSONL)。每个资源记录两个阶段：
+    renamed(已改 public_id) 和 updated(已改 display_name)，中断后重新运行时跳过已完成的部分。
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(
+            os.path.dirname(DONE_MD_PATH), "rename_checkpoint.jsonl"
+        )
+        self._lock = threading.Lock()
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.stages[entry["from"]] = entry
+
+    def record(self, public_id, new_public_id, new_display_name, stage):
+        entry = {
+            "from": public_id,
+            "to": new_public_id,
+            "display_name": new_display_name,
+            "stage": stage,
+        }
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.stages[public_id] = entry
+
+    def stage(self, public_id):
+        entry = self.stages.get(public_id)
+        return entry["stage"] if entry else None
+
+    def unfinished(self):
+        """已改 public_id 但还没改 display_name 的资源"""
+        return [
+            (entry["from"], entry["to"], entry["display_name"])
+            for entry in self.stages.values()
+            if entry["stage"] == "renamed"
+        ]
+
+
+def bulk_rename(dry_run=False, max_workers=RENAME_CONCURRENCY, checkpoint_path=None):
+    """
+    批量改名。先从分页获取的完整资源列表算出改名计划，再用线程池并发执行，
+    每个接口调用失败时重试，进度写入 Rename_checkpoint，中断后重新运行会从断点继续。
+
+    Args:
+        dry_run (bool): True 时只打印改名计划，不调用改名接口。
+        max_workers (int): 同时执行的改名数。
+        checkpoint_path (str): 进度文件路径，默认放在 DONE_MD_PATH 旁边。
+
+    Returns:
+        list[tuple[str, str, str]]: 改名计划 (public_id, new_public_id, new_display_name)。
+    """
+    inventory = get_inventory()
+    checkpoint = Rename_checkpoint(checkpoint_path)
+
+    # 改名前全量刷新，避免按过期的列表改名
+    plan = []
+    for asset in inventory.list("upload", refresh=True):
+        item = plan_asset_rename(asset)
+        if item and checkpoint.stage(item[0]) != "updated":
+            plan.append(item)
+    # 上次中断时已改 public_id、还没改 display_name 的资源，新列表里已经是新名字了
+    planned = {item[0] for item in plan}
+    plan.extend(item for item in checkpoint.unfinished() if item[0] not in planned)
+
+    logger.info(f"需要改名的资源: {len(plan)} 个。")
+    for public_id, new_public_id, new_display_name in plan:
+        print(f"Renaming {public_id} to {new_public_id}@{new_display_name}")
+    if dry_run or not plan:
+        return plan
+
+    def rename_one(public_id, new_public_id, new_display_name):
+        if checkpoint.stage(public_id) != "renamed":
+            call_with_retry(cloudinary.uploader.rename, public_id, new_public_id)
+            checkpoint.record(public_id, new_public_id, new_display_name, "renamed")
+        call_with_retry(cloudinary.api.update, new_public_id, display_name=new_display_name)
+        checkpoint.record(public_id, new_public_id, new_display_name, "updated")
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(rename_one, *item): item for item in plan}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Error renaming {futures[future][0]}: {e}")
+    logger.info(f"改名完成: 成功 {len(plan) - failed} 个，失败 {failed} 个。")
+
+    # public_id 变了，缓存的列表要全量刷新
+    inventory.invalidate()
+    return plan
+
+
+def multi_rename_remote_cloudinary_assets(dry_run=False):
+    """
+    Renames folders and files in Cloudinary according to the specified rules.
+    - Folders are padded with leading zeros to 4 digits.
+    - Filenames are padded to the format XXXX-YYY.jpg.
+    See bulk_rename for concurrency, dry-run and resume behavior.
+    """
+    return bulk_rename(dry_run=dry_run)
 
 
 def main():
-    only_count = True
-    cloudinary_comic_count, cloudinary_covers = 0, []
     local_groups = group_local_files()
 
     with open(DONE_MD_PATH, "a", encoding="utf-8") as md_file:
@@ -179,61 +572,28 @@ def main():
     if not len(local_groups):
         return
 
-    if only_count:
-        # cloudinary_comic_count = get_cloudinary_comic_count()
-        cloudinary_comic_count = 0
-    else:
-        cloudinary_covers = get_cloudinary_comic_covers()
-
+    # 用本地清单判断哪些文件已经上传过，不调用 Cloudinary 的列表接口
+    manifest = Upload_manifest()
+    groups_to_upload = []
     for group_name_full, files in local_groups.items():
         group_name = os.path.basename(group_name_full)
         logger.debug(f"\n--- 正在处理组: {group_name} ---")
-
-        # 判断封面是否已存在于 Cloudinary
-        if only_count:
-            is_uploaded = int(group_name) <= cloudinary_comic_count
-        else:
-            is_uploaded = group_name in cloudinary_covers
-
-        if is_uploaded or not len(files):
-            logger.debug(f"组 '{group_name}' 的封面已存在于 Cloudinary。跳过上传。")
-            # move_group_to_done(files,group_name)
+        if not len(files):
             continue
 
-        # --- 如果不存在，执行上传逻辑 ---
-        logger.debug(f"组 '{group_name}' 不存在于 Cloudinary。开始上传...")
-
-        # 1. 上传封面 (组里的第一个文件) 到 comic1 根目录
-        cover_file = sorted(files)[0]
-        cover_filename = os.path.basename(cover_file)
-        logger.debug(f"  1. 上传封面 '{cover_filename}' 到 '{CLOUDINARY_ROOT_FOLDER}'")
-        cloudinary.uploader.upload(
-            cover_file,
-            folder=CLOUDINARY_ROOT_FOLDER,
-            # public_id=os.path.splitext(cover_filename)[0],  # 使用不带扩展名的文件名作为 public_id
-            public_id=group_name,
-        )
-
-        # 2. 上传所有文件到 comic1/group_name 子文件夹
-        subfolder = f"{CLOUDINARY_ROOT_FOLDER}/{group_name}"
-        logger.debug(f"  2. 上传 {len(files)} 个文件到子文件夹 '{subfolder}'")
-        for f in files[1:]:
-            filename = os.path.basename(f)
-            logger.debug(f"    - 上传 {filename}")
-            cloudinary.uploader.upload(
-                f, folder=subfolder, public_id=os.path.splitext(filename)[0]
-            )
-
-        # 3. 移动本地文件
-        logger.debug("  4. 移动本地文件到完成目录")
-        move_group_folder_to_done(group_name_full, group_name)
-
-        # 4. 更新 done.md
-        logger.debug(f"  3. 更新 '{DONE_MD_PATH}' 文件")
-        with open(DONE_MD_PATH, "a", encoding="utf-8") as md_file:
-            md_file.write(f"{group_name},")
+        pending = manifest.pending_uploads(plan_group_uploads(group_name, files))
+        if not pending:
+            # 文件都已上传过(例如上次上传完成后没来得及移动)，直接完成这个组
+            logger.debug(f"组 '{group_name}' 的文件已全部上传到 Cloudinary。跳过上传。")
+            finish_group(group_name_full, group_name)
+            continue
+        groups_to_upload.append((group_name_full, group_name, pending))
 
-        logger.debug(f"--- 组 '{group_name}' 处理完成 ---")
+    # 1. 上传封面 (组里的第一个文件) 到 comic1 根目录
+    # 2. 上传其余文件到 comic1/group_name 子文件夹
+    # 3. 移动本地文件, 4. 更新 done.md
+    # UPLOAD_CONCURRENCY 为 1 时也走这里，逐个上传，同样有重试，一个组失败不影响其他组
+    upload_groups_concurrently(groups_to_upload, manifest, max(1, UPLOAD_CONCURRENCY))
 
 def update_task_record(tm=None):
     with open(DONE_MD_PATH, "r", encoding="utf-8") as f:
@@ -247,14 +607,11 @@ def update_task_record(tm=None):
 
             uploaded_list = line.split(",")
             uploaded_list = [int(i) for i in uploaded_list]
-            from task_manager import Task_manager
+            from task_manager import get_task_manager
 
             if not tm:
-                tm = Task_manager()
-            tasks = tm.read_df_from_csv()
-            uncomplete_task = tasks.query(
-                "is_target == 1 and generate_storybook==1 and upload_storybook != 1"
-            )
+                tm = get_task_manager()
+            uncomplete_task = tm.read_target_tasks("upload_storybook")
             uncomplete_set = set(uncomplete_task.id)
             uploaded_set = set(uploaded_list)
             logger.info(
@@ -262,11 +619,8 @@ def update_task_record(tm=None):
             )
             if not uploaded_set.issubset(uncomplete_set):
                 logger.warning(f"本次上传成功的数据状态可能不对，请确认")
-            target_index = tasks["id"].isin(uploaded_list)
-            tasks.loc[target_index, "upload_storybook"] = 1
-            # tasks.loc[target_index, "is_target"] = 1
-
-            tm.update_task(tasks)
+            tm.mark(uploaded_list, "upload_storybook", 1)
+            tm.flush()
             return uploaded_list
 
 if __name__ == "__main__":
@@ -1,8 +1,17 @@
 import os
+import time
+import random
+import asyncio
+import threading
 import instructor
+from dotenv import load_dotenv
 
 # Choose the appropriate import based on your API:
 from langchain_google_genai import ChatGoogleGenerativeAI
+from logger_config import get_logger
+
+load_dotenv()
+logger = get_logger(__name__)
 
 # config = {
 #     "model": "gemini-2.5-flash",
@@ -13,14 +22,181 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 #     "google_api_key": os.environ.get("gemini_api_key2"),
 # }
 
+# 轮流使用的多个 API key，用逗号分隔，不设置时只用 gemini_api_key2
+GEMINI_API_KEYS = os.getenv("GEMINI_API_KEYS", "")
+# 每个 key 每分钟最多的请求数
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "10"))
+# 遇到 429 等错误时的最大重试次数
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "5"))
+# abatch 同时进行的请求数
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))
+
+_clients = {}
+_pools = {}
+_lock = threading.Lock()
+_pools_lock = threading.Lock()
+
+
+def get_api_keys():
+    keys = [key.strip() for key in GEMINI_API_KEYS.split(",") if key.strip()]
+    if not keys and os.environ.get("gemini_api_key2"):
+        keys = [os.environ.get("gemini_api_key2")]
+    return keys
 
-def get_llm(model_name="gemini-2.5-flash", api_key=None):
+
+def get_llm(model_name="gemini-2.5-flash", api_key=None, temperature=0, max_retries=None):
+    """
+    返回 (model_name, api_key, temperature) 对应的 ChatGoogleGenerativeAI，
+    参数相同时复用同一个实例和它的连接。
+    """
     if not api_key:
         api_key = os.environ.get("gemini_api_key2")
-    llm = ChatGoogleGenerativeAI(
-        model=model_name, google_api_key=api_key, temperature=0
-    )
-    return llm
+    key = (model_name, api_key, temperature, max_retries)
+    with _lock:
+        if key not in _clients:
+            options = {} if max_retries is None else {"max_retries": max_retries}
+            _clients[key] = ChatGoogleGenerativeAI(
+                model=model_name, google_api_key=api_key, temperature=temperature, **options
+            )
+        return _clients[key]
+
+
+class Token_bucket:
+    """
+    令牌桶限流。每秒补充 rate 个令牌，最多攒 capacity 个，
+    每次请求取一个令牌，没有令牌时等待。
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self):
+        # 取到令牌时返回 0，否则返回需要等待的秒数
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while (wait := self._take()) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while (wait := self._take()) > 0:
+            await asyncio.sleep(wait)
+
+
+def is_rate_limited(e):
+    text = f"{type(e).__name__} {e}"
+    return "429" in text or "ResourceExhausted" in text or "RESOURCE_EXHAUSTED" in text
+
+
+class Gemini_client_pool:
+    """
+    在多个 API key 之间轮流调用 Gemini。
+    每个 key 有自己的令牌桶，遇到 429 时换下一个 key，按指数退避(加随机抖动)重试。
+    """
+
+    def __init__(self, model_name="gemini-2.5-flash", temperature=0, api_keys=None, rpm=GEMINI_RPM):
+        self.model_name = model_name
+        self.temperature = temperature
+        self.api_keys = api_keys or get_api_keys()
+        if not self.api_keys:
+            raise ValueError("没有可用的 Gemini API key，请设置 GEMINI_API_KEYS 或 gemini_api_key2")
+        # 重试和换 key 由这里处理，客户端自己不再重试
+        self.clients = [get_llm(model_name, key, temperature, max_retries=1) for key in self.api_keys]
+        self.buckets = [Token_bucket(rpm / 60) for _ in self.api_keys]
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def _next(self):
+        with self.lock:
+            index = self.next_index
+            self.next_index = (index + 1) % len(self.clients)
+        return self.clients[index], self.buckets[index]
+
+    def _backoff(self, attempt, e):
+        wait = 2**attempt + random.uniform(0, 1)
+        logger.warning(f"调用 Gemini 失败({e})，{wait:.1f}秒后换 key 重试...")
+        return wait
+
+    def invoke(self, messages, retries=GEMINI_RETRIES):
+        for attempt in range(retries + 1):
+            client, bucket = self._next()
+            bucket.acquire()
+            try:
+                return client.invoke(messages)
+            except Exception as e:
+                if attempt == retries or not is_rate_limited(e):
+                    raise
+                time.sleep(self._backoff(attempt, e))
+
+    async def ainvoke(self, messages, retries=GEMINI_RETRIES):
+        for attempt in range(retries + 1):
+            client, bucket = self._next()
+            await bucket.acquire_async()
+            try:
+                return await client.ainvoke(messages)
+            except Exception as e:
+                if attempt == retries or not is_rate_limited(e):
+                    raise
+                await asyncio.sleep(self._backoff(attempt, e))
+
+    async def abatch(self, list_of_messages, concurrency=GEMINI_CONCURRENCY, return_exceptions=False):
+        """
+        并发调用 ainvoke，结果的顺序和输入一致。
+
+        Args:
+            list_of_messages (list): 每个元素是一次调用的 prompt 或消息列表。
+            concurrency (int): 同时进行的请求数。
+            return_exceptions (bool): True 时失败的调用返回异常对象，不影响其他调用。
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(messages):
+            async with semaphore:
+                return await self.ainvoke(messages)
+
+        return await asyncio.gather(
+            *(one(messages) for messages in list_of_messages), return_exceptions=return_exceptions
+        )
+
+    def batch(self, list_of_messages, concurrency=GEMINI_CONCURRENCY, return_exceptions=False):
+        """abatch 的同步版本"""
+        return run_in_loop(self.abatch(list_of_messages, concurrency, return_exceptions))
+
+
+_loop = None
+
+
+def run_in_loop(coro):
+    """
+    在后台线程的常驻事件循环里执行协程并等待结果。
+    客户端的异步连接和创建它的事件循环绑定，每次 asyncio.run 新建循环会导致连接无法复用。
+    """
+    global _loop
+    with _pools_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+
+def get_client_pool(model_name="gemini-2.5-flash", temperature=0):
+    """返回进程内共用的 Gemini_client_pool"""
+    key = (model_name, temperature)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = Gemini_client_pool(model_name, temperature)
+        return _pools[key]
 
 
 # if __name__ == "__main__":
@@ -2,14 +2,24 @@
 这个模块包含使用LLM（大型语言模型）生成内容的工具函数。
 """
 
+import os
 import json
-from typing import List, Callable
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Callable, Iterator, Dict
 from logger_config import get_logger
-from gemini_api_util import get_llm
+from gemini_api_util import get_llm, get_client_pool, run_in_loop
+import llm_cache
+import json_stream
 from langchain_core.messages import AIMessage
 
 logger = get_logger(__name__)
 
+# 一次 LLM 调用最多生成的故事数，超过时拆成多次并发调用
+STORIES_PER_CALL = int(os.getenv("STORIES_PER_CALL", "5"))
+# generate_stories_bulk 同时进行的 LLM 调用数
+STORY_CONCURRENCY = int(os.getenv("STORY_CONCURRENCY", "4"))
+
 
 class MockLLM:
     """
@@ -59,6 +69,74 @@ def extract_json_from_string(text: str) -> dict | None:
     return json.loads(text)
 
 
+def build_story_prompt(topic: str, number_of_stories: int = 3, word_count: int = 30, part: int = 0) -> str:
+    # 构建一个清晰、具体的提示，要求LLM返回JSON格式
+    # 同一个主题拆成多次调用时，用 part 区分每次的 prompt，避免缓存返回同一组故事
+    part_text = f"\n    这是第{part + 1}组故事，请写和常见写法不同的情节。" if part else ""
+    return f"""请根据主题生成一个JSON对象。
+    对象应该包含一个名为 "stories" 的键，其值是长度为 {number_of_stories}的数组。
+    数组每个元素是{word_count}个字左右，跟主题有关系的独立小故事。
+    小故事里不要用任何代词。
+    请确保您的回答是严格的JSON格式，不要包含任何额外的解释或注释。
+    主题：
+    '{topic}'{part_text}
+"""
+
+
+def generate_stories_by_stream(
+    topic: str,
+    stream_func: Callable[..., Iterator[str]],
+    number_of_stories: int = 3,
+    word_count: int = 30,
+) -> List[str]:
+    """
+    使用流式生成函数生成小故事，生成够 number_of_stories 个故事后立刻停止，
+    不用等 LLM 把 JSON 和后面的多余内容都生成完。
+
+    Args:
+        topic (str): 故事的主题。
+        stream_func (Callable[..., Iterator[str]]): 流式生成函数，
+            接受 prompt 和关键字参数 stop_when，逐段返回文本。
+            例如: Local_llm.stream_query
+        number_of_stories (int): 需要生成的故事数量。
+        word_count (int): 每个故事的大致字数。
+
+    Returns:
+        List[str]: 生成的故事列表。如果失败则返回空列表。
+    """
+    prompt = build_story_prompt(topic, number_of_stories, word_count)
+
+    # 每个故事的字符串一闭合就取出来，够数后停止生成
+    parser = json_stream.Json_array_stream("stories")
+    stories = []
+
+    def enough(text):
+        return len(stories) >= number_of_stories
+
+    response_text = ""
+    try:
+        chunks = stream_func(prompt, stop_when=enough)
+        try:
+            for chunk in chunks:
+                response_text += chunk
+                stories.extend(s for s in parser.feed(chunk) if isinstance(s, str))
+                if enough(response_text):
+                    break
+        finally:
+            # 提前结束时关闭生成器，让 LLM 停止生成
+            if hasattr(chunks, "close"):
+                chunks.close()
+        logger.info(response_text)
+    except Exception as e:
+        logger.error(f"在与LLM交互或处理数据时发生未知错误: {e}")
+        return []
+
+    stories = stories[:number_of_stories]
+    if not stories:
+        logger.error(f"错误：LLM返回的文本中没有完整的故事。收到的文本: \n{response_text}")
+    return stories
+
+
 def generate_stories_by_generation_func(
     topic: str,
     generation_func: Callable[[str], str],
@@ -79,22 +157,30 @@ def generate_stories_by_generation_func(
     Returns:
         List[str]: 一个包含生成的故事字符串的列表。如果失败则返回空列表。
     """
-    # 构建一个清晰、具体的提示，要求LLM返回JSON格式
-    prompt = f"""请根据主题生成一个JSON对象。
-    对象应该包含一个名为 "stories" 的键，其值是长度为 {number_of_stories}的数组。
-    数组每个元素是{word_count}个字左右，跟主题有关系的独立小故事。
-    小故事里不要用任何代词。
-    请确保您的回答是严格的JSON格式，不要包含任何额外的解释或注释。
-    主题：
-    '{topic}'
-"""
+    prompt = build_story_prompt(topic, number_of_stories, word_count)
 
     response_text = ""
     try:
         # 调用传入的函数来获取结果
         response_text = generation_func(prompt)
         logger.info(response_text)
+    except Exception as e:
+        logger.error(f"在与LLM交互或处理数据时发生未知错误: {e}")
+        return []
+    return parse_stories(response_text)
+
+
+def parse_stories(response_text) -> List[str]:
+    """
+    从LLM的回复中解析出故事列表。
 
+    Args:
+        response_text (str | AIMessage): generation_func 的返回值。
+
+    Returns:
+        List[str]: 故事列表。格式不对时返回空列表。
+    """
+    try:
         # 解析LLM返回的JSON字符串
         if isinstance(response_text, AIMessage):
             response_text=response_text.content
@@ -111,6 +197,11 @@ def generate_stories_by_generation_func(
             return []
 
     except json.JSONDecodeError:
+        # 回复被截断或后面有多余内容时，保留已经完整的故事
+        stories = [s for s in json_stream.parse_array(response_text, "stories") if isinstance(s, str)]
+        if stories:
+            logger.warning(f"LLM返回的JSON不完整，保留其中完整的 {len(stories)} 个故事。")
+            return stories
         logger.error(
             f"错误：无法解析LLM返回的文本为JSON。收到的文本: \n{response_text}"
         )
@@ -120,33 +211,162 @@ def generate_stories_by_generation_func(
         return []
 
 
+def has_stories(response_text) -> bool:
+    """回复能解析出故事时返回 True，作为 llm_cache.cached 的 validate 使用"""
+    return bool(parse_stories(response_text))
+
+
+def split_story_counts(number_of_stories: int, chunk_size: int = STORIES_PER_CALL) -> List[int]:
+    """把故事数拆成每次不超过 chunk_size 的若干份，例如 12 -> [5, 5, 2]"""
+    chunk_size = max(1, chunk_size)
+    return [min(chunk_size, number_of_stories - i) for i in range(0, number_of_stories, chunk_size)]
+
+
+def _story_jobs(topics, number_of_stories, chunk_size):
+    # 每次调用是 (主题, 故事数, 第几份)，重复的主题只生成一次
+    return [
+        (topic, count, part)
+        for topic in dict.fromkeys(topics)
+        for part, count in enumerate(split_story_counts(number_of_stories, chunk_size))
+    ]
+
+
+def _merge_stories(topics, jobs, results, number_of_stories) -> Dict[str, List[str]]:
+    # 按主题合并各次调用的结果，去掉重复的故事
+    merged = {topic: [] for topic in topics}
+    for (topic, _, _), stories in zip(jobs, results):
+        for story in stories:
+            if story not in merged[topic]:
+                merged[topic].append(story)
+    return {topic: stories[:number_of_stories] for topic, stories in merged.items()}
+
+
+async def agenerate_stories_bulk(
+    topics: List[str],
+    generation_func: Callable,
+    number_of_stories: int = 3,
+    word_count: int = 30,
+    chunk_size: int = STORIES_PER_CALL,
+    concurrency: int = STORY_CONCURRENCY,
+) -> Dict[str, List[str]]:
+    """
+    generate_stories_bulk 的 async 版本，generation_func 是 async 函数，
+    例如 gemini_api_util.get_client_pool().ainvoke。
+
+    Returns:
+        Dict[str, List[str]]: 每个主题生成的故事。
+    """
+    jobs = _story_jobs(topics, number_of_stories, chunk_size)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(topic, count, part):
+        prompt = build_story_prompt(topic, count, word_count, part)
+        async with semaphore:
+            try:
+                response_text = await generation_func(prompt)
+                logger.info(response_text)
+            except Exception as e:
+                logger.error(f"在与LLM交互或处理数据时发生未知错误: {e}")
+                return []
+        return parse_stories(response_text)
+
+    results = await asyncio.gather(*(one(*job) for job in jobs))
+    return _merge_stories(topics, jobs, results, number_of_stories)
+
+
+def generate_stories_bulk(
+    topics: List[str],
+    generation_func: Callable,
+    number_of_stories: int = 3,
+    word_count: int = 30,
+    chunk_size: int = STORIES_PER_CALL,
+    concurrency: int = STORY_CONCURRENCY,
+    task_manager=None,
+    pic=None,
+) -> Dict[str, List[str]]:
+    """
+    为多个主题并发生成小故事。
+    每个主题的 number_of_stories 按 chunk_size 拆成多次调用，所有调用并发进行，
+    同步的 generation_func 用线程池，async 的 generation_func 在 run_in_loop 的事件循环里执行。
+
+    Args:
+        topics (List[str]): 故事主题列表。
+        generation_func (Callable): 用于生成文本的函数，可以是普通函数或 async 函数。
+        number_of_stories (int): 每个主题需要生成的故事数量。
+        word_count (int): 每个故事的大致字数。
+        chunk_size (int): 一次调用最多生成的故事数。
+        concurrency (int): 同时进行的调用数。
+        task_manager: 指定时把所有故事一次性写入任务管理器。
+        pic: 写入任务管理器时的图片参数，和 insert_task 一样。
+
+    Returns:
+        Dict[str, List[str]]: 每个主题生成的故事，失败的主题为空列表。
+    """
+    if llm_cache.is_async(generation_func):
+        coro = agenerate_stories_bulk(
+            topics, generation_func, number_of_stories, word_count, chunk_size, concurrency
+        )
+        # 不能用 asyncio.run: 共用的客户端的异步连接绑定在 run_in_loop 的常驻事件循环上
+        result = run_in_loop(coro)
+    else:
+        jobs = _story_jobs(topics, number_of_stories, chunk_size)
+
+        def one(job):
+            topic, count, part = job
+            prompt = build_story_prompt(topic, count, word_count, part)
+            try:
+                response_text = generation_func(prompt)
+                logger.info(response_text)
+            except Exception as e:
+                logger.error(f"在与LLM交互或处理数据时发生未知错误: {e}")
+                return []
+            return parse_stories(response_text)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(one, jobs))
+        result = _merge_stories(topics, jobs, results, number_of_stories)
+
+    for topic, stories in result.items():
+        if len(stories) < number_of_stories:
+            logger.warning(f"主题 '{topic}' 只生成了 {len(stories)}/{number_of_stories} 个故事")
+
+    if task_manager is not None:
+        all_stories = [story for stories in result.values() for story in stories]
+        if all_stories:
+            task_manager.insert_task(all_stories, pic=pic)
+    return result
+
+
 # --- 主程序入口，用于演示和测试 ---
 if __name__ == "__main__":
-    # 1. 创建一个模拟的LLM实例
-    llm = get_llm()
+    from task_manager import get_task_manager
+
+    # 1. 多个 key 轮流调用的 Gemini 客户端
+    pool = get_client_pool()
+    tm = get_task_manager()
 
     # 2. 定义故事主题和数量
-    story_topic = "一只勇敢的小猫"
+    story_topics = ["一只勇敢的小猫"]
     number_of_stories = 30
 
-    # 3. 调用函数生成故事，演示传入方法
-    print(f"正在为主题 '{story_topic}' 生成 {number_of_stories} 个小故事...")
-    generated_stories_1 = generate_stories_by_generation_func(
-        topic=story_topic,
-        number_of_stories=number_of_stories,
+    # 3. 拆成多次调用并发生成，相同的 prompt 重新运行时使用缓存的回复，结果一次写入任务管理器
+    print(f"正在为主题 {story_topics} 各生成 {number_of_stories} 个小故事...")
+    generated = generate_stories_bulk(
+        story_topics,
         # generation_func=MockLLM().complete,  # 直接把方法作为参数传入
-        generation_func=llm.invoke,  # 直接把方法作为参数传入
+        generation_func=llm_cache.cached(
+            pool.ainvoke, model=pool.model_name, validate=has_stories, temperature=pool.temperature
+        ),
+        number_of_stories=number_of_stories,
+        task_manager=tm,
     )
 
     # 4. 打印结果
-    if generated_stories_1:
-        print("\n--- 成功生成的故事列表---")
-        for i, story in enumerate(generated_stories_1, 1):
-            print(f"{i}. {story}")
-    else:
-        logger.error("\n--- 未能生成故事 ---")
-
-    from task_manager import Task_manager
-    tm = Task_manager()
-    tm.insert_task(generated_stories_1)
+    for topic, stories in generated.items():
+        if stories:
+            print(f"\n--- '{topic}' 成功生成的故事列表---")
+            for i, story in enumerate(stories, 1):
+                print(f"{i}. {story}")
+        else:
+            logger.error(f"\n--- '{topic}' 未能生成故事 ---")
     # tm.update_task(df=None)
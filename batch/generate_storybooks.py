@@ -2,8 +2,9 @@ from playwright.sync_api import sync_playwright, Playwright, expect
 import time, os
 from logger_config import get_logger
 from dotenv import load_dotenv
-import random,subprocess
+import random,subprocess, threading, queue
 from playwright.sync_api import TimeoutError
+import image_pipeline
 
 WAIT_TIME = 30 * 1000
 load_dotenv()
@@ -12,6 +13,51 @@ START_BROWSER_CMD = os.getenv("START_BROWSER_CMD")
 SCREENSHOT_QUALITY = int(os.getenv("SCREENSHOT_QUALITY"))
 logger = get_logger(__name__)
 TARGET_URL_PART = "storybook"
+# 多标签页模式下，每个新标签页打开的绘本 Gem 地址
+STORYBOOK_URL = os.getenv("STORYBOOK_URL", "https://gemini.google.com/gem/storybook")
+# 同时用来生成绘本的标签页数，1 表示和以前一样逐个生成
+STORYBOOK_TABS = int(os.getenv("STORYBOOK_TABS", "1"))
+# 多个线程同时连接浏览器时，避免重复启动浏览器
+_browser_lock = threading.Lock()
+# 等待绘本页面渲染完成的最长时间(毫秒)，超时后才退回到固定的随机等待
+PAGE_READY_TIMEOUT = int(os.getenv("PAGE_READY_TIMEOUT", "15000"))
+# DOM 在这段时间(毫秒)内没有变化才认为页面已经稳定
+PAGE_READY_QUIET_MS = int(os.getenv("PAGE_READY_QUIET_MS", "500"))
+# 绘本页面的保存方式: screenshot(截图) / network(直接保存页面加载的原图，取不到时再截图)
+CAPTURE_MODE = os.getenv("CAPTURE_MODE", "screenshot")
+# 原图的 content-type 对应的扩展名
+IMAGE_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp"}
+# 要截图的左右两页
+PAGE_SELECTORS = ["storybook-page[class='left']", "storybook-page[class='right']"]
+
+# 在页面里判断当前左右两页是否渲染完成：
+# 图片都已加载(complete 且 naturalWidth > 0)、绘本内没有正在播放的动画、DOM 在 quietMs 内没有变化。
+# 第一次调用时安装 MutationObserver，传入 reset 时把“最后一次变化”设为现在(翻页前调用)。
+PAGE_READY_JS = """
+({selectors, quietMs, reset}) => {
+    const state = window.__storybookReady;
+    if (!state || reset) {
+        if (!state) {
+            window.__storybookReady = {last: Date.now()};
+            new MutationObserver(() => { window.__storybookReady.last = Date.now(); })
+                .observe(document.body, {subtree: true, childList: true, attributes: true, characterData: true});
+        }
+        window.__storybookReady.last = Date.now();
+        return false;
+    }
+    const pages = selectors
+        .map(selector => Array.from(document.querySelectorAll(selector)).pop())
+        .filter(page => page);
+    if (pages.length === 0) return false;
+    const images = pages.flatMap(page => Array.from(page.querySelectorAll('img')));
+    if (!images.every(img => img.complete && img.naturalWidth > 0)) return false;
+    const animating = document.getAnimations().some(animation =>
+        animation.playState === 'running' && animation.effect && animation.effect.target
+        && animation.effect.target.closest && animation.effect.target.closest('storybook, storybook-page'));
+    if (animating) return false;
+    return Date.now() - state.last >= quietMs;
+}
+"""
 
 def sleep_random(sleep_time=10, bias=1):
     r_sleep_time = random.randint(sleep_time - bias, sleep_time + bias)
@@ -63,7 +109,155 @@ def get_browser(playwright: Playwright):
     return browser, context, target_page
 
 
-def crawl_new_tab(context, href_storybook, id):
+class Page_ready_detector:
+    """
+    根据具体信号判断绘本的当前页是否渲染完成，代替固定的随机等待。
+    除了 PAGE_READY_JS 里检查的图片/动画/DOM 变化外，还要求没有未完成的图片请求。
+    """
+
+    def __init__(self, page, timeout=PAGE_READY_TIMEOUT, quiet_ms=PAGE_READY_QUIET_MS, poll_ms=200):
+        self.page = page
+        self.timeout = timeout
+        self.quiet_ms = quiet_ms
+        self.poll_ms = poll_ms
+        self.pending_images = set()
+        # 要在 goto 之前创建，才能统计到第一页的图片请求
+        page.on("request", self._on_request)
+        page.on("requestfinished", self._on_request_done)
+        page.on("requestfailed", self._on_request_done)
+
+    def _on_request(self, request):
+        if request.resource_type == "image":
+            self.pending_images.add(request)
+
+    def _on_request_done(self, request):
+        self.pending_images.discard(request)
+
+    def _evaluate(self, reset=False):
+        return self.page.evaluate(
+            PAGE_READY_JS,
+            {"selectors": PAGE_SELECTORS, "quietMs": self.quiet_ms, "reset": reset},
+        )
+
+    def reset(self):
+        """翻页前调用，之后的 DOM 稳定时间从现在开始算"""
+        self._evaluate(reset=True)
+
+    def wait(self):
+        """
+        等到当前页渲染完成。
+
+        Returns:
+            bool: 在 timeout 内就绪返回 True，超时返回 False。
+        """
+        deadline = time.monotonic() + self.timeout / 1000
+        while time.monotonic() < deadline:
+            # 用 wait_for_timeout 而不是 time.sleep，等待期间 playwright 才会处理请求事件
+            if not self.pending_images and self._evaluate():
+                return True
+            self.page.wait_for_timeout(self.poll_ms)
+        return False
+
+
+# 一页里只有一张图片、没有文字时返回图片地址，否则(文字页、多图合成的页面)返回 null
+PAGE_IMAGE_SRC_JS = """
+page => {
+    const images = Array.from(page.querySelectorAll('img'));
+    if (images.length !== 1 || page.innerText.trim()) return null;
+    return images[0].currentSrc || images[0].src;
+}
+"""
+
+
+class Page_image_capturer:
+    """
+    记录页面加载的图片响应，保存绘本页面时优先直接写入原图的字节，
+    不用重新截图、编码；取不到原图的页面(文字页、合成的页面)再截图。
+    传入 encoder 时，图片交给 image_pipeline 的进程池编码后写入，调用 wait 等待全部写完。
+    """
+
+    def __init__(self, page, mode=CAPTURE_MODE, encoder=None):
+        self.page = page
+        self.enabled = mode == "network"
+        self.encoder = encoder
+        self.futures = []
+        self.responses = {}
+        if self.enabled:
+            # 要在 goto 之前创建，才能记录到第一页的图片
+            page.on("response", self._on_response)
+
+    def _on_response(self, response):
+        content_type = response.headers.get("content-type", "").split(";")[0]
+        if response.ok and content_type in IMAGE_EXTENSIONS:
+            self.responses[response.url] = response
+
+    def _original_image(self, src):
+        # 返回 (原图字节, 扩展名)，拿不到时返回 None
+        response = self.responses.get(src) if src else None
+        if response is None:
+            return None
+        content_type = response.headers.get("content-type", "").split(";")[0]
+        try:
+            return response.body(), IMAGE_EXTENSIONS[content_type]
+        except Exception as e:
+            logger.debug(f"读取图片响应失败,url={src}: {e}")
+            return None
+
+    def _write(self, body, ext, base_path):
+        if self.encoder:
+            is_cover = os.path.basename(base_path).endswith("-001")
+            self.futures.append(self.encoder.submit(body, base_path, is_cover=is_cover))
+            return base_path + self.encoder.extension
+        with open(base_path + ext, "wb") as f:
+            f.write(body)
+        return base_path + ext
+
+    def wait(self):
+        """等待提交给进程池的图片全部写完"""
+        paths = [future.result() for future in self.futures]
+        self.futures = []
+        return paths
+
+    def save(self, locator, base_path):
+        """
+        保存一页绘本。
+
+        Args:
+            locator (Playwright Locator): storybook-page 元素。
+            base_path (str): 不带扩展名的保存路径。
+
+        Returns:
+            str: 实际保存的文件路径。
+        """
+        if self.enabled:
+            original = self._original_image(locator.evaluate(PAGE_IMAGE_SRC_JS))
+            if original:
+                return self._write(*original, base_path)
+        if self.encoder:
+            # 只截 PNG，编码在进程池里做
+            return self._write(locator.screenshot(type="png"), ".png", base_path)
+        locator.screenshot(path=base_path + ".jpg", type="jpeg", quality=SCREENSHOT_QUALITY)
+        return base_path + ".jpg"
+
+    def save_all(self, comic_dir, id):
+        """
+        不翻页，按 DOM 顺序直接保存所有页面的原图。
+        只有每一页都能取到原图时才保存，否则返回 False，由调用方翻页截图。
+        """
+        if not self.enabled:
+            return False
+        pages = self.page.locator("storybook-page")
+        srcs = [pages.nth(i).evaluate(PAGE_IMAGE_SRC_JS) for i in range(pages.count())]
+        originals = [self._original_image(src) for src in srcs]
+        if len(originals) < 2 or not all(originals):
+            return False
+        for page_num, (body, ext) in enumerate(originals, start=1):
+            self._write(body, ext, os.path.join(comic_dir, f"{id:0>4}-{page_num:03}"))
+        logger.debug(f"不翻页直接保存了{len(originals)}页原图,id={id}")
+        return True
+
+
+def crawl_new_tab(context, href_storybook, id, pending=None):
     """
     This function crawls a new tab and takes screenshots of each page.
 
@@ -71,6 +265,7 @@ def crawl_new_tab(context, href_storybook, id):
         context (Playwright Context): The Playwright context object.
         href_storybook (str): The URL of the storybook to be crawled.
         id (int): The ID of the storybook.
+        pending (list): 传入列表时不等待图片编码完成，把编码的 Future 加入这个列表，由调用方等待。
 
     Returns:
         bool: True if the crawling is successful.
@@ -78,6 +273,8 @@ def crawl_new_tab(context, href_storybook, id):
     logger.debug(f"开始访问会本页面,href={href_storybook},id={id}")
     id = str(id)
     new_tab = context.new_page()
+    detector = Page_ready_detector(new_tab)
+    capturer = Page_image_capturer(new_tab, encoder=image_pipeline.get_encoder())
     new_tab.goto(href_storybook)
     new_tab.bring_to_front()
 
@@ -97,15 +294,17 @@ def crawl_new_tab(context, href_storybook, id):
         # new_tab.wait_for_load_state('networkidle', timeout=WAIT_TIME)
 
         # 1:{1},2:{2,3},3:{4,5},
-        if current_page == 1:
-            sleep_random(20)
-        else:
-            sleep_random(4)
+        ready = detector.wait()
+        if not ready:
+            logger.debug(f"第{current_page}页在{detector.timeout}ms内没有就绪，改用固定等待。")
+            sleep_random(20 if current_page == 1 else 4)
+        if current_page == 1 and capturer.save_all(comic_dir, id):
+            break
+        if current_page != 1:
             storybook_content = new_tab.locator("storybook-page[class='left']").nth(-1)
             left_page_num=current_page*2-2
-            screenshot_path = os.path.join(comic_dir, f"{id:0>4}-{left_page_num:03}.jpg")
-            storybook_content.screenshot(
-                path=screenshot_path, type="jpeg", quality=SCREENSHOT_QUALITY
+            capturer.save(
+                storybook_content, os.path.join(comic_dir, f"{id:0>4}-{left_page_num:03}")
             )
 
         # if current_page == 1:
@@ -119,19 +318,25 @@ def crawl_new_tab(context, href_storybook, id):
         # expect(storybook_content).to_be_visible(timeout=WAIT_TIME)
         # expect(storybook_content).to_be_visible(timeout=WAIT_TIME)
 
-        time.sleep(1)
+        if not ready:
+            time.sleep(1)
         storybook_content = new_tab.locator("storybook-page[class='right']").nth(-1)
         right_page_num=current_page*2-1
-        screenshot_path = os.path.join(comic_dir, f"{id:0>4}-{right_page_num:03}.jpg")
-        storybook_content.screenshot(
-            path=screenshot_path, type="jpeg", quality=SCREENSHOT_QUALITY
+        screenshot_path = capturer.save(
+            storybook_content, os.path.join(comic_dir, f"{id:0>4}-{right_page_num:03}")
         )
         logger.debug(f"操作成功！截图{screenshot_path}已保存。")
         current_page += 1
         if next_page_button.is_disabled():
             break
+        detector.reset()
         next_page_button.click()
     new_tab.close()
+    if pending is not None:
+        pending.extend(capturer.futures)
+        return True
+    # 编码在进程池里进行，全部写完后才算完成，上传时不会缺页
+    capturer.wait()
     return True
 
 def upload_file(file_path,page,selector1='div[class~="file-uploader"]',selector2='button[data-test-id="local-image-file-uploader-button"]'):
@@ -162,77 +367,95 @@ def upload_file(file_path,page,selector1='div[class~="file-uploader"]',selector2
             file_chooser.set_files(file_path)
             sleep_random(7)
 
+def generate_in_page(context, target_page, prompt, id=1, pic=None, pending=None):
+    """
+    在 target_page 中输入提示词生成绘本，拿到分享链接后截图保存。
+
+    Args:
+        context (Playwright Context): target_page 所在的浏览器上下文。
+        target_page (Playwright Page): 已经打开绘本 Gem 的标签页。
+        prompt (str): 故事提示词。
+        id (int): 故事的 ID。
+        pic (str): 参考图片的路径，没有时为 None。
+        pending (list): 见 crawl_new_tab。
+
+    Returns:
+        bool: True if the crawling is successful.
+    """
+    close_panel_button = target_page.locator(
+        "button[aria-label='Close panel'][mattooltip='Close']"
+    )
+    try:
+        expect(close_panel_button).to_be_visible(timeout=WAIT_TIME)
+        close_panel_button.click()
+    # except TimeoutError as e:
+    except Exception as e:
+        logger.error(e)
+        print(f"在 {WAIT_TIME}ms 内未发现关闭按钮，跳过点击操作。")
+
+    input_box = target_page.locator("rich-textarea p").first
+    # 等待元素可见
+    expect(input_box).to_be_visible(timeout=60)
+
+    # while 1:
+    #     text_=input_box.inner_text()
+    #     match_res=re.match(r'^\s+$',text_)
+    #     if not text_ or not match_res:
+    #         break
+    #     input_box.clear()
+    for i in range(10):
+        input_box.clear()
+
+    prompt = f"""不要让我补充内容，按我给的提示词和你自己的想法，为这个故事生成绘本。
+    如果我上传了图片，绘本风格就参照图片的风格。
+    提示词是:
+    {prompt}"""
+    input_box.fill(prompt)
+
+    if pic:
+        upload_file(
+            # path=r"D:\workspace-lilyco\lilyco_storybook\asset\pic\done\0001\0001-007.jpg",
+            file_path=pic,
+            page=target_page,
+        )
+
+    time.sleep(3)
+    target_page.keyboard.press("Control+Enter")
+
+    # result_locator = target_page.locator("storybook")
+    share_button = target_page.locator("share-button")
+
+    logger.debug("正在等待share_button元素加载...")
+    # networkidle not work here ,to_be_enabled also not work
+    # target_page.wait_for_load_state("networkidle", timeout=WAIT_TIME*6)
+    # expect 会在这里暂停脚本，直到元素可见，或者超时（默认30秒）
+    expect(share_button).to_be_visible(timeout=180 * 1000)
+    # expect(share_button).to_be_enabled(timeout=180 * 1000)
+    sleep_random(15)
+    share_button.click()
+
+    # button = share_button.locator("button").nth(1)
+    # expect(button).to_be_visible(timeout=WAIT_TIME)
+    # button.click()
+
+    copy_link = target_page.locator('a[data-test-id="created-share-link"]')
+    # target_page.wait_for_load_state("networkidle", timeout=WAIT_TIME)
+    expect(copy_link).to_be_visible(timeout=WAIT_TIME)
+    href_storybook = copy_link.get_attribute("href")
+
+    share_canvas = copy_link.locator("xpath=..").locator("xpath=..")
+    close_canvas_button = share_canvas.locator("button[mattooltip='Close']")
+    expect(close_canvas_button).to_be_visible(timeout=WAIT_TIME)
+    close_canvas_button.click()
+
+    return crawl_new_tab(context, href_storybook, id, pending)
+
+
 def run(prompt, id=1, pic=None):
     with sync_playwright() as playwright:
         browser, context, target_page = get_browser_with_retry(playwright)
         try:
-            close_panel_button = target_page.locator(
-                "button[aria-label='Close panel'][mattooltip='Close']"
-            )
-            try:
-                expect(close_panel_button).to_be_visible(timeout=WAIT_TIME)
-                close_panel_button.click()
-            # except TimeoutError as e:
-            except Exception as e:
-                logger.error(e)
-                print(f"在 {WAIT_TIME}ms 内未发现关闭按钮，跳过点击操作。")
-
-            input_box = target_page.locator("rich-textarea p").first
-            # 等待元素可见
-            expect(input_box).to_be_visible(timeout=60)
-
-            # while 1:
-            #     text_=input_box.inner_text()
-            #     match_res=re.match(r'^\s+$',text_)
-            #     if not text_ or not match_res:
-            #         break
-            #     input_box.clear()
-            for i in range(10):
-                input_box.clear()
-
-            prompt = f"""不要让我补充内容，按我给的提示词和你自己的想法，为这个故事生成绘本。
-            如果我上传了图片，绘本风格就参照图片的风格。
-            提示词是:
-            {prompt}"""
-            input_box.fill(prompt)
-
-            if pic:
-                upload_file(
-                    # path=r"D:\workspace-lilyco\lilyco_storybook\asset\pic\done\0001\0001-007.jpg",
-                    file_path=pic,
-                    page=target_page,
-                )
-
-            time.sleep(3)
-            target_page.keyboard.press("Control+Enter")
-
-            # result_locator = target_page.locator("storybook")
-            share_button = target_page.locator("share-button")
-
-            logger.debug("正在等待share_button元素加载...")
-            # networkidle not work here ,to_be_enabled also not work
-            # target_page.wait_for_load_state("networkidle", timeout=WAIT_TIME*6)
-            # expect 会在这里暂停脚本，直到元素可见，或者超时（默认30秒）
-            expect(share_button).to_be_visible(timeout=180 * 1000)
-            # expect(share_button).to_be_enabled(timeout=180 * 1000)
-            sleep_random(15)
-            share_button.click()
-
-            # button = share_button.locator("button").nth(1)
-            # expect(button).to_be_visible(timeout=WAIT_TIME)
-            # button.click()
-
-            copy_link = target_page.locator('a[data-test-id="created-share-link"]')
-            # target_page.wait_for_load_state("networkidle", timeout=WAIT_TIME)
-            expect(copy_link).to_be_visible(timeout=WAIT_TIME)
-            href_storybook = copy_link.get_attribute("href")
-
-            share_canvas = copy_link.locator("xpath=..").locator("xpath=..")
-            close_canvas_button = share_canvas.locator("button[mattooltip='Close']")
-            expect(close_canvas_button).to_be_visible(timeout=WAIT_TIME)
-            close_canvas_button.click()
-
-            return crawl_new_tab(context, href_storybook, id)
+            return generate_in_page(context, target_page, prompt, id, pic)
 
         except Exception as e:
             logger.error(f"发生错误: {e}")
@@ -242,6 +465,93 @@ def run(prompt, id=1, pic=None):
             # browser.close() # 注释掉这一行
             logger.debug("脚本执行完毕。浏览器保持打开状态。")
 
+
+class Storybook_worker:
+    """
+    在当前线程里连接浏览器，并打开一个专用的绘本标签页。
+    playwright 的同步 API 不能跨线程使用，所以每个线程各自持有一个 Storybook_worker，
+    所有标签页共用 CDP 连接的同一个浏览器上下文(同一个登录状态)。
+    """
+
+    def __enter__(self):
+        self.playwright = sync_playwright().start()
+        with _browser_lock:
+            self.browser, self.context, _ = get_browser_with_retry(self.playwright)
+        self.page = self.context.new_page()
+        return self
+
+    def run(self, prompt, id=1, pic=None, pending=None):
+        try:
+            # 每个任务都在新的对话里生成
+            self.page.goto(STORYBOOK_URL)
+            return generate_in_page(self.context, self.page, prompt, id, pic, pending)
+        except Exception as e:
+            logger.error(f"发生错误: {e}")
+            return False
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.page.close()
+        finally:
+            self.playwright.stop()
+
+
+def run_pool(tasks, workers=STORYBOOK_TABS, on_done=None):
+    """
+    用 workers 个标签页并发生成绘本，哪个标签页空闲就把下一个任务交给它。
+
+    Args:
+        tasks (list): 任务列表，每个任务可以用 task["text"] / task["id"] / task["pic"] 取值。
+        workers (int): 同时打开的标签页数。
+        on_done (Callable[[int, bool], None]): 每完成一个任务就在调用线程中调用一次，
+            参数是任务 id 和 run 的结果。
+
+    Returns:
+        dict: 任务 id 到结果的映射。
+    """
+    task_queue = queue.Queue()
+    for task in tasks:
+        task_queue.put(task)
+    result_queue = queue.Queue()
+    worker_exit = object()
+
+    def worker_loop():
+        try:
+            with Storybook_worker() as worker:
+                while True:
+                    try:
+                        task = task_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    res = worker.run(task["text"], task["id"], pic=task["pic"])
+                    result_queue.put((task["id"], res))
+        except Exception as e:
+            logger.error(f"标签页启动失败: {e}")
+        finally:
+            result_queue.put(worker_exit)
+
+    threads = [
+        threading.Thread(target=worker_loop, daemon=True)
+        for _ in range(max(1, min(workers, task_queue.qsize())))
+    ]
+    for thread in threads:
+        thread.start()
+
+    # 在调用线程里记录结果，on_done 不需要考虑线程安全
+    results = {}
+    alive = len(threads)
+    while alive:
+        item = result_queue.get()
+        if item is worker_exit:
+            alive -= 1
+            continue
+        id, res = item
+        results[id] = res
+        if on_done:
+            on_done(id, res)
+    return results
+
+
 if __name__ == "__main__":
     run_crawl_new_tab = 0
     # --- 运行主程序 ---
@@ -252,21 +562,26 @@ if __name__ == "__main__":
             id = input("input your comic id\n")
             crawl_new_tab(context, href_storybook, id)
     else:
-        from task_manager import Task_manager
+        from task_manager import get_task_manager
 
-        tm = Task_manager()
-        tasks = tm.read_df_from_csv()
-        target_task = tasks.query("is_target == 1 and generate_storybook != 1")
+        tm = get_task_manager()
+        target_task = tm.read_target_tasks("generate_storybook")
         print("target_task", target_task)
-        for _, task in target_task.iterrows():
-            # prompt = "兔子托比在林间小溪上漂流,它沿途看到了很多鱼，它和其中一只叫波利的安康鱼做了朋友"
-            prompt = task["text"]
-            id = task["id"]
-            pic= task["pic"]
-            res = run(prompt, id,pic=pic)
+
+        def on_done(id, res):
             if res:
-                # tasks.loc[id, "generate_storybook"] = 1
-                tasks.loc[tasks["id"] == id, "generate_storybook"] = 1
-                tm.update_task(tasks)
+                tm.mark(id, "generate_storybook", 1)
             else:
-                logger.error('生成绘本失败')
+                logger.error(f'生成绘本失败,id={id}')
+
+        if STORYBOOK_TABS > 1:
+            run_pool([task for _, task in target_task.iterrows()], on_done=on_done)
+        else:
+            for _, task in target_task.iterrows():
+                # prompt = "兔子托比在林间小溪上漂流,它沿途看到了很多鱼，它和其中一只叫波利的安康鱼做了朋友"
+                prompt = task["text"]
+                id = task["id"]
+                pic= task["pic"]
+                res = run(prompt, id,pic=pic)
+                on_done(id, res)
+        tm.flush()
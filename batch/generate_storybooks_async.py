@@ -0,0 +1,385 @@
+"""
+generate_storybooks.py 的 asyncio 版本。
+用 playwright.async_api 在一个事件循环里同时处理多个绘本，
+等待生成、翻页和截图的时候不会占住线程。
+"""
+
+from playwright.async_api import async_playwright, Playwright, expect
+import asyncio, os
+import random, subprocess
+from logger_config import get_logger
+import image_pipeline
+from generate_storybooks import (
+    WAIT_TIME,
+    NOTDONE_PATH,
+    SCREENSHOT_QUALITY,
+    TARGET_URL_PART,
+    STORYBOOK_URL,
+    STORYBOOK_TABS,
+    PAGE_READY_TIMEOUT,
+    PAGE_READY_QUIET_MS,
+    PAGE_SELECTORS,
+    PAGE_READY_JS,
+    CAPTURE_MODE,
+    IMAGE_EXTENSIONS,
+    PAGE_IMAGE_SRC_JS,
+)
+
+logger = get_logger(__name__)
+
+
+async def sleep_random(sleep_time=10, bias=1):
+    r_sleep_time = random.randint(sleep_time - bias, sleep_time + bias)
+    await asyncio.sleep(r_sleep_time)
+
+
+async def get_browser_with_retry(playwright: Playwright):
+    try:
+        return await get_browser(playwright)
+    except Exception as e:
+        logger.error(f"发生错误: {e}")
+        START_BROWSER_CMD = os.getenv("START_BROWSER_CMD")
+        START_BROWSER_CMD_LIST = START_BROWSER_CMD.split("@@@")
+        subprocess.Popen(START_BROWSER_CMD_LIST)
+        await asyncio.sleep(10)
+        return await get_browser(playwright)
+
+
+async def get_browser(playwright: Playwright):
+    # ---. 连接到在9222端口上运行的现有浏览器 ---
+    logger.debug("正在连接到已打开的浏览器...")
+    browser = await playwright.chromium.connect_over_cdp("http://localhost:9222")
+
+    target_page = None
+    for context in browser.contexts:
+        for page in context.pages:
+            if TARGET_URL_PART in page.url:
+                target_page = page
+                break
+        if target_page:
+            break
+
+    if not target_page:
+        logger.error(
+            f"错误：在所有打开的标签页中，没有找到包含 '{TARGET_URL_PART}' 的页面。\n请确认你已经在指定的浏览器窗口中手动打开并登录了目标网站。"
+        )
+        await browser.close()
+        raise Exception(f"not found target page {TARGET_URL_PART}")
+    logger.debug(f"连接成功！当前页面是: {await target_page.title()}")
+    return browser, context, target_page
+
+
+class Page_ready_detector:
+    """generate_storybooks.Page_ready_detector 的异步版本"""
+
+    def __init__(self, page, timeout=PAGE_READY_TIMEOUT, quiet_ms=PAGE_READY_QUIET_MS, poll_ms=200):
+        self.page = page
+        self.timeout = timeout
+        self.quiet_ms = quiet_ms
+        self.poll_ms = poll_ms
+        self.pending_images = set()
+        page.on("request", self._on_request)
+        page.on("requestfinished", self._on_request_done)
+        page.on("requestfailed", self._on_request_done)
+
+    def _on_request(self, request):
+        if request.resource_type == "image":
+            self.pending_images.add(request)
+
+    def _on_request_done(self, request):
+        self.pending_images.discard(request)
+
+    async def _evaluate(self, reset=False):
+        return await self.page.evaluate(
+            PAGE_READY_JS,
+            {"selectors": PAGE_SELECTORS, "quietMs": self.quiet_ms, "reset": reset},
+        )
+
+    async def reset(self):
+        await self._evaluate(reset=True)
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout / 1000
+        while loop.time() < deadline:
+            if not self.pending_images and await self._evaluate():
+                return True
+            await asyncio.sleep(self.poll_ms / 1000)
+        return False
+
+
+class Page_image_capturer:
+    """generate_storybooks.Page_image_capturer 的异步版本"""
+
+    def __init__(self, page, mode=CAPTURE_MODE, encoder=None):
+        self.page = page
+        self.enabled = mode == "network"
+        self.encoder = encoder
+        self.futures = []
+        self.responses = {}
+        if self.enabled:
+            page.on("response", self._on_response)
+
+    def _on_response(self, response):
+        content_type = response.headers.get("content-type", "").split(";")[0]
+        if response.ok and content_type in IMAGE_EXTENSIONS:
+            self.responses[response.url] = response
+
+    async def _original_image(self, src):
+        response = self.responses.get(src) if src else None
+        if response is None:
+            return None
+        content_type = response.headers.get("content-type", "").split(";")[0]
+        try:
+            return await response.body(), IMAGE_EXTENSIONS[content_type]
+        except Exception as e:
+            logger.debug(f"读取图片响应失败,url={src}: {e}")
+            return None
+
+    def _write(self, body, ext, base_path):
+        if self.encoder:
+            is_cover = os.path.basename(base_path).endswith("-001")
+            self.futures.append(self.encoder.submit(body, base_path, is_cover=is_cover))
+            return base_path + self.encoder.extension
+        with open(base_path + ext, "wb") as f:
+            f.write(body)
+        return base_path + ext
+
+    async def wait(self):
+        paths = [await asyncio.wrap_future(future) for future in self.futures]
+        self.futures = []
+        return paths
+
+    async def save(self, locator, base_path):
+        if self.enabled:
+            original = await self._original_image(await locator.evaluate(PAGE_IMAGE_SRC_JS))
+            if original:
+                return self._write(*original, base_path)
+        if self.encoder:
+            return self._write(await locator.screenshot(type="png"), ".png", base_path)
+        await locator.screenshot(path=base_path + ".jpg", type="jpeg", quality=SCREENSHOT_QUALITY)
+        return base_path + ".jpg"
+
+    async def save_all(self, comic_dir, id):
+        if not self.enabled:
+            return False
+        pages = self.page.locator("storybook-page")
+        srcs = [await pages.nth(i).evaluate(PAGE_IMAGE_SRC_JS) for i in range(await pages.count())]
+        originals = [await self._original_image(src) for src in srcs]
+        if len(originals) < 2 or not all(originals):
+            return False
+        for page_num, (body, ext) in enumerate(originals, start=1):
+            self._write(body, ext, os.path.join(comic_dir, f"{id:0>4}-{page_num:03}"))
+        logger.debug(f"不翻页直接保存了{len(originals)}页原图,id={id}")
+        return True
+
+
+async def crawl_new_tab(context, href_storybook, id):
+    """
+    This function crawls a new tab and takes screenshots of each page.
+
+    Args:
+        context (Playwright Context): The Playwright context object.
+        href_storybook (str): The URL of the storybook to be crawled.
+        id (int): The ID of the storybook.
+
+    Returns:
+        bool: True if the crawling is successful.
+    """
+    logger.debug(f"开始访问会本页面,href={href_storybook},id={id}")
+    id = str(id)
+    new_tab = await context.new_page()
+    detector = Page_ready_detector(new_tab)
+    capturer = Page_image_capturer(new_tab, encoder=image_pipeline.get_encoder())
+    await new_tab.goto(href_storybook)
+
+    next_page_button = new_tab.locator(
+        "button[aria-label='Next page'][data-test-id='next-page-button']"
+    )
+    await expect(next_page_button).to_be_visible(timeout=WAIT_TIME)
+
+    comic_dir = os.path.join(NOTDONE_PATH, f"{id:0>4}")
+    os.makedirs(comic_dir, exist_ok=True)
+
+    current_page = 1
+    while 1:
+        # 1:{1},2:{2,3},3:{4,5},
+        ready = await detector.wait()
+        if not ready:
+            logger.debug(f"第{current_page}页在{detector.timeout}ms内没有就绪，改用固定等待。")
+            await sleep_random(20 if current_page == 1 else 4)
+        if current_page == 1 and await capturer.save_all(comic_dir, id):
+            break
+        if current_page != 1:
+            storybook_content = new_tab.locator("storybook-page[class='left']").nth(-1)
+            left_page_num = current_page * 2 - 2
+            await capturer.save(
+                storybook_content, os.path.join(comic_dir, f"{id:0>4}-{left_page_num:03}")
+            )
+
+        if not ready:
+            await asyncio.sleep(1)
+        storybook_content = new_tab.locator("storybook-page[class='right']").nth(-1)
+        right_page_num = current_page * 2 - 1
+        screenshot_path = await capturer.save(
+            storybook_content, os.path.join(comic_dir, f"{id:0>4}-{right_page_num:03}")
+        )
+        logger.debug(f"操作成功！截图{screenshot_path}已保存。")
+        current_page += 1
+        if await next_page_button.is_disabled():
+            break
+        await detector.reset()
+        await next_page_button.click()
+    await new_tab.close()
+    await capturer.wait()
+    return True
+
+
+async def upload_file(
+    file_path,
+    page,
+    selector1='div[class~="file-uploader"]',
+    selector2='button[data-test-id="local-image-file-uploader-button"]',
+):
+    # 确保文件存在
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"文件不存在: {file_path}")
+
+    element = page.locator(selector1)
+    await expect(element).to_be_visible(timeout=WAIT_TIME)
+    await element.click()
+    async with page.expect_file_chooser() as fc_info:
+        element = page.locator(selector2)
+        await expect(element).to_be_visible(timeout=WAIT_TIME)
+        await element.click()
+    file_chooser = await fc_info.value
+    await file_chooser.set_files(file_path)
+    await sleep_random(7)
+
+
+async def generate_in_page(context, target_page, prompt, id=1, pic=None):
+    """
+    generate_storybooks.generate_in_page 的异步版本。
+
+    Returns:
+        bool: True if the crawling is successful.
+    """
+    close_panel_button = target_page.locator(
+        "button[aria-label='Close panel'][mattooltip='Close']"
+    )
+    try:
+        await expect(close_panel_button).to_be_visible(timeout=WAIT_TIME)
+        await close_panel_button.click()
+    except Exception as e:
+        logger.error(e)
+        print(f"在 {WAIT_TIME}ms 内未发现关闭按钮，跳过点击操作。")
+
+    input_box = target_page.locator("rich-textarea p").first
+    await expect(input_box).to_be_visible(timeout=60)
+    for i in range(10):
+        await input_box.clear()
+
+    prompt = f"""不要让我补充内容，按我给的提示词和你自己的想法，为这个故事生成绘本。
+    如果我上传了图片，绘本风格就参照图片的风格。
+    提示词是:
+    {prompt}"""
+    await input_box.fill(prompt)
+
+    if pic:
+        await upload_file(file_path=pic, page=target_page)
+
+    await asyncio.sleep(3)
+    await target_page.keyboard.press("Control+Enter")
+
+    share_button = target_page.locator("share-button")
+    logger.debug("正在等待share_button元素加载...")
+    await expect(share_button).to_be_visible(timeout=180 * 1000)
+    await sleep_random(15)
+    await share_button.click()
+
+    copy_link = target_page.locator('a[data-test-id="created-share-link"]')
+    await expect(copy_link).to_be_visible(timeout=WAIT_TIME)
+    href_storybook = await copy_link.get_attribute("href")
+
+    share_canvas = copy_link.locator("xpath=..").locator("xpath=..")
+    close_canvas_button = share_canvas.locator("button[mattooltip='Close']")
+    await expect(close_canvas_button).to_be_visible(timeout=WAIT_TIME)
+    await close_canvas_button.click()
+
+    return await crawl_new_tab(context, href_storybook, id)
+
+
+async def run(prompt, id=1, pic=None):
+    async with async_playwright() as playwright:
+        browser, context, target_page = await get_browser_with_retry(playwright)
+        try:
+            return await generate_in_page(context, target_page, prompt, id, pic)
+        except Exception as e:
+            logger.error(f"发生错误: {e}")
+        finally:
+            # 浏览器保持打开状态，以便下次还可以使用
+            logger.debug("脚本执行完毕。浏览器保持打开状态。")
+
+
+async def run_many(tasks, concurrency=STORYBOOK_TABS, on_done=None):
+    """
+    在一个事件循环里并发生成多个绘本，同时最多打开 concurrency 个标签页。
+
+    Args:
+        tasks (list): 任务列表，每个任务可以用 task["text"] / task["id"] / task["pic"] 取值。
+        concurrency (int): 同时处理的绘本数。
+        on_done (Callable[[int, bool], None]): 每完成一个任务调用一次，参数是任务 id 和结果。
+
+    Returns:
+        dict: 任务 id 到结果的映射。
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results = {}
+
+    async with async_playwright() as playwright:
+        browser, context, _ = await get_browser_with_retry(playwright)
+
+        async def run_task(task):
+            async with semaphore:
+                page = await context.new_page()
+                try:
+                    # 每个任务都在新的对话里生成
+                    await page.goto(STORYBOOK_URL)
+                    res = await generate_in_page(
+                        context, page, task["text"], task["id"], task["pic"]
+                    )
+                except Exception as e:
+                    logger.error(f"发生错误: {e}")
+                    res = False
+                finally:
+                    await page.close()
+            return task["id"], res
+
+        for future in asyncio.as_completed([run_task(task) for task in tasks]):
+            id, res = await future
+            results[id] = res
+            if on_done:
+                on_done(id, res)
+    return results
+
+
+def run_async(tasks, concurrency=STORYBOOK_TABS, on_done=None):
+    """同步代码里调用 run_many 的入口"""
+    return asyncio.run(run_many(tasks, concurrency, on_done))
+
+
+if __name__ == "__main__":
+    from task_manager import get_task_manager
+
+    tm = get_task_manager()
+    target_task = tm.read_target_tasks("generate_storybook")
+    print("target_task", target_task)
+
+    def on_done(id, res):
+        if res:
+            tm.mark(id, "generate_storybook", 1)
+        else:
+            logger.error(f"生成绘本失败,id={id}")
+
+    run_async([task for _, task in target_task.iterrows()], on_done=on_done)
+    tm.flush()
@@ -0,0 +1,119 @@
+"""
+绘本页面图片的编码流水线。
+浏览器线程只负责拿到截图(PNG)或原图的字节，JPEG/WebP 编码、缩放到网页显示尺寸、
+封面缩略图和写文件都交给进程池处理。文件先写临时文件再替换，
+cloudinary_util.main 上传时不会读到写了一半的图片。
+"""
+
+import os, threading
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from logger_config import get_logger
+
+load_dotenv()
+logger = get_logger(__name__)
+
+# 是否启用进程池编码 (1 启用)，不启用时按以前的方式直接截 JPEG
+ENCODE_IN_POOL = os.getenv("ENCODE_IN_POOL", "0") == "1"
+# 进程数，0 表示使用 CPU 核数
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "0"))
+# 输出格式: jpeg / webp
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg")
+IMAGE_QUALITY = int(os.getenv("SCREENSHOT_QUALITY", "85"))
+# 缩放到网页显示用的最大宽度，0 表示不缩放
+IMAGE_MAX_WIDTH = int(os.getenv("IMAGE_MAX_WIDTH", "0"))
+# 封面缩略图的保存目录和宽度，不设置目录时不生成缩略图
+# (不能放在 NOTDONE_PATH 的分组目录里，否则会被当成绘本页面上传)
+THUMB_PATH = os.getenv("THUMB_PATH")
+THUMB_WIDTH = int(os.getenv("THUMB_WIDTH", "320"))
+
+FORMAT_EXTENSIONS = {"jpeg": ".jpg", "webp": ".webp", "png": ".png"}
+
+
+def _save_atomic(image, path, fmt, quality):
+    tmp_path = f"{path}.tmp"
+    image.save(tmp_path, format=fmt.upper(), quality=quality, optimize=True)
+    os.replace(tmp_path, path)
+
+
+def encode_image(
+    data: bytes,
+    base_path: str,
+    fmt=IMAGE_FORMAT,
+    quality=IMAGE_QUALITY,
+    max_width=IMAGE_MAX_WIDTH,
+    thumb_path=None,
+    thumb_width=THUMB_WIDTH,
+):
+    """
+    在子进程中把图片字节编码后保存。
+
+    Args:
+        data (bytes): PNG 截图或原图的字节。
+        base_path (str): 不带扩展名的保存路径。
+        fmt (str): 输出格式 (jpeg / webp / png)。
+        quality (int): 编码质量。
+        max_width (int): 超过这个宽度时等比缩小，0 表示不缩放。
+        thumb_path (str): 缩略图的保存路径，None 表示不生成。
+        thumb_width (int): 缩略图宽度。
+
+    Returns:
+        str: 保存的文件路径。
+    """
+    from PIL import Image
+
+    image = Image.open(BytesIO(data))
+    if fmt == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if max_width and image.width > max_width:
+        image.thumbnail((max_width, image.height), Image.LANCZOS)
+
+    path = base_path + FORMAT_EXTENSIONS[fmt]
+    _save_atomic(image, path, fmt, quality)
+
+    if thumb_path:
+        thumb = image.copy()
+        thumb.thumbnail((thumb_width, thumb.height), Image.LANCZOS)
+        _save_atomic(thumb, thumb_path, fmt, quality)
+    return path
+
+
+class Image_encoder:
+    """
+    把图片编码提交到进程池。submit 立刻返回 Future，
+    浏览器线程不用等编码完成就可以继续翻页。
+    """
+
+    def __init__(self, workers=ENCODE_WORKERS, fmt=IMAGE_FORMAT):
+        self.executor = ProcessPoolExecutor(max_workers=workers or None)
+        self.fmt = fmt
+        self.extension = FORMAT_EXTENSIONS[fmt]
+
+    def submit(self, data: bytes, base_path: str, is_cover=False):
+        thumb_path = None
+        if is_cover and THUMB_PATH:
+            os.makedirs(THUMB_PATH, exist_ok=True)
+            thumb_path = os.path.join(THUMB_PATH, os.path.basename(base_path) + self.extension)
+        return self.executor.submit(
+            encode_image, data, base_path, fmt=self.fmt, thumb_path=thumb_path
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def get_encoder():
+    """返回进程内共用的 Image_encoder，ENCODE_IN_POOL 没有启用时返回 None"""
+    global _encoder
+    if not ENCODE_IN_POOL:
+        return None
+    with _encoder_lock:
+        if _encoder is None:
+            _encoder = Image_encoder()
+            logger.debug(f"图片编码进程池已启动,format={IMAGE_FORMAT}")
+        return _encoder
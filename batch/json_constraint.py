@@ -0,0 +1,344 @@
+"""
+按 JSON schema 约束本地模型的输出。
+生成的每一步只保留能让输出仍然是合法 JSON 前缀的 token，顶层对象闭合后立刻停止生成，
+不会再出现 ```json 之类的多余内容，也不会因为格式错误浪费整次生成。
+
+只支持 schema 的一个子集: type (object / array / string / number / integer / boolean / null)、
+properties、required、items、minItems、maxItems、字符串的 enum。
+定义了 properties 的对象不允许出现其他键，没有定义 properties 的对象允许任意键值。
+"""
+
+import os
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 每一步先检查分数最高的多少个候选 token，都不合法时再扩大范围
+JSON_CONSTRAINT_TOP_K = int(os.getenv("JSON_CONSTRAINT_TOP_K", "16"))
+# 最多检查的候选 token 数，超过后只允许结束生成
+JSON_CONSTRAINT_MAX_K = int(os.getenv("JSON_CONSTRAINT_MAX_K", "1024"))
+
+STORIES_SCHEMA = {
+    "type": "object",
+    "properties": {"stories": {"type": "array", "items": {"type": "string"}}},
+    "required": ["stories"],
+}
+
+TOOL_CALLS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "tool_calls": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"name": {"type": "string"}, "args": {"type": "object"}},
+                "required": ["name", "args"],
+            },
+        }
+    },
+    "required": ["tool_calls"],
+}
+
+
+def stories_schema(number_of_stories):
+    """要求正好 number_of_stories 个故事的 STORIES_SCHEMA"""
+    items = {"type": "array", "items": {"type": "string"}, "minItems": number_of_stories, "maxItems": number_of_stories}
+    return {**STORIES_SCHEMA, "properties": {"stories": items}}
+
+
+def tool_calls_schema(tool_names):
+    """工具名只能是 tool_names 中的某一个的 TOOL_CALLS_SCHEMA，tool_names 为空时不限制"""
+    if not tool_names:
+        return TOOL_CALLS_SCHEMA
+    call = {
+        "type": "object",
+        "properties": {"name": {"type": "string", "enum": list(tool_names)}, "args": {"type": "object"}},
+        "required": ["name", "args"],
+    }
+    return {**TOOL_CALLS_SCHEMA, "properties": {"tool_calls": {"type": "array", "items": call}}}
+
+
+WHITESPACE = " \t\n\r"
+NUMBER_CHARS = "0123456789+-.eE"
+ESCAPE_CHARS = '"\\/bfnrt'
+HEX_CHARS = "0123456789abcdefABCDEF"
+VALUE_TYPES = {
+    "{": ("object",),
+    "[": ("array",),
+    '"': ("string",),
+    "t": ("boolean",),
+    "f": ("boolean",),
+    "n": ("null",),
+    "-": ("number", "integer"),
+}
+LITERALS = {"t": "rue", "f": "alse", "n": "ull"}
+
+# 解析状态是不可变的元组栈，尝试候选 token 时不需要复制。栈里的帧:
+#   ("value", schema)                           等待一个值
+#   ("obj", schema, phase, seen_keys, key)      phase: first / key / colon / value / after / next
+#   ("arr", schema, phase, count)               phase: first / value / after
+#   ("str", schema, escape, text)               escape: 0 普通, -1 反斜杠之后, 1~4 剩余的十六进制位数
+#   ("lit", remaining)                          true / false / null 剩下的字符
+#   ("num", text)
+#   ("done",)                                   顶层值已经结束
+
+
+def _allows(schema, ch):
+    expected = schema.get("type")
+    if expected is None:
+        return ch in VALUE_TYPES or ch.isdigit()
+    types = VALUE_TYPES.get(ch, ("number", "integer") if ch.isdigit() else ())
+    if ch == "." or (expected == "integer" and ch in ".eE"):
+        return False
+    return expected in types
+
+
+def _closed(schema):
+    return "properties" in schema
+
+
+def _can_close_object(frame):
+    return set(frame[1].get("required", ())) <= frame[3]
+
+
+def _remaining_keys(frame):
+    return [k for k in frame[1]["properties"] if k not in frame[3]]
+
+
+def _value_done(stack):
+    if not stack:
+        return (("done",),)
+    parent = stack[-1]
+    if parent[0] == "obj":
+        return stack[:-1] + ((parent[0], parent[1], "after", parent[3], ""),)
+    return stack[:-1] + (("arr", parent[1], "after", parent[3] + 1),)
+
+
+def _start_value(stack, schema, ch):
+    if ch in WHITESPACE:
+        return stack + (("value", schema),)
+    if not _allows(schema, ch):
+        return None
+    if ch == "{":
+        return stack + (("obj", schema, "first", frozenset(), ""),)
+    if ch == "[":
+        return stack + (("arr", schema, "first", 0),)
+    if ch == '"':
+        return stack + (("str", schema, 0, ""),)
+    if ch in LITERALS:
+        return stack + (("lit", LITERALS[ch]),)
+    return stack + (("num", ch),)
+
+
+def step(stack, ch):
+    """输入一个字符，返回新的解析状态，不合法时返回 None"""
+    frame = stack[-1]
+    rest = stack[:-1]
+    kind = frame[0]
+
+    if kind == "value":
+        return _start_value(rest, frame[1], ch)
+
+    if kind == "done":
+        return stack if ch in WHITESPACE else None
+
+    if kind == "lit":
+        if ch != frame[1][0]:
+            return None
+        return _value_done(rest) if len(frame[1]) == 1 else rest + (("lit", frame[1][1:]),)
+
+    if kind == "num":
+        if ch in NUMBER_CHARS:
+            return rest + (("num", frame[1] + ch),)
+        try:
+            float(frame[1])
+        except ValueError:
+            return None
+        # 数字没有结束符，遇到其他字符时数字结束，这个字符交给上一层处理
+        return step(_value_done(rest), ch)
+
+    if kind == "str":
+        schema, escape, text = frame[1], frame[2], frame[3]
+        enum = schema.get("enum")
+        if escape == -1:
+            if ch == "u":
+                return rest + (("str", schema, 4, text),)
+            return rest + (("str", schema, 0, text),) if ch in ESCAPE_CHARS else None
+        if escape > 0:
+            return rest + (("str", schema, escape - 1, text),) if ch in HEX_CHARS else None
+        if ch == '"':
+            if enum is not None and text not in enum:
+                return None
+            return _value_done(rest)
+        if ch == "\\":
+            return None if enum is not None else rest + (("str", schema, -1, text),)
+        if ord(ch) < 0x20:
+            return None
+        if enum is None:
+            return stack
+        text += ch
+        if not any(value.startswith(text) for value in enum):
+            return None
+        return rest + (("str", schema, 0, text),)
+
+    if kind == "obj":
+        schema, phase, seen, key = frame[1], frame[2], frame[3], frame[4]
+        if phase == "key":
+            if ch == '"':
+                if _closed(schema) and key not in _remaining_keys(frame):
+                    return None
+                return rest + (("obj", schema, "colon", seen | {key}, key),)
+            if ch == "\\" or ord(ch) < 0x20:
+                return None
+            key += ch
+            if _closed(schema) and not any(k.startswith(key) for k in _remaining_keys(frame)):
+                return None
+            return rest + (("obj", schema, "key", seen, key),)
+        if ch in WHITESPACE:
+            return stack
+        if phase in ("first", "next") and ch == '"':
+            if _closed(schema) and not _remaining_keys(frame):
+                return None
+            return rest + (("obj", schema, "key", seen, ""),)
+        if phase in ("first", "after") and ch == "}":
+            return _value_done(rest) if _can_close_object(frame) else None
+        if phase == "colon" and ch == ":":
+            child = schema.get("properties", {}).get(key, {})
+            return rest + (("obj", schema, "value", seen, key), ("value", child))
+        if phase == "after" and ch == ",":
+            if _closed(schema) and not _remaining_keys(frame):
+                return None
+            return rest + (("obj", schema, "next", seen, ""),)
+        return None
+
+    if kind == "arr":
+        schema, phase, count = frame[1], frame[2], frame[3]
+        if ch in WHITESPACE:
+            return stack
+        if phase in ("first", "after") and ch == "]":
+            return _value_done(rest) if count >= schema.get("minItems", 0) else None
+        if phase == "after" and ch == ",":
+            if count >= schema.get("maxItems", count + 1):
+                return None
+            return rest + (("arr", schema, "value", count),)
+        if phase in ("first", "value"):
+            if count >= schema.get("maxItems", count + 1):
+                return None
+            return _start_value(rest + (("arr", schema, "value", count),), schema.get("items", {}), ch)
+        return None
+
+    return None
+
+
+class Json_prefix_validator:
+    """逐段输入文本，判断到目前为止的输出是不是符合 schema 的 JSON 的前缀"""
+
+    def __init__(self, schema):
+        self.stack = (("value", schema),)
+
+    def advance(self, text, stack=None):
+        """返回输入 text 之后的状态，不合法时返回 None，不修改当前状态"""
+        stack = self.stack if stack is None else stack
+        for ch in text:
+            stack = step(stack, ch)
+            if stack is None:
+                return None
+        return stack
+
+    def feed(self, text):
+        stack = self.advance(text)
+        if stack is None:
+            return False
+        self.stack = stack
+        return True
+
+    @property
+    def complete(self):
+        return self.stack[-1][0] == "done"
+
+
+class Json_schema_logits_processor(LogitsProcessor):
+    """
+    把不能让输出保持为合法 JSON 前缀的 token 的分数设为 -inf。
+    只检查分数最高的一部分候选 token，所以每一步的开销和词表大小无关。
+    """
+
+    def __init__(self, tokenizer, schema, prompt_length, top_k=JSON_CONSTRAINT_TOP_K, max_k=JSON_CONSTRAINT_MAX_K):
+        self.tokenizer = tokenizer
+        self.schema = schema
+        self.prompt_length = prompt_length
+        self.top_k = top_k
+        self.max_k = max_k
+        self.validators = []
+        self.consumed = []
+        self.token_texts = {}
+        eos = tokenizer.eos_token_id
+        self.eos_ids = [eos] if eos is not None else []
+
+    def _text(self, token_id):
+        if token_id not in self.token_texts:
+            self.token_texts[token_id] = self.tokenizer.decode([token_id], skip_special_tokens=True)
+        return self.token_texts[token_id]
+
+    def sync(self, input_ids):
+        """把上一步生成的 token 输入到每一行的 validator"""
+        if not self.validators:
+            self.validators = [Json_prefix_validator(self.schema) for _ in range(input_ids.shape[0])]
+            self.consumed = [self.prompt_length] * input_ids.shape[0]
+        for row, validator in enumerate(self.validators):
+            for token_id in input_ids[row, self.consumed[row] :].tolist():
+                if not validator.complete and token_id not in self.eos_ids:
+                    validator.feed(self._text(token_id))
+            self.consumed[row] = input_ids.shape[-1]
+
+    def _allowed(self, validator, scores):
+        if validator.complete:
+            return self.eos_ids
+        k, checked = self.top_k, 0
+        while True:
+            candidates = torch.topk(scores, min(k, scores.shape[-1])).indices.tolist()
+            allowed = []
+            for token_id in candidates[checked:]:
+                text = self._text(token_id)
+                if text and validator.advance(text) is not None:
+                    allowed.append(token_id)
+            checked = len(candidates)
+            if allowed:
+                return allowed
+            if k >= self.max_k or checked >= scores.shape[-1]:
+                return self.eos_ids
+            k *= 8
+
+    def __call__(self, input_ids, scores):
+        self.sync(input_ids)
+        masked = torch.full_like(scores, float("-inf"))
+        for row, validator in enumerate(self.validators):
+            allowed = torch.tensor(self._allowed(validator, scores[row]), device=scores.device, dtype=torch.long)
+            values = scores[row, allowed]
+            # 候选都已经被 top-k / top-p 排除时，按均匀分布在合法 token 中选择
+            if torch.isinf(values).all():
+                values = torch.zeros_like(values)
+            masked[row, allowed] = values
+        return masked
+
+
+class Json_complete_criteria(StoppingCriteria):
+    """顶层 JSON 值闭合后立刻停止生成"""
+
+    def __init__(self, processor: Json_schema_logits_processor):
+        self.processor = processor
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.processor.sync(input_ids)
+        return torch.tensor([v.complete for v in self.processor.validators], device=input_ids.device)
+
+
+def constraint_kwargs(tokenizer, schema, prompt_length):
+    """返回传给 model.generate 的 logits_processor 和 stopping_criteria"""
+    processor = Json_schema_logits_processor(tokenizer, schema, prompt_length)
+    return {
+        "logits_processor": LogitsProcessorList([processor]),
+        "stopping_criteria": StoppingCriteriaList([Json_complete_criteria(processor)]),
+    }
@@ -0,0 +1,122 @@
+"""
+LLM 流式输出的增量 JSON 解析。
+逐段输入文本，顶层对象里某个数组 (例如 "stories"、"tool_calls") 的元素一闭合就返回，
+不用等整个回复生成完；回复被截断时，已经闭合的元素也不会丢失。
+"""
+
+import re
+import json
+
+WHITESPACE = " \t\n\r"
+
+
+class Json_array_stream:
+    """
+    从流式文本中取出 "key": [...] 数组的元素。
+
+    用法:
+        stream = Json_array_stream("stories")
+        for chunk in chunks:
+            for story in stream.feed(chunk):
+                ...
+    """
+
+    def __init__(self, key):
+        self.pattern = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+        self.text = ""
+        # 数组开始之后的扫描位置，None 表示还没有找到数组
+        self.pos = None
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.element_start = None
+        self.found = False
+        self.done = False
+        self.elements = []
+
+    def feed(self, chunk):
+        """
+        输入一段文本。
+
+        Returns:
+            list: 这段文本中新闭合的数组元素 (已经 json.loads 过)。
+        """
+        self.text += chunk
+        if self.done:
+            return []
+        if self.pos is None:
+            match = self.pattern.search(self.text)
+            if not match:
+                return []
+            self.found = True
+            self.pos = match.end()
+
+        new_elements = []
+        text = self.text
+        while self.pos < len(text) and not self.done:
+            ch = text[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.depth == 0:
+                        self._close(self.pos + 1, new_elements)
+            elif self.element_start is None:
+                # 元素之间: 跳过空白和逗号，遇到 ] 表示数组结束
+                if ch == "]":
+                    self.done = True
+                elif ch not in WHITESPACE and ch != ",":
+                    self.element_start = self.pos
+                    self._open(ch)
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                if self.depth == 0:
+                    # 数字等没有结束符的元素遇到数组结尾
+                    self._close(self.pos, new_elements)
+                    self.done = True
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        self._close(self.pos + 1, new_elements)
+            elif ch == "," and self.depth == 0:
+                self._close(self.pos, new_elements)
+            self.pos += 1
+        return new_elements
+
+    def _open(self, ch):
+        if ch == '"':
+            self.in_string = True
+        elif ch in "{[":
+            self.depth = 1
+
+    def _close(self, end, new_elements):
+        raw = self.text[self.element_start : end].strip()
+        self.element_start = None
+        self.depth = 0
+        if not raw:
+            return
+        try:
+            element = json.loads(raw)
+        except json.JSONDecodeError:
+            # 格式错误的元素跳过，不影响后面的元素
+            return
+        self.elements.append(element)
+        new_elements.append(element)
+
+
+def parse_array(text, key):
+    """
+    从完整或被截断的文本中取出 "key": [...] 数组里所有已经闭合的元素。
+
+    Returns:
+        list: 闭合的元素，没有找到数组时返回空列表。
+    """
+    stream = Json_array_stream(key)
+    stream.feed(text)
+    return stream.elements
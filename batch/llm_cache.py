@@ -0,0 +1,217 @@
+"""
+LLM 回复的磁盘缓存。
+按 模型 + 规范化后的对话 + 生成参数 计算 key，把回复保存在 SQLite 里，
+工作流重试或重新运行时，相同的 prompt 直接返回上次的结果，不再调用 LLM。
+超过 LLM_CACHE_MAX_ENTRIES 条时淘汰最久没有用到的记录，超过 LLM_CACHE_TTL 秒的记录视为过期。
+
+用法:
+    generation_func = llm_cache.cached(llm.invoke_query_format1, model=llm.llm_name)
+    generation_func = llm_cache.cached(get_llm().invoke, model="gemini-2.5-flash", temperature=0)
+"""
+
+import os, re, json, time, hashlib, sqlite3, functools, inspect
+from contextlib import closing
+from typing import Callable
+from dotenv import load_dotenv
+from logger_config import get_logger
+
+load_dotenv()
+logger = get_logger(__name__)
+
+# 是否启用缓存 (1 启用)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") == "1"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "asset/llm_cache.db")
+# 最多保存的回复数
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+# 回复的有效期(秒)，0 表示不过期
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 86400)))
+
+
+def normalize_messages(messages) -> list[dict]:
+    """
+    把字符串、dict 列表、LangChain 消息列表统一成 [{"role": ..., "content": ...}]，
+    并去掉每行首尾的空白，缩进不同的同一个 prompt 会得到同一个 key。
+    """
+    if isinstance(messages, str):
+        messages = [{"role": "user", "content": messages}]
+    normalized = []
+    for message in messages:
+        if isinstance(message, dict):
+            role, content = message.get("role"), message.get("content")
+        else:
+            role, content = getattr(message, "type", None), getattr(message, "content", None)
+        if isinstance(content, str):
+            content = "\n".join(line.strip() for line in content.strip().splitlines())
+            content = re.sub(r"\n{3,}", "\n\n", content)
+        normalized.append({"role": role, "content": content})
+    return normalized
+
+
+def make_key(model: str, messages, **params) -> str:
+    payload = {"model": model, "messages": normalize_messages(messages), "params": params}
+    data = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _dump_response(response) -> str:
+    # 回复可能是字符串、AIMessage 或 pipeline 返回的列表
+    if isinstance(response, str):
+        return json.dumps({"type": "str", "value": response}, ensure_ascii=False)
+    if hasattr(response, "content") and hasattr(response, "type"):
+        return json.dumps({"type": "ai_message", "value": response.content}, ensure_ascii=False)
+    return json.dumps({"type": "json", "value": response}, ensure_ascii=False)
+
+
+def _load_response(data: str):
+    record = json.loads(data)
+    if record["type"] == "ai_message":
+        from langchain_core.messages import AIMessage
+
+        return AIMessage(content=record["value"])
+    return record["value"]
+
+
+class Llm_response_cache:
+    TABLE_NAME = "responses"
+
+    def __init__(self, db_path=LLM_CACHE_PATH, max_entries=LLM_CACHE_MAX_ENTRIES, ttl=LLM_CACHE_TTL):
+        self.DB_PATH = db_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(self.DB_PATH) or ".", exist_ok=True)
+        self._init_db()
+
+    def _connect(self):
+        return sqlite3.connect(self.DB_PATH, timeout=30)
+
+    def _init_db(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.TABLE_NAME} ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL, last_used REAL)"
+            )
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{self.TABLE_NAME}_last_used "
+                f"ON {self.TABLE_NAME} (last_used)"
+            )
+
+    def get(self, key: str):
+        """返回缓存的回复，没有或已过期时返回 None"""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                f"SELECT response, created_at FROM {self.TABLE_NAME} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                conn.execute(f"DELETE FROM {self.TABLE_NAME} WHERE key = ?", (key,))
+                return None
+            conn.execute(f"UPDATE {self.TABLE_NAME} SET last_used = ? WHERE key = ?", (now, key))
+        return _load_response(row[0])
+
+    def put(self, key: str, model: str, response):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.TABLE_NAME} (key, model, response, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, model, _dump_response(response), now, now),
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        if self.ttl:
+            conn.execute(f"DELETE FROM {self.TABLE_NAME} WHERE created_at < ?", (now - self.ttl,))
+        count = conn.execute(f"SELECT COUNT(*) FROM {self.TABLE_NAME}").fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                f"DELETE FROM {self.TABLE_NAME} WHERE key IN ("
+                f"SELECT key FROM {self.TABLE_NAME} ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def clear(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"DELETE FROM {self.TABLE_NAME}")
+
+
+_cache = None
+
+
+def get_cache():
+    """返回进程内共用的 Llm_response_cache"""
+    global _cache
+    if _cache is None:
+        _cache = Llm_response_cache()
+    return _cache
+
+
+def cached(
+    generation_func: Callable,
+    model: str,
+    cache: Llm_response_cache = None,
+    validate: Callable = None,
+    **params,
+) -> Callable:
+    """
+    给任意 generation_func 加上缓存，返回参数相同的新函数。
+
+    Args:
+        generation_func (Callable): 接受 prompt (字符串或消息列表) 的生成函数，也可以是 async 函数。
+        model (str): 模型名，不同模型的回复分开缓存。
+        cache (Llm_response_cache): 使用的缓存，默认是 get_cache()。
+        validate (Callable): 只有 validate(response) 为 True 时才写入缓存，
+            避免格式错误的回复在重试时被反复使用。
+        **params: 影响结果的生成参数，例如 temperature，会加入 key。
+
+    Returns:
+        Callable: 带缓存的生成函数。LLM_CACHE 没有启用时返回 generation_func 本身。
+    """
+    if not LLM_CACHE_ENABLED:
+        return generation_func
+    # functools.partial 固定的参数 (例如 json_schema) 也会影响结果
+    name = getattr(generation_func, "__qualname__", None) or getattr(
+        getattr(generation_func, "func", None), "__qualname__", repr(generation_func)
+    )
+    fixed = getattr(generation_func, "keywords", None) or {}
+
+    def lookup(prompt, args, kwargs):
+        response_cache = cache or get_cache()
+        key = make_key(model, prompt, func=name, args=args, fixed=fixed, kwargs=kwargs, **params)
+        response = response_cache.get(key)
+        if response is not None:
+            logger.info(f"LLM 缓存命中: {model} {key[:12]}")
+        return response_cache, key, response
+
+    def store(response_cache, key, response):
+        if validate is None or validate(response):
+            response_cache.put(key, model, response)
+        return response
+
+    if is_async(generation_func):
+
+        @functools.wraps(generation_func)
+        async def async_wrapper(prompt, *args, **kwargs):
+            response_cache, key, response = lookup(prompt, args, kwargs)
+            if response is not None:
+                return response
+            return store(response_cache, key, await generation_func(prompt, *args, **kwargs))
+
+        return async_wrapper
+
+    @functools.wraps(generation_func)
+    def wrapper(prompt, *args, **kwargs):
+        response_cache, key, response = lookup(prompt, args, kwargs)
+        if response is not None:
+            return response
+        return store(response_cache, key, generation_func(prompt, *args, **kwargs))
+
+    return wrapper
+
+
+def is_async(func) -> bool:
+    """func (或 functools.partial 包装的函数) 是不是 async 函数"""
+    while isinstance(func, functools.partial):
+        func = func.func
+    return inspect.iscoroutinefunction(func)
@@ -0,0 +1,451 @@
+"""
+本地 gemma 模型的推理服务。
+多个 agent 进程共用同一个模型和同一组 CPU 核，请求按 continuous batching 调度：
+每个 decode step 之间都可以把新请求加入正在生成的批次，生成结束的请求立刻从批次中移除，
+不用等整批都生成完。stream=true 的请求每生成一个 token 就把新增的文本发给客户端。
+
+启动:
+    python local_llm_server.py
+接口:
+    POST /v1/chat/completions  (OpenAI 格式，ChatOpenAI(base_url="http://127.0.0.1:11435/v1"))
+    POST /api/chat             (Ollama 格式，ChatOllama(base_url="http://127.0.0.1:11435"))
+    GET  /v1/models, /api/tags
+设置 LOCAL_LLM_SERVER_URL 后，Local_llm / CustomLLM 也会通过 model_registry 调用这个服务。
+"""
+
+import os, json, time, queue, threading, uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import torch
+from dotenv import load_dotenv
+from local_llm_util import Local_llm
+from logger_config import get_logger
+
+load_dotenv()
+logger = get_logger(__name__)
+
+LLM_SERVER_HOST = os.getenv("LLM_SERVER_HOST", "127.0.0.1")
+LLM_SERVER_PORT = int(os.getenv("LLM_SERVER_PORT", "11435"))
+# 服务加载的模型
+LLM_SERVER_MODEL = os.getenv("LLM_SERVER_MODEL", "google/gemma-3-1b-it")
+# 同时生成的最大请求数
+LLM_SERVER_MAX_BATCH = int(os.getenv("LLM_SERVER_MAX_BATCH", "8"))
+# 请求没有指定时每条最多生成的 token 数
+LLM_SERVER_MAX_TOKENS = int(os.getenv("LLM_SERVER_MAX_TOKENS", "1024"))
+
+
+class Generation_request:
+    def __init__(self, prompt_ids, max_new_tokens, temperature, stream=False):
+        self.prompt_ids = list(prompt_ids)
+        self.generated = []
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.stream = stream
+        self.finish_reason = None
+        self.text = None
+        self.error = None
+        self.done = threading.Event()
+        # 流式请求每一步新增的文本，None 表示生成结束
+        self.chunks = queue.Queue()
+        self._sent = ""
+
+    @property
+    def finished(self):
+        return self.finish_reason is not None
+
+    def _put_text(self, text):
+        if text.startswith(self._sent) and len(text) > len(self._sent):
+            self.chunks.put(text[len(self._sent) :])
+            self._sent = text
+
+    def push(self, tokenizer):
+        """流式请求: 把新生成的 token 对应的文本放进 chunks"""
+        if not self.stream:
+            return
+        text = tokenizer.decode(self.generated, skip_special_tokens=True)
+        # 多字节字符还没有生成完整时先不发送
+        if not text.endswith("\ufffd"):
+            self._put_text(text)
+
+    def close(self, text=None, error=None):
+        self.text = text
+        self.error = error
+        if self.stream and text:
+            self._put_text(text)
+        self.chunks.put(None)
+        self.done.set()
+
+
+def _left_pad(tensor, width, dim):
+    # 在 dim 维左侧补 0 到 width
+    pad = [0, 0] * (tensor.dim() - 1 - dim % tensor.dim()) + [width - tensor.shape[dim], 0]
+    return torch.nn.functional.pad(tensor, pad)
+
+
+class Continuous_batcher:
+    """
+    在一个调度线程里驱动模型，其他线程通过 submit / generate 提交请求。
+
+    新请求只对它自己的 prompt 做 prefill，得到的 KV cache 左侧补齐后和正在生成的批次的 cache 拼接，
+    已经在生成的序列不需要重新计算；之后每步只输入每个序列上一步生成的 token。
+    生成结束的序列通过 cache.batch_select_indices 从 KV cache 中删除。
+
+    滑动窗口等不能拼接、删除行的 cache (例如 gemma3 的 sliding window 层) 退回到按批次调度：
+    只在批次全部结束后才加入新请求，已经结束的序列留在批次里继续计算，结果丢弃。
+    """
+
+    def __init__(self, llm: Local_llm, max_batch=LLM_SERVER_MAX_BATCH):
+        self.model = llm.model
+        self.tokenizer = llm.tokenizer
+        self.model.eval()
+        self.max_batch = max_batch
+
+        eos = self.model.generation_config.eos_token_id
+        self.eos_ids = set(eos if isinstance(eos, list) else [eos])
+        self.eos_ids.add(self.tokenizer.eos_token_id)
+        self.eos_ids.discard(None)
+        self.pad_id = self.tokenizer.pad_token_id
+        if self.pad_id is None:
+            self.pad_id = self.tokenizer.eos_token_id
+
+        self.pending = queue.Queue()
+        self.active = []
+        self.cache = None
+        self.mask = None
+        # 第一次 prefill 后按 cache 的类型确定是否支持拼接和删除行
+        self.mergeable = None
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, messages, max_new_tokens=LLM_SERVER_MAX_TOKENS, temperature=0.0, stream=False):
+        prompt_ids = self.tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True, tokenize=True
+        )
+        request = Generation_request(prompt_ids, max_new_tokens, temperature, stream)
+        self.pending.put(request)
+        return request
+
+    def generate(self, messages, max_new_tokens=LLM_SERVER_MAX_TOKENS, temperature=0.0):
+        request = self.submit(messages, max_new_tokens, temperature)
+        request.done.wait()
+        if request.error:
+            raise request.error
+        return request
+
+    def _admit(self):
+        admitted = []
+        if self.active and self.mergeable is False:
+            # 不能拼接 cache 时等当前批次结束
+            return admitted
+        while len(self.active) + len(admitted) < self.max_batch:
+            # 没有正在生成的请求时阻塞等待，否则只取已经到达的请求
+            block = not self.active and not admitted
+            try:
+                admitted.append(self.pending.get(block=block))
+            except queue.Empty:
+                break
+        return admitted
+
+    def _loop(self):
+        while True:
+            admitted = self._admit()
+            try:
+                with torch.inference_mode():
+                    if admitted:
+                        self._prefill(admitted)
+                    else:
+                        self._decode()
+            except Exception as e:
+                logger.error(f"生成失败: {e}")
+                for request in self.active + admitted:
+                    if not request.done.is_set():
+                        request.close(error=e)
+                self.active = []
+                self.cache = None
+                self.mask = None
+
+    @staticmethod
+    def _can_merge(cache):
+        from transformers import DynamicCache
+
+        if not isinstance(cache, DynamicCache) or not hasattr(cache, "batch_select_indices"):
+            return False
+        return not any(getattr(cache, "is_sliding", None) or [])
+
+    def _merge(self, cache, mask):
+        """把新请求的 cache 和 mask 左侧补齐后拼接到当前批次后面"""
+        from transformers import DynamicCache
+
+        width = max(self.mask.shape[1], mask.shape[1])
+        layers = tuple(
+            (
+                torch.cat([_left_pad(k1, width, -2), _left_pad(k2, width, -2)]),
+                torch.cat([_left_pad(v1, width, -2), _left_pad(v2, width, -2)]),
+            )
+            for (k1, v1), (k2, v2) in zip(self.cache.to_legacy_cache(), cache.to_legacy_cache())
+        )
+        self.cache = DynamicCache.from_legacy_cache(layers)
+        self.mask = torch.cat([_left_pad(self.mask, width, -1), _left_pad(mask, width, -1)])
+
+    def _prefill(self, requests):
+        sequences = [r.prompt_ids for r in requests]
+        width = max(len(ids) for ids in sequences)
+        input_ids = torch.tensor(
+            [[self.pad_id] * (width - len(ids)) + ids for ids in sequences],
+            device=self.model.device,
+        )
+        mask = torch.tensor(
+            [[0] * (width - len(ids)) + [1] * len(ids) for ids in sequences],
+            device=self.model.device,
+        )
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            cache_position=torch.arange(width, device=self.model.device),
+            use_cache=True,
+        )
+        if self.mergeable is None:
+            self.mergeable = self._can_merge(outputs.past_key_values)
+            if not self.mergeable:
+                logger.warning(
+                    f"{type(outputs.past_key_values).__name__} 不支持拼接和删除行，新请求只在批次之间加入"
+                )
+        if self.active:
+            self._merge(outputs.past_key_values, mask)
+        else:
+            self.cache = outputs.past_key_values
+            self.mask = mask
+        self.active.extend(requests)
+        for request, row in zip(requests, outputs.logits[:, -1, :]):
+            self._sample(request, row)
+        self._retire()
+
+    def _decode(self):
+        input_ids = torch.tensor(
+            [[r.generated[-1]] for r in self.active], device=self.model.device
+        )
+        past_length = self.mask.shape[1]
+        self.mask = torch.cat([self.mask, self.mask.new_ones((len(self.active), 1))], dim=-1)
+        position_ids = self.mask.sum(-1, keepdim=True) - 1
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=self.mask,
+            position_ids=position_ids,
+            cache_position=torch.tensor([past_length], device=self.model.device),
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        self.cache = outputs.past_key_values
+        for request, row in zip(self.active, outputs.logits[:, -1, :]):
+            # 留在批次里的已结束序列，结果丢弃
+            if not request.finished:
+                self._sample(request, row)
+        self._retire()
+
+    def _sample(self, request, row):
+        if request.temperature and request.temperature > 0:
+            probs = torch.softmax(row.float() / request.temperature, dim=-1)
+            token = int(torch.multinomial(probs, 1))
+        else:
+            token = int(row.argmax())
+        request.generated.append(token)
+        if token in self.eos_ids:
+            request.finish_reason = "stop"
+        elif len(request.generated) >= request.max_new_tokens:
+            request.finish_reason = "length"
+        request.push(self.tokenizer)
+
+    def _retire(self):
+        for request in self.active:
+            if request.finished and not request.done.is_set():
+                request.close(text=self.tokenizer.decode(request.generated, skip_special_tokens=True))
+        keep = [i for i, r in enumerate(self.active) if not r.finished]
+        if len(keep) == len(self.active):
+            return
+        if not keep:
+            self.active = []
+            self.cache = None
+            self.mask = None
+        elif self.mergeable:
+            self.cache.batch_select_indices(torch.tensor(keep, device=self.model.device))
+            self.mask = self.mask[keep]
+            self.active = [self.active[i] for i in keep]
+
+
+def _message_content(content):
+    # OpenAI 格式的 content 可能是 [{"type": "text", "text": ...}] 这样的列表
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def _normalize_messages(messages):
+    return [{"role": m["role"], "content": _message_content(m.get("content"))} for m in messages]
+
+
+class Llm_request_handler(BaseHTTPRequestHandler):
+    batcher: Continuous_batcher = None
+    model_name = LLM_SERVER_MODEL
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, content_type, lines):
+        # HTTP/1.0 不带 Content-Length，每一行生成后立刻发出，发送完关闭连接
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        for line in lines:
+            self.wfile.write(line.encode("utf-8"))
+            self.wfile.flush()
+
+    @staticmethod
+    def _deltas(request):
+        # 逐步返回新生成的文本，直到生成结束
+        while (delta := request.chunks.get()) is not None:
+            yield delta
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [{"id": self.model_name, "object": "model"}]})
+        elif self.path == "/api/tags":
+            self._send_json(200, {"models": [{"name": self.model_name, "model": self.model_name}]})
+        else:
+            self._send_json(404, {"error": f"not found: {self.path}"})
+
+    def do_POST(self):
+        try:
+            body = self._read_json()
+            if self.path == "/v1/chat/completions":
+                self._openai_chat(body)
+            elif self.path == "/api/chat":
+                self._ollama_chat(body)
+            else:
+                self._send_json(404, {"error": f"not found: {self.path}"})
+        except Exception as e:
+            logger.error(f"处理请求失败: {e}")
+            self._send_json(500, {"error": str(e)})
+
+    def _openai_chat(self, body):
+        messages = _normalize_messages(body["messages"])
+        max_new_tokens = body.get("max_tokens") or LLM_SERVER_MAX_TOKENS
+        temperature = body.get("temperature", 0.0)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        if body.get("stream"):
+            request = self.batcher.submit(messages, max_new_tokens, temperature, stream=True)
+
+            def chunk(delta, finish_reason=None):
+                data = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": self.model_name,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }
+                return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+            def lines():
+                yield chunk({"role": "assistant", "content": ""})
+                for delta in self._deltas(request):
+                    yield chunk({"content": delta})
+                if request.error:
+                    yield f"data: {json.dumps({'error': str(request.error)}, ensure_ascii=False)}\n\n"
+                else:
+                    yield chunk({}, request.finish_reason)
+                yield "data: [DONE]\n\n"
+
+            self._send_stream("text/event-stream", lines())
+            return
+
+        request = self.batcher.generate(messages, max_new_tokens, temperature)
+        self._send_json(
+            200,
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": self.model_name,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": request.text},
+                        "finish_reason": request.finish_reason,
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": len(request.prompt_ids),
+                    "completion_tokens": len(request.generated),
+                    "total_tokens": len(request.prompt_ids) + len(request.generated),
+                },
+            },
+        )
+
+    def _ollama_chat(self, body):
+        options = body.get("options") or {}
+        messages = _normalize_messages(body["messages"])
+        max_new_tokens = options.get("num_predict") or LLM_SERVER_MAX_TOKENS
+        temperature = options.get("temperature", 0.0)
+
+        def response(request, content, done):
+            data = {
+                "model": self.model_name,
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "message": {"role": "assistant", "content": content},
+                "done": done,
+            }
+            if done:
+                data.update(
+                    done_reason=request.finish_reason,
+                    prompt_eval_count=len(request.prompt_ids),
+                    eval_count=len(request.generated),
+                )
+            return data
+
+        # Ollama 默认是流式请求，按 NDJSON 每生成一段返回一行
+        if body.get("stream", True):
+            request = self.batcher.submit(messages, max_new_tokens, temperature, stream=True)
+
+            def lines():
+                for delta in self._deltas(request):
+                    yield json.dumps(response(request, delta, False), ensure_ascii=False) + "\n"
+                if request.error:
+                    yield json.dumps({"error": str(request.error)}, ensure_ascii=False) + "\n"
+                else:
+                    yield json.dumps(response(request, "", True), ensure_ascii=False) + "\n"
+
+            self._send_stream("application/x-ndjson", lines())
+        else:
+            request = self.batcher.generate(messages, max_new_tokens, temperature)
+            self._send_json(200, response(request, request.text, True))
+
+
+def serve(model_name=LLM_SERVER_MODEL, host=LLM_SERVER_HOST, port=LLM_SERVER_PORT, max_batch=LLM_SERVER_MAX_BATCH):
+    llm = Local_llm(llm_name=model_name)
+    Llm_request_handler.batcher = Continuous_batcher(llm, max_batch=max_batch)
+    Llm_request_handler.model_name = model_name
+    server = ThreadingHTTPServer((host, port), Llm_request_handler)
+    logger.info(f"本地模型服务已启动: http://{host}:{port}, model={model_name}")
+    print(f"本地模型服务已启动: http://{host}:{port}, model={model_name}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve()
@@ -1,23 +1,76 @@
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import os
-from transformers import pipeline
+import os, threading
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+import model_registry
+import prefix_cache
+import json_constraint
+from logger_config import get_logger
 
 os.environ["TF_ENABLE_ONEDNN_OPTS"] = "0"
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
+logger = get_logger(__name__)
+
+# chat / stream 每条最多生成的 token 数，不设置时和以前一样不限制 (使用模型的 generation_config)，
+# 多个故事的 JSON 数组不会被截断
+LOCAL_LLM_MAX_NEW_TOKENS = int(os.getenv("LOCAL_LLM_MAX_NEW_TOKENS", "0")) or None
+# 默认的草稿模型，例如 google/gemma-3-270m-it，不设置时不使用投机解码
+LOCAL_LLM_DRAFT_MODEL = os.getenv("LOCAL_LLM_DRAFT_MODEL")
+# invoke_batch 每批一起生成的 prompt 数
+LOCAL_LLM_BATCH_SIZE = int(os.getenv("LOCAL_LLM_BATCH_SIZE", "8"))
+
+
+class Event_stopping_criteria(StoppingCriteria):
+    """event 被设置后停止生成，用于从其他线程中止 generate"""
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
 
 
 # google/gemma-2b-it
 # google/gemma-3-270m-it
 class Local_llm:
-    def __init__(self, llm_name="google/gemma-3-270m-it"):
+    def __init__(
+        self,
+        llm_name="google/gemma-3-270m-it",
+        device=None,
+        torch_dtype=None,
+        mode=None,
+        use_prefix_cache=prefix_cache.PREFIX_CACHE_ENABLED,
+        draft_llm_name=LOCAL_LLM_DRAFT_MODEL,
+    ):
+        # 模型在第一次调用时才通过 model_registry 加载，同一个模型在进程内只加载一次
         self.llm_name = llm_name
-        self.pipe = pipeline("text-generation", model=self.llm_name)
-        # llm_name = "google/gemma-3-1b-it"
-        # self.tokenizer = AutoTokenizer.from_pretrained(llm_name)
-        # self.model = AutoModelForCausalLM.from_pretrained(llm_name)
-        # self.model.eval()
+        self.device = device
+        self.torch_dtype = torch_dtype
+        # 推理模式 fp32 / bf16 / int8，None 时使用 model_registry.LOCAL_LLM_MODE
+        self.mode = mode
+        self.use_prefix_cache = use_prefix_cache
+        # 投机解码的草稿模型，需要和 llm_name 使用同一个 tokenizer，
+        # 例如用 gemma-3-270m 起草、gemma-3-1b 验证
+        self.draft_llm_name = draft_llm_name if draft_llm_name != llm_name else None
+
+    @property
+    def pipe(self):
+        return model_registry.get_pipeline(self.llm_name, self.device, self.torch_dtype, self.mode)
+
+    # model / tokenizer 总是当前进程里的权重，不经过 socket 或推理服务
+    @property
+    def model(self):
+        return model_registry.get_local_pipeline(self.llm_name, self.device, self.torch_dtype, self.mode).model
+
+    @property
+    def tokenizer(self):
+        return model_registry.get_local_pipeline(self.llm_name, self.device, self.torch_dtype, self.mode).tokenizer
+
+    @property
+    def draft_model(self):
+        if not self.draft_llm_name:
+            return None
+        return model_registry.get_local_pipeline(self.draft_llm_name, self.device, self.torch_dtype, self.mode).model
 
     def get_model(self):
         return self.model
@@ -26,12 +79,151 @@ class Local_llm:
         return self.tokenizer
 
 
+    def chat(self, messages, max_new_tokens=LOCAL_LLM_MAX_NEW_TOKENS, json_schema=None, **generate_kwargs):
+        """
+        生成一轮回复，返回值和 pipeline 的格式一样。
+        启用前缀缓存时直接调用 model.generate，和之前调用过的 prompt 相同的前缀不再重新计算。
+
+        Args:
+            json_schema (dict): 指定时按 json_constraint 约束输出，JSON 对象闭合后立刻停止，
+                例如 json_constraint.STORIES_SCHEMA。
+
+        Returns:
+            list[dict]: [{"generated_text": messages + [{"role": "assistant", "content": ...}]}]
+        """
+        if model_registry.is_remote() or not (self.use_prefix_cache or json_schema or self.draft_llm_name):
+            if json_schema:
+                logger.warning("通过推理服务或模型进程调用时不支持 json_schema，忽略约束")
+            if max_new_tokens:
+                generate_kwargs["max_new_tokens"] = max_new_tokens
+            return self.pipe(messages, **generate_kwargs)
+
+        input_ids, generate_kwargs = self._prepare(messages, max_new_tokens, json_schema, generate_kwargs)
+        with torch.inference_mode():
+            outputs = self.model.generate(**generate_kwargs)
+        content = self.tokenizer.decode(outputs[0][input_ids.shape[-1] :], skip_special_tokens=True)
+        return [{"generated_text": list(messages) + [{"role": "assistant", "content": content}]}]
+
+    def _prepare(self, messages, max_new_tokens, json_schema, generate_kwargs):
+        # 生成 model.generate 的参数: prompt、前缀缓存、草稿模型和 JSON 约束
+        tokenizer = self.tokenizer
+        model = self.model
+        input_ids = tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True, return_tensors="pt"
+        ).to(model.device)
+        ids = input_ids[0].tolist()
+        past = None
+        if self.draft_llm_name:
+            # 草稿模型和主模型的 cache 需要一起前进，投机解码时不使用前缀缓存
+            generate_kwargs["assistant_model"] = self.draft_model
+        elif self.use_prefix_cache:
+            past = self._cached_prefix(ids)
+        if json_schema:
+            generate_kwargs.update(json_constraint.constraint_kwargs(tokenizer, json_schema, len(ids)))
+        generate_kwargs.update(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past,
+        )
+        if max_new_tokens:
+            generate_kwargs["max_new_tokens"] = max_new_tokens
+        return input_ids, generate_kwargs
+
+    def stream(self, messages, max_new_tokens=LOCAL_LLM_MAX_NEW_TOKENS, json_schema=None, stop_when=None, **generate_kwargs):
+        """
+        边生成边返回文本片段。
+
+        Args:
+            messages (list[dict]): 和 invoke 一样的对话。
+            json_schema (dict): 和 chat 一样的 JSON 约束。
+            stop_when (Callable[[str], bool]): 每收到一段文本后用目前为止的全部文本调用，
+                返回 True 时停止生成，例如已经生成了足够多的故事。
+            **generate_kwargs: 传给 model.generate 的其他参数。
+
+        Yields:
+            str: 新生成的文本片段。
+        """
+        if model_registry.is_remote():
+            # 推理服务和模型进程不支持流式返回，生成结束后一次返回
+            response = self.chat(messages, max_new_tokens=max_new_tokens, json_schema=json_schema, **generate_kwargs)
+            yield response[0]["generated_text"][-1]["content"]
+            return
+
+        stop_event = threading.Event()
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        _, generate_kwargs = self._prepare(messages, max_new_tokens, json_schema, generate_kwargs)
+        criteria = generate_kwargs.get("stopping_criteria") or StoppingCriteriaList()
+        criteria.append(Event_stopping_criteria(stop_event))
+        generate_kwargs.update(streamer=streamer, stopping_criteria=criteria)
+
+        errors = []
+
+        def generate():
+            try:
+                with torch.inference_mode():
+                    self.model.generate(**generate_kwargs)
+            except Exception as e:
+                errors.append(e)
+                # 结束 streamer，否则迭代的一方会一直等待
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        text = ""
+        try:
+            for chunk in streamer:
+                text += chunk
+                yield chunk
+                if stop_when and stop_when(text):
+                    break
+        finally:
+            # 调用方提前结束迭代或 stop_when 满足时，让生成线程在下一步停止
+            stop_event.set()
+            for _ in streamer:
+                pass
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def stream_query(self, query, stop_when=None, json_schema=None):
+        """和 invoke_query_format1 相同的提示词，流式返回"""
+        messages = [
+            {"role": "system", "content": "用中文回答我的问题。"},
+            {"role": "user", "content": query},
+        ]
+        return self.stream(messages, json_schema=json_schema, stop_when=stop_when)
+
+    def _cached_prefix(self, ids):
+        # 缓存 prompt 除最后一个 token 以外的部分，最后一个 token 留给 generate 计算 logits
+        cache = prefix_cache.get_prefix_cache(
+            model_registry.pipeline_key(self.llm_name, self.device, self.torch_dtype, self.mode)
+        )
+        prefix = ids[:-1]
+        model = self.model
+        try:
+            length, past = cache.lookup(prefix)
+            if length < len(prefix):
+                with torch.inference_mode():
+                    outputs = model(
+                        input_ids=torch.tensor([prefix[length:]], device=model.device),
+                        past_key_values=past,
+                        cache_position=torch.arange(length, len(prefix), device=model.device),
+                        use_cache=True,
+                    )
+                past = outputs.past_key_values
+                cache.store(prefix, past)
+            return past
+        except Exception as e:
+            # 有些 cache (例如滑动窗口) 不支持截断，这时不用缓存
+            logger.warning(f"前缀缓存不可用，改为完整计算: {e}")
+            return None
+
     def invoke(self, messages):
         
         # messages = [
         #     {"role": "system", "content": "用中文回答我的问题。"},{"role": "user", "content": query},
         # ]
-        response=self.pipe(messages)
+        response=self.chat(messages)
         print('response',response)
         return response
 
@@ -41,18 +233,18 @@ class Local_llm:
             # {"role": "system", "content": "用中文回答我的问题。"},
             {"role": "user", "content": query},
         ]
-        response=self.pipe(messages)
+        response=self.chat(messages)
 
         print('response',response)
         return response
 
-    def invoke_query_format1(self, query):
+    def invoke_query_format1(self, query, json_schema=None):
         
         messages = [
             {"role": "system", "content": "用中文回答我的问题。"},
             {"role": "user", "content": query},
         ]
-        response=self.pipe(messages)
+        response=self.chat(messages, json_schema=json_schema)
         print('response',response)
         generated_text_list = response[0]["generated_text"]
         assistant_reply_dict = generated_text_list[-1]
@@ -72,7 +264,7 @@ class Local_llm:
             tokenize=True,
             return_dict=True,
             return_tensors="pt",
-        ).to(device)
+        ).to(self.model.device)
 
         outputs = self.model.generate(
             **inputs,
@@ -87,6 +279,62 @@ class Local_llm:
         print('response',response)
         return response
 
+    def invoke_batch(self, list_of_messages, batch_size=LOCAL_LLM_BATCH_SIZE, max_new_tokens=1024, **generate_kwargs):
+        """
+        把多组对话按批一起生成，比逐条调用 invoke 吞吐量高。
+        prompt 按 token 长度排序后再分批，同一批里长度相近，左侧补齐的 padding 更少。
+
+        Args:
+            list_of_messages (list[list[dict]]): 多组对话，每组和 invoke 的 messages 格式一样。
+            batch_size (int): 每批的条数。
+            max_new_tokens (int): 每条最多生成的 token 数。
+            **generate_kwargs: 传给 model.generate 的其他参数，例如 do_sample、temperature。
+
+        Returns:
+            list[str]: 每组对话的回复内容，顺序和输入一致。
+        """
+        tokenizer = self.tokenizer
+        model = self.model
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+        prompts = [
+            tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+            for messages in list_of_messages
+        ]
+        # chat template 里已经带了 bos，不再重复添加
+        lengths = [len(ids) for ids in tokenizer(prompts, add_special_tokens=False)["input_ids"]]
+        order = sorted(range(len(prompts)), key=lambda i: lengths[i])
+
+        results = [None] * len(prompts)
+        padding_side = tokenizer.padding_side
+        # 生成时新 token 接在最右边，所以要在左侧补齐
+        tokenizer.padding_side = "left"
+        try:
+            for start in range(0, len(order), batch_size):
+                batch = order[start : start + batch_size]
+                inputs = tokenizer(
+                    [prompts[i] for i in batch],
+                    return_tensors="pt",
+                    padding=True,
+                    add_special_tokens=False,
+                ).to(model.device)
+                with torch.inference_mode():
+                    outputs = model.generate(
+                        **inputs,
+                        max_new_tokens=max_new_tokens,
+                        pad_token_id=tokenizer.pad_token_id,
+                        **generate_kwargs,
+                    )
+                texts = tokenizer.batch_decode(
+                    outputs[:, inputs["input_ids"].shape[-1] :], skip_special_tokens=True
+                )
+                for i, text in zip(batch, texts):
+                    results[i] = text
+        finally:
+            tokenizer.padding_side = padding_side
+        return results
+
 if __name__ == "__main__":
     # llm=Local_llm()
     llm=Local_llm(llm_name="google/gemma-3-1b-it")
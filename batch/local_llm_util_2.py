@@ -2,7 +2,9 @@ from pydantic import PrivateAttr
 import os, torch
 
 os.environ["TF_ENABLE_ONEDNN_OPTS"] = "0"
-from transformers import pipeline
+from local_llm_util import Local_llm, LOCAL_LLM_DRAFT_MODEL
+import json_constraint
+import json_stream
 from langchain_core.tools import tool
 from langchain_core.language_models import BaseLLM, BaseChatModel
 from langgraph.graph import StateGraph, END
@@ -20,12 +22,12 @@ SYSTEM_CONTENT="""
 你可以使用如下工具，
 {}
 请按照以下 JSON 格式返回工具调用：
-{
+{{
   "tool_calls": [
-    {"name": "tool_name", "args": {"arg_name": "value"}}
+    {{"name": "tool_name", "args": {{"arg_name": "value"}}}}
   ]
-}
-如果没有工具需要调用，返回空列表：{"tool_calls": []}。
+}}
+如果没有工具需要调用，返回空列表：{{"tool_calls": []}}。
 现在请根据任务描述生成工具调用。"""
 # google/gemma-3-270m-it
 # google/gemma-3-1b-it
@@ -34,44 +36,84 @@ class CustomLLM(BaseLLM):
     # class CustomLLM(BaseChatModel):
     llm_name: str = "google/gemma-3-270m-it"
     tools: list = []
-    _pipe: Any = PrivateAttr()
+    # 是否按 {"tool_calls": [...]} 的 schema 约束输出，保证 _generate 能解析
+    constrained: bool = False
+    # 投机解码的草稿模型，例如 llm_name 为 gemma-3-1b-it 时用 gemma-3-270m-it，
+    # 默认和 Local_llm 一样使用 LOCAL_LLM_DRAFT_MODEL
+    draft_llm_name: str | None = LOCAL_LLM_DRAFT_MODEL
+    _llm: Any = PrivateAttr()
 
     def __init__(self, **data: Any):
         super().__init__(**data)
-        # self.llm_name = llm_name
-        self._pipe = pipeline("text-generation", model=self.llm_name, device=device)
+        # 和 Local_llm 共用 model_registry 里的模型和前缀缓存，不会重复加载权重，
+        # 每次调用相同的 SYSTEM_CONTENT 也只计算一次
+        self._llm = Local_llm(
+            llm_name=self.llm_name, device=device, draft_llm_name=self.draft_llm_name
+        )
 
-    def invoke(self, query: str) -> str:
-        messages = [
+    def _messages(self, query: str) -> list:
+        return [
             {"role": "system", "content": SYSTEM_CONTENT.format(self.tools)},
             {"role": "user", "content": query},
         ]
-        response = self._pipe(messages)
+
+    def _json_schema(self):
+        if not self.constrained:
+            return None
+        tool_names = list(self.tools) if isinstance(self.tools, dict) else []
+        return json_constraint.tool_calls_schema(tool_names)
+
+    def invoke(self, query: str) -> str:
+        messages = self._messages(query)
+        response = self._llm.chat(messages, json_schema=self._json_schema())
         print("response", response)
         generated_text_list = response[0]["generated_text"]
         assistant_reply_dict = generated_text_list[-1]
         assistant_content = assistant_reply_dict["content"]
         return assistant_content
 
+    def stream_query(self, query: str, stop_when=None):
+        """
+        流式返回 invoke 的回复文本片段。
+        stop_when 用目前为止的全部文本调用，返回 True 时停止生成。
+        不能叫 stream，否则会覆盖 LangChain Runnable.stream(input, config) 的接口。
+        """
+        return self._llm.stream(
+            self._messages(query), json_schema=self._json_schema(), stop_when=stop_when
+        )
+
     def _generate(self, messages: Sequence[Dict]) -> Dict:
         # 将 LangChain 的消息转换为你的 LLM 输入格式
         query = messages[-1].content if messages else ""
-        response_text = self.invoke(query)
 
         # 模拟工具调用解析：假设 LLM 返回 JSON 格式的工具调用
         # 示例：{"tool_calls": [{"name": "reverse_string", "args": {"input_text": "hello"}}]}
+        # 流式解析，每个工具调用一闭合就取出来，tool_calls 数组结束后停止生成，
+        # 回复被截断时保留已经完整的工具调用
+        parser = json_stream.Json_array_stream("tool_calls")
+        calls = []
+        response_text = ""
+        chunks = self.stream_query(query, stop_when=lambda text: parser.done)
         try:
-            response_json = json.loads(response_text)
-            if "tool_calls" in response_json:
-                tool_calls = [
-                    {"id": f"call_{i}", "name": call["name"], "args": call["args"]}
-                    for i, call in enumerate(response_json["tool_calls"])
-                ]
-                return AIMessage(content="", tool_calls=tool_calls)
-        except json.JSONDecodeError:
-            # 如果不是 JSON，假设是普通文本响应
-            pass
+            for chunk in chunks:
+                response_text += chunk
+                calls.extend(
+                    call for call in parser.feed(chunk) if isinstance(call, dict) and "name" in call
+                )
+                if parser.done:
+                    break
+        finally:
+            chunks.close()
+        print("response", response_text)
+
+        if parser.found:
+            tool_calls = [
+                {"id": f"call_{i}", "name": call["name"], "args": call.get("args", {})}
+                for i, call in enumerate(calls)
+            ]
+            return AIMessage(content="", tool_calls=tool_calls)
 
+        # 如果不是 JSON，假设是普通文本响应
         return AIMessage(content=response_text)
 
     def bind_tools(self, tools):
@@ -0,0 +1,290 @@
+"""
+进程内共用的本地模型注册表。
+按 (模型名, device, dtype) 缓存 transformers 的 text-generation pipeline，第一次使用时才加载，
+Local_llm 和 CustomLLM 用同一个模型时共用同一份权重。
+
+设置环境变量 LOCAL_LLM_SOCKET 后，get_pipeline 改为连接常驻的模型进程，
+脚本启动时不用再加载模型。常驻进程用下面的命令启动：
+    python model_registry.py
+设置 LOCAL_LLM_SERVER_URL 后改为调用 local_llm_server.py 的推理服务，
+多个进程的请求会在服务里合并成批次生成。
+"""
+
+import os, json, threading, socketserver, socket
+import urllib.request
+from dotenv import load_dotenv
+from logger_config import get_logger
+
+load_dotenv()
+os.environ["TF_ENABLE_ONEDNN_OPTS"] = "0"
+
+logger = get_logger(__name__)
+
+# 常驻模型进程的 Unix socket 路径，不设置时在当前进程里加载模型
+LOCAL_LLM_SOCKET = os.getenv("LOCAL_LLM_SOCKET")
+# local_llm_server.py 的地址，例如 http://127.0.0.1:11435，优先于 LOCAL_LLM_SOCKET
+LOCAL_LLM_SERVER_URL = os.getenv("LOCAL_LLM_SERVER_URL")
+# 常驻模型进程启动时预先加载的模型，用逗号分隔
+LOCAL_LLM_PRELOAD = os.getenv("LOCAL_LLM_PRELOAD", "google/gemma-3-1b-it")
+# 推理模式: fp32 / bf16 / int8 (Linear 层动态量化，只支持 CPU)
+LOCAL_LLM_MODE = os.getenv("LOCAL_LLM_MODE", "fp32")
+# torch 的计算线程数，0 表示使用 torch 的默认值
+LOCAL_LLM_THREADS = int(os.getenv("LOCAL_LLM_THREADS", "0"))
+# 绑定的 CPU 核，例如 "0-7" 或 "0,2,4,6"，不设置时不绑定
+LOCAL_LLM_CPU_AFFINITY = os.getenv("LOCAL_LLM_CPU_AFFINITY")
+# 是否用 torch.compile 编译模型的 forward (1 启用)
+LOCAL_LLM_COMPILE = os.getenv("LOCAL_LLM_COMPILE", "0") == "1"
+
+INFERENCE_MODES = {"fp32": "float32", "bf16": "bfloat16", "int8": "float32"}
+
+_pipelines = {}
+_pipeline_locks = {}
+_lock = threading.Lock()
+_threads_configured = False
+
+
+def default_device():
+    import torch
+
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def _to_torch_dtype(torch_dtype):
+    # 允许用字符串指定 dtype，例如 "bfloat16"，方便通过 socket 传递
+    if torch_dtype is None or not isinstance(torch_dtype, str) or torch_dtype == "auto":
+        return torch_dtype
+    import torch
+
+    return getattr(torch, torch_dtype)
+
+
+def _dtype_name(torch_dtype):
+    if torch_dtype is None or isinstance(torch_dtype, str):
+        return torch_dtype
+    return str(torch_dtype).replace("torch.", "")
+
+
+def _parse_cpus(text):
+    cpus = set()
+    for part in text.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.update(range(int(start), int(end) + 1))
+        elif part.strip():
+            cpus.add(int(part))
+    return cpus
+
+
+def set_cpu_affinity(cpus):
+    """
+    把当前进程绑定到 cpus。Linux 上用 os.sched_setaffinity，其他平台 (Windows) 用 psutil。
+
+    Returns:
+        bool: 绑定成功返回 True。
+    """
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        else:
+            import psutil
+
+            psutil.Process().cpu_affinity(sorted(cpus))
+    except ImportError:
+        logger.warning(f"没有安装 psutil，LOCAL_LLM_CPU_AFFINITY={sorted(cpus)} 不会生效")
+        return False
+    except (OSError, ValueError) as e:
+        logger.warning(f"绑定 CPU 核 {sorted(cpus)} 失败: {e}")
+        return False
+    return True
+
+
+def configure_threads(threads=LOCAL_LLM_THREADS, affinity=LOCAL_LLM_CPU_AFFINITY):
+    """设置 torch 的线程数和进程绑定的 CPU 核，只在第一次加载模型前执行一次"""
+    global _threads_configured
+    if _threads_configured:
+        return
+    _threads_configured = True
+    import torch
+
+    if affinity:
+        cpus = _parse_cpus(affinity)
+        if set_cpu_affinity(cpus):
+            # 没有指定线程数时，线程数和绑定的核数一致
+            threads = threads or len(cpus)
+    if threads:
+        torch.set_num_threads(threads)
+    logger.info(f"torch 线程数: {torch.get_num_threads()}")
+
+
+def pipeline_key(model_name, device=None, torch_dtype=None, mode=None):
+    """返回 (模型名, device, dtype, 推理模式)，参数相同的调用共用同一个 pipeline"""
+    mode = mode or LOCAL_LLM_MODE
+    if mode not in INFERENCE_MODES:
+        raise ValueError(f"不支持的推理模式: {mode}")
+    # 没有单独指定 dtype 时使用推理模式对应的 dtype
+    dtype = _dtype_name(torch_dtype) or INFERENCE_MODES[mode]
+    return (model_name, device or default_device(), dtype, mode)
+
+
+def load_pipeline(model_name, device, torch_dtype=None, mode="fp32"):
+    import torch
+    from transformers import pipeline
+
+    configure_threads()
+    pipe = pipeline(
+        "text-generation",
+        model=model_name,
+        device=device,
+        torch_dtype=_to_torch_dtype(torch_dtype),
+    )
+    pipe.model.eval()
+    if mode == "int8":
+        if device != "cpu":
+            raise ValueError("int8 动态量化只支持 device=cpu")
+        # 只量化 Linear 层的权重，激活值在运行时量化，不需要校准数据
+        pipe.model = torch.ao.quantization.quantize_dynamic(
+            pipe.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    if LOCAL_LLM_COMPILE:
+        pipe.model.forward = torch.compile(pipe.model.forward, dynamic=True)
+    return pipe
+
+
+def get_local_pipeline(model_name, device=None, torch_dtype=None, mode=None):
+    """返回当前进程里的 pipeline，没有加载过时先加载"""
+    key = pipeline_key(model_name, device, torch_dtype, mode)
+    with _lock:
+        if key not in _pipelines:
+            logger.info(f"正在加载模型: {key}")
+            _pipelines[key] = load_pipeline(*key)
+            _pipeline_locks[key] = threading.Lock()
+        return _pipelines[key]
+
+
+def is_remote():
+    """get_pipeline 是否会返回推理服务或常驻模型进程的客户端"""
+    return bool(LOCAL_LLM_SERVER_URL) or bool(LOCAL_LLM_SOCKET and os.path.exists(LOCAL_LLM_SOCKET))
+
+
+def get_pipeline(model_name, device=None, torch_dtype=None, mode=None):
+    """
+    返回可以像 transformers pipeline 一样调用的对象。
+
+    Args:
+        model_name (str): 模型名，例如 "google/gemma-3-270m-it"。
+        device (str): "cpu" / "cuda"，None 时自动选择。
+        torch_dtype: torch 的 dtype 或它的名字，例如 "bfloat16"，None 时由 mode 决定。
+        mode (str): 推理模式 fp32 / bf16 / int8，None 时使用 LOCAL_LLM_MODE。
+    """
+    if LOCAL_LLM_SERVER_URL:
+        return Http_pipeline(LOCAL_LLM_SERVER_URL, model_name)
+    if LOCAL_LLM_SOCKET and os.path.exists(LOCAL_LLM_SOCKET):
+        return Remote_pipeline(LOCAL_LLM_SOCKET, model_name, device, _dtype_name(torch_dtype), mode)
+    return get_local_pipeline(model_name, device, torch_dtype, mode)
+
+
+class Remote_pipeline:
+    """
+    通过 Unix socket 调用常驻模型进程里的 pipeline。
+    只支持 pipe(messages, **kwargs) 这种调用方式，参数和返回值都要能转成 JSON。
+    """
+
+    def __init__(self, socket_path, model_name, device=None, torch_dtype=None, mode=None):
+        self.socket_path = socket_path
+        self.model_name = model_name
+        self.device = device
+        self.torch_dtype = torch_dtype
+        self.mode = mode
+
+    def __call__(self, inputs, **kwargs):
+        request = {
+            "model": self.model_name,
+            "device": self.device,
+            "torch_dtype": self.torch_dtype,
+            "mode": self.mode,
+            "inputs": inputs,
+            "kwargs": kwargs,
+        }
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.socket_path)
+            with client.makefile("rw", encoding="utf-8") as f:
+                f.write(json.dumps(request, ensure_ascii=False) + "\n")
+                f.flush()
+                response = json.loads(f.readline())
+        if "error" in response:
+            raise RuntimeError(f"模型进程返回错误: {response['error']}")
+        return response["result"]
+
+
+class Http_pipeline:
+    """
+    通过 local_llm_server.py 的 /v1/chat/completions 接口生成，返回值和 pipeline 的格式一样。
+    只支持 max_new_tokens / temperature 两个生成参数。
+    """
+
+    def __init__(self, base_url, model_name):
+        self.url = base_url.rstrip("/") + "/v1/chat/completions"
+        self.model_name = model_name
+
+    def __call__(self, inputs, max_new_tokens=None, temperature=0.0, **kwargs):
+        body = {
+            "model": self.model_name,
+            "messages": inputs,
+            "max_tokens": max_new_tokens,
+            "temperature": temperature,
+        }
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(body, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request) as response:
+            result = json.loads(response.read())
+        message = result["choices"][0]["message"]
+        return [{"generated_text": list(inputs) + [message]}]
+
+
+class _Pipeline_handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                key = pipeline_key(request["model"], request.get("device"), request.get("torch_dtype"), request.get("mode"))
+                pipe = get_local_pipeline(*key)
+                # 同一个模型同时只处理一个请求
+                with _pipeline_locks[key]:
+                    result = pipe(request["inputs"], **request.get("kwargs", {}))
+                response = {"result": result}
+            except Exception as e:
+                logger.error(f"处理请求失败: {e}")
+                response = {"error": str(e)}
+            self.wfile.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+def serve(socket_path, preload=()):
+    """
+    启动常驻模型进程，在 socket_path 上接收请求。
+
+    Args:
+        socket_path (str): Unix socket 路径。
+        preload (list[str]): 启动时预先加载的模型名。
+    """
+    for model_name in preload:
+        get_local_pipeline(model_name)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, _Pipeline_handler) as server:
+        logger.info(f"模型进程已启动: {socket_path}")
+        print(f"模型进程已启动: {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    serve(
+        LOCAL_LLM_SOCKET or "/tmp/lilyco_llm.sock",
+        preload=[name for name in LOCAL_LLM_PRELOAD.split(",") if name],
+    )
@@ -0,0 +1,82 @@
+"""
+prompt 前缀的 KV cache。
+agent 每一步都会带上同样的系统提示词，把这部分的 key/value 缓存下来，
+下次调用时只需要计算和缓存不同的部分，缩短第一个 token 的等待时间。
+"""
+
+import os, copy, threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 是否启用前缀缓存 (1 启用)
+PREFIX_CACHE_ENABLED = os.getenv("PREFIX_CACHE", "1") == "1"
+# 每个模型最多缓存的前缀数，超出后淘汰最久没有用到的
+PREFIX_CACHE_SIZE = int(os.getenv("PREFIX_CACHE_SIZE", "8"))
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class Prefix_kv_cache:
+    """
+    按 token id 序列保存 KV cache，查找时返回公共前缀最长的那一条。
+    返回的是深拷贝并截断到公共前缀长度的 cache，调用方可以直接交给 generate 继续使用。
+    """
+
+    def __init__(self, max_entries=PREFIX_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, ids):
+        """
+        Args:
+            ids (list[int]): prompt 的 token id。
+
+        Returns:
+            tuple[int, Cache | None]: 命中的前缀长度和对应的 cache，没有命中时返回 (0, None)。
+        """
+        best_key, best_length = None, 0
+        with self.lock:
+            for key in self.entries:
+                length = common_prefix_length(key, ids)
+                if length > best_length:
+                    best_key, best_length = key, length
+            if best_key is None:
+                return 0, None
+            self.entries.move_to_end(best_key)
+            past = copy.deepcopy(self.entries[best_key])
+        if past.get_seq_length() > best_length:
+            past.crop(best_length)
+        return best_length, past
+
+    def store(self, ids, past):
+        with self.lock:
+            key = tuple(ids)
+            self.entries[key] = copy.deepcopy(past)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_prefix_cache(key):
+    """返回某个模型共用的 Prefix_kv_cache，key 一般是 (模型名, device, dtype)"""
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = Prefix_kv_cache()
+        return _caches[key]
@@ -0,0 +1,235 @@
+"""
+故事的近似重复检测。
+把故事切成字符 n-gram，用 MinHash + LSH 分桶保存在 SQLite 里，
+新故事只需要和同一个桶里的少数故事比较，不用和全部已有故事逐一比较。
+Task_manager.insert_task 插入前用它检查，相似度超过阈值的故事按 STORY_DEDUP 的设置
+标记为非目标 (is_target=0，不生成绘本也不上传) 或直接丢弃。
+"""
+
+import os, re, zlib, random, sqlite3, hashlib, threading
+from contextlib import closing
+import numpy as np
+from dotenv import load_dotenv
+from logger_config import get_logger
+
+load_dotenv()
+logger = get_logger(__name__)
+
+# 重复故事的处理方式: flag (标记 is_target=0) / drop (不插入) / off (不检查)
+# 默认 off，insert_task 和以前一样插入所有故事，需要去重时再设置
+STORY_DEDUP = os.getenv("STORY_DEDUP", "off")
+STORY_DEDUP_PATH = os.getenv("STORY_DEDUP_PATH", "asset/story_dedup.db")
+# n-gram 集合的 Jaccard 相似度超过这个值时视为重复
+STORY_DEDUP_THRESHOLD = float(os.getenv("STORY_DEDUP_THRESHOLD", "0.7"))
+# 字符 n-gram 的长度，中文短故事用 2 比较合适
+STORY_DEDUP_NGRAM = int(os.getenv("STORY_DEDUP_NGRAM", "2"))
+# LSH 的分桶数和每个桶的行数，签名长度 = BANDS * ROWS
+# 相似度约 (1/BANDS)^(1/ROWS) 以上的故事才会落到同一个桶里
+STORY_DEDUP_BANDS = int(os.getenv("STORY_DEDUP_BANDS", "16"))
+STORY_DEDUP_ROWS = int(os.getenv("STORY_DEDUP_ROWS", "4"))
+
+# 2^31-1，保证 a * x + b 不超出 int64
+PRIME = (1 << 31) - 1
+PUNCTUATION = re.compile(r"[\s，。！？、；：“”‘’（）《》,.!?;:'\"()\[\]<>-]+")
+
+
+def normalize(text: str) -> str:
+    return PUNCTUATION.sub("", str(text)).lower()
+
+
+def shingles(text: str, n=STORY_DEDUP_NGRAM) -> set[str]:
+    text = normalize(text)
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class Story_dedup_index:
+    TEXT_TABLE = "story_texts"
+    BAND_TABLE = "story_bands"
+    META_TABLE = "story_meta"
+
+    def __init__(
+        self,
+        db_path=STORY_DEDUP_PATH,
+        threshold=STORY_DEDUP_THRESHOLD,
+        bands=STORY_DEDUP_BANDS,
+        rows=STORY_DEDUP_ROWS,
+    ):
+        self.DB_PATH = db_path
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        # 哈希函数的参数固定，保存的桶在下次运行时仍然有效
+        rng = random.Random(42)
+        size = bands * rows
+        self.a = np.array([rng.randrange(1, PRIME) for _ in range(size)], dtype=np.int64)
+        self.b = np.array([rng.randrange(0, PRIME) for _ in range(size)], dtype=np.int64)
+        os.makedirs(os.path.dirname(self.DB_PATH) or ".", exist_ok=True)
+        self._init_db()
+
+    def _connect(self):
+        return sqlite3.connect(self.DB_PATH, timeout=30)
+
+    def _init_db(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.TEXT_TABLE} (id INTEGER PRIMARY KEY, text TEXT)")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.BAND_TABLE} (band INTEGER, hash TEXT, id INTEGER)")
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{self.BAND_TABLE}_band_hash "
+                f"ON {self.BAND_TABLE} (band, hash)"
+            )
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.META_TABLE} (key TEXT PRIMARY KEY, value TEXT)")
+
+    def signature(self, grams: set[str]) -> np.ndarray:
+        """MinHash 签名: 每个哈希函数下所有 n-gram 的最小哈希值"""
+        if not grams:
+            return np.zeros(self.bands * self.rows, dtype=np.int64)
+        x = np.array([zlib.crc32(g.encode("utf-8")) % PRIME for g in grams], dtype=np.int64)
+        return ((self.a[:, None] * x[None, :] + self.b[:, None]) % PRIME).min(axis=1)
+
+    def band_hashes(self, signature: np.ndarray) -> list[tuple[int, str]]:
+        return [
+            (band, "-".join(map(str, signature[band * self.rows : (band + 1) * self.rows])))
+            for band in range(self.bands)
+        ]
+
+    def _write(self, conn, id, text):
+        grams = shingles(text)
+        if not grams:
+            return
+        bands = self.band_hashes(self.signature(grams))
+        conn.execute(f"INSERT OR REPLACE INTO {self.TEXT_TABLE} (id, text) VALUES (?, ?)", (int(id), text))
+        conn.execute(f"DELETE FROM {self.BAND_TABLE} WHERE id = ?", (int(id),))
+        conn.executemany(
+            f"INSERT INTO {self.BAND_TABLE} (band, hash, id) VALUES (?, ?, ?)",
+            [(band, h, int(id)) for band, h in bands],
+        )
+
+    def sync(self, load_tasks, checkpoint):
+        """
+        让索引跟上任务管理器。
+        索引记录已经加入的最大任务 id 和那时任务管理器的 checkpoint，平时只加入 id 更大的任务；
+        checkpoint 对不上时 (任务被删除、CSV 被重建后 id 重新使用) 才清空索引全部重建。
+
+        Args:
+            load_tasks (Callable[[int], list]): load_tasks(after_id) 返回 id 大于 after_id 的任务 (id, text)。
+            checkpoint (Callable[[int], str]): checkpoint(upto_id) 返回任务管理器里 id 不超过 upto_id 的任务的
+                checkpoint(count, text)。
+        """
+        with closing(self._connect()) as conn, conn:
+            meta = dict(conn.execute(f"SELECT key, value FROM {self.META_TABLE}").fetchall())
+            max_id = int(meta.get("max_id", 0))
+            if max_id and checkpoint(max_id) != meta.get("checkpoint"):
+                logger.warning("任务管理器里的任务和去重索引不一致，重建索引")
+                conn.execute(f"DELETE FROM {self.TEXT_TABLE}")
+                conn.execute(f"DELETE FROM {self.BAND_TABLE}")
+                max_id = 0
+            tasks = [(int(id), str(text)) for id, text in load_tasks(max_id)]
+            for id, text in tasks:
+                self._write(conn, id, text)
+            if tasks:
+                max_id = max(id for id, _ in tasks)
+                logger.info(f"去重索引加入了 {len(tasks)} 个故事")
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {self.META_TABLE} (key, value) VALUES (?, ?)",
+                [("max_id", str(max_id)), ("checkpoint", checkpoint(max_id) if max_id else "")],
+            )
+
+    def query(self, text):
+        """
+        查找和 text 最相似的已有故事。
+
+        Returns:
+            tuple[int, float] | None: (故事 id, 相似度)，没有超过阈值的故事时返回 None。
+        """
+        grams = shingles(text)
+        if not grams:
+            return None
+        bands = self.band_hashes(self.signature(grams))
+        where = " OR ".join("(b.band = ? AND b.hash = ?)" for _ in bands)
+        params = [value for pair in bands for value in pair]
+        with closing(self._connect()) as conn:
+            candidates = conn.execute(
+                f"SELECT DISTINCT t.id, t.text FROM {self.BAND_TABLE} b "
+                f"JOIN {self.TEXT_TABLE} t ON t.id = b.id WHERE {where}",
+                params,
+            ).fetchall()
+        # 同一个桶里的只是候选，用 n-gram 集合算出准确的相似度
+        best = None
+        for id, candidate in candidates:
+            similarity = jaccard(grams, shingles(candidate))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (id, similarity)
+        return best
+
+
+def checkpoint(count, text):
+    """
+    任务管理器的 checkpoint: id 不超过某个 id 的任务数和这个 id 的故事。
+    任务被删除时任务数会变，CSV 被重建后同一个 id 的故事一般也不同，不用读取全部任务就能发现不一致。
+    """
+    return hashlib.sha256(f"{count}\n{text}".encode("utf-8")).hexdigest()
+
+
+def dedup_rows(new_rows, start_id, load_tasks, checkpoint, id_column, text_column, target_column, mode=STORY_DEDUP):
+    """
+    检查新任务是否和已有任务 (以及同一批里前面的任务) 重复。
+
+    Args:
+        new_rows (list[dict]): Task_manager._build_new_rows 生成的新任务。
+        start_id (int): 新任务之前最大的 id。
+        load_tasks / checkpoint (Callable): 用来同步索引，见 Story_dedup_index.sync。
+        id_column / text_column / target_column (str): id、故事和 is_target 的列名。
+        mode (str): flag / drop / off。
+
+    Returns:
+        list[dict]: 处理后的新任务。drop 模式下丢弃重复的任务并重新编号。
+    """
+    if mode == "off" or not new_rows:
+        return new_rows
+    index = get_index()
+    index.sync(load_tasks, checkpoint)
+
+    # 新任务还没有写入任务管理器，不加入索引，同一批里的故事在内存里比较。
+    # 写入后下次 sync 时才加入索引，写入失败也不会在索引里留下不存在的任务
+    kept, batch = [], []
+    next_id = start_id
+    for row in new_rows:
+        grams = shingles(row[text_column])
+        match = index.query(row[text_column])
+        for id, other in batch:
+            similarity = jaccard(grams, other)
+            if similarity >= index.threshold and (match is None or similarity > match[1]):
+                match = (id, similarity)
+        if match and mode == "drop":
+            logger.warning(f"丢弃重复的故事(和 id={match[0]} 相似度 {match[1]:.2f}): {row[text_column]}")
+            continue
+        next_id += 1
+        row[id_column] = next_id
+        if match:
+            logger.warning(f"标记重复的故事 id={next_id}(和 id={match[0]} 相似度 {match[1]:.2f})，不生成绘本")
+            row[target_column] = 0
+        else:
+            batch.append((next_id, grams))
+        kept.append(row)
+    return kept
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """返回进程内共用的 Story_dedup_index"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = Story_dedup_index()
+        return _index
@@ -0,0 +1,281 @@
+"""
+绘本生成的流水线。
+每个任务各自依次经过 生成故事 → 生成绘本(爬取) → 等待图片编码 → 上传 Cloudinary → 发布到 D1 五个阶段，
+阶段之间用有界队列连接，每个阶段有自己的线程数。
+第一个绘本上传、发布的时候，后面的绘本还在生成，不用像 story_workflow 那样等全部生成完再上传。
+
+用法:
+    python story_pipeline.py                  # 处理已有的待生成、待上传任务
+    python story_pipeline.py 主题1 主题2       # 先为这些主题生成故事，再接着处理
+"""
+
+import os, sys, json, threading, queue, contextlib, datetime, urllib.request
+from dotenv import load_dotenv
+from logger_config import get_logger
+import cloudinary_util
+import generate_storybooks
+import story_workflow
+
+load_dotenv()
+logger = get_logger(__name__)
+
+NOTDONE_PATH = os.getenv("NOTDONE_PATH")
+# 发布故事的 D1 接口 (和 post_stories.js 相同)
+D1_API_URL = os.getenv("D1_API_URL", "http://127.0.0.1:8788/api/story")
+# 每个阶段输入队列的长度，队列满时上一个阶段等待
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+# 各阶段的线程数
+PIPELINE_STORY_WORKERS = int(os.getenv("PIPELINE_STORY_WORKERS", "1"))
+# 生成绘本的线程数，每个线程占用一个浏览器标签页
+PIPELINE_CRAWL_WORKERS = int(os.getenv("PIPELINE_CRAWL_WORKERS", str(generate_storybooks.STORYBOOK_TABS)))
+PIPELINE_ENCODE_WORKERS = int(os.getenv("PIPELINE_ENCODE_WORKERS", "2"))
+# 同时上传的组数
+PIPELINE_UPLOAD_WORKERS = int(os.getenv("PIPELINE_UPLOAD_WORKERS", "2"))
+PIPELINE_PUBLISH_WORKERS = int(os.getenv("PIPELINE_PUBLISH_WORKERS", "1"))
+
+# 放进队列表示上游已经结束
+_STOP = object()
+
+
+class Pipeline_stage:
+    """
+    流水线的一个阶段。workers 个线程从输入队列取任务，func 的返回值放进下一个阶段的队列。
+
+    Args:
+        name (str): 阶段名，用于日志。
+        func (Callable): func(item) 或 func(item, resource)，返回 None 表示这个任务到此为止。
+        workers (int): 线程数。
+        fan_out (bool): True 时 func 返回一个列表，每个元素分别放进下一个阶段。
+        resource (Callable): 返回上下文管理器的函数，每个线程进入一次，得到的对象作为 func 的第二个参数。
+            用于只能在创建它的线程里使用的对象，例如 playwright 的标签页。
+    """
+
+    def __init__(self, name, func, workers=1, fan_out=False, resource=None, queue_size=PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.fan_out = fan_out
+        self.resource = resource
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next = None
+        self.done = 0
+        self.failed = 0
+        # 还没结束的上游 (调用方 + 上一个阶段)
+        self._producers = 1
+        self._alive = self.workers
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def close(self):
+        """一个上游结束时调用，所有上游都结束后通知每个线程退出"""
+        with self._lock:
+            self._producers -= 1
+            if self._producers:
+                return
+        for _ in range(self.workers):
+            self.queue.put(_STOP)
+
+    def start(self):
+        threads = [
+            threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _emit(self, result):
+        results = result if self.fan_out else [result]
+        for item in results:
+            if item is not None and self.next:
+                self.next.put(item)
+
+    def _loop(self, resource):
+        while (item := self.queue.get()) is not _STOP:
+            try:
+                result = self.func(item) if self.resource is None else self.func(item, resource)
+            except Exception as e:
+                result = None
+                logger.error(f"[{self.name}] 处理失败: {e}")
+            with self._lock:
+                if result is None:
+                    self.failed += 1
+                else:
+                    self.done += 1
+            self._emit(result)
+
+    def _drain(self):
+        # 线程启动失败时仍然要取走分给它的任务，否则上游会一直等队列空出来
+        while (item := self.queue.get()) is not _STOP:
+            logger.error(f"[{self.name}] 跳过任务: {item}")
+            with self._lock:
+                self.failed += 1
+
+    def _worker(self):
+        finished = False
+        try:
+            context = self.resource() if self.resource else contextlib.nullcontext()
+            with context as resource:
+                self._loop(resource)
+                finished = True
+        except Exception as e:
+            logger.error(f"[{self.name}] 线程启动失败: {e}")
+        finally:
+            if not finished:
+                self._drain()
+            with self._lock:
+                self._alive -= 1
+                last = not self._alive
+            if last and self.next:
+                self.next.close()
+
+
+def run_stages(stages, seeds):
+    """
+    把各阶段连成流水线并运行到所有任务处理完。
+
+    Args:
+        stages (list[Pipeline_stage]): 按顺序排列的阶段。
+        seeds (dict[str, list]): 阶段名到初始任务的映射，任务可以从任意阶段开始。
+
+    Returns:
+        dict[str, tuple[int, int]]: 阶段名到 (成功数, 失败数) 的映射。
+    """
+    for stage, next_stage in zip(stages, stages[1:]):
+        stage.next = next_stage
+        next_stage._producers += 1
+    threads = [thread for stage in stages for thread in stage.start()]
+
+    def seed(stage):
+        for item in seeds.get(stage.name, []):
+            stage.put(item)
+        stage.close()
+
+    # 每个阶段的初始任务由各自的线程放入，队列满时只等这一个阶段，
+    # 待上传的任务不用等待生成绘本的任务全部放进队列
+    threads += [threading.Thread(target=seed, args=(stage,), daemon=True) for stage in stages]
+    for thread in threads[-len(stages) :]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {stage.name: (stage.done, stage.failed) for stage in stages}
+
+
+class Storybook_pipeline:
+    """story_workflow 的各个步骤按任务拆开，用 run_stages 重叠执行"""
+
+    def __init__(self, tm=None, pic=None):
+        self.tm = tm or story_workflow.tm
+        self.pic = pic
+        self.manifest = cloudinary_util.Upload_manifest()
+        self._seen = set()
+        self._seen_lock = threading.Lock()
+        self._done_md_lock = threading.Lock()
+
+    def _new_tasks(self, stage):
+        # 返回还没有放进流水线的待处理任务
+        tasks = []
+        target_task = self.tm.read_target_tasks(stage)
+        with self._seen_lock:
+            for _, task in target_task.iterrows():
+                id = int(task["id"])
+                if id not in self._seen:
+                    self._seen.add(id)
+                    tasks.append({"id": id, "text": task["text"], "pic": task["pic"]})
+        return tasks
+
+    def generate_stories(self, topic):
+        story_workflow.generate_stories_tool(story_topic=topic, pic=self.pic)
+        # 启用 STORY_DEDUP 时，重复的故事已经被标记为非目标任务，不会出现在这里
+        return self._new_tasks("generate_storybook")
+
+    def crawl(self, task, worker):
+        pending = []
+        if not worker.run(task["text"], task["id"], pic=task["pic"], pending=pending):
+            logger.error(f"生成绘本失败,id={task['id']}")
+            return None
+        task["futures"] = pending
+        return task
+
+    def encode(self, task):
+        # 全部页面写完后才算生成完成，上传时不会缺页
+        for future in task.pop("futures", []):
+            future.result()
+        self.tm.mark(task["id"], "generate_storybook", 1)
+        return task
+
+    def upload(self, task):
+        group_name = f"{task['id']:0>4}"
+        group_name_full = os.path.join(NOTDONE_PATH, group_name)
+        files = cloudinary_util.list_group_files(group_name_full)
+        if not files:
+            logger.error(f"组 '{group_name}' 没有可以上传的文件")
+            return None
+        plan = cloudinary_util.plan_group_uploads(group_name, files)
+        for f, options, sha256 in self.manifest.pending_uploads(plan):
+            cloudinary_util.upload_with_retry(f, **options)
+            self.manifest.record(cloudinary_util.Upload_manifest.public_id(options), sha256, f)
+            logger.debug(f"    - 上传 {os.path.basename(f)} 完成")
+        with self._done_md_lock:
+            cloudinary_util.finish_group(group_name_full, group_name)
+        self.tm.mark(task["id"], "upload_storybook", 1)
+        return task
+
+    def publish(self, task):
+        body = [{"title": task["text"], "index": f"{task['id']:0>4}"}]
+        cloudinary_util.call_with_retry(post_json, D1_API_URL, body)
+        logger.info(f"绘本已发布,id={task['id']}")
+        return task
+
+    def stages(self):
+        return [
+            Pipeline_stage("stories", self.generate_stories, PIPELINE_STORY_WORKERS, fan_out=True),
+            Pipeline_stage(
+                "crawl", self.crawl, PIPELINE_CRAWL_WORKERS, resource=generate_storybooks.Storybook_worker
+            ),
+            Pipeline_stage("encode", self.encode, PIPELINE_ENCODE_WORKERS),
+            Pipeline_stage("upload", self.upload, PIPELINE_UPLOAD_WORKERS),
+            Pipeline_stage("publish", self.publish, PIPELINE_PUBLISH_WORKERS),
+        ]
+
+    def run(self, topics=()):
+        """
+        运行流水线。
+
+        Args:
+            topics (list[str]): 要生成故事的主题，为空时只处理已有的任务。
+
+        Returns:
+            dict[str, tuple[int, int]]: 各阶段的 (成功数, 失败数)。
+        """
+        # 和 cloudinary_util.main 一样先写入本次运行的标记，update_task_record 按组名读取
+        with open(cloudinary_util.DONE_MD_PATH, "a", encoding="utf-8") as md_file:
+            md_file.write(f"\n{cloudinary_util.DONE_MD_PREFIX}{datetime.datetime.now()}\n")
+        seeds = {
+            "stories": list(topics),
+            "crawl": self._new_tasks("generate_storybook"),
+            # 已经生成、还没上传的任务直接从上传开始
+            "upload": self._new_tasks("upload_storybook"),
+        }
+        stats = run_stages(self.stages(), seeds)
+        self.tm.flush()
+        for name, (done, failed) in stats.items():
+            logger.info(f"[{name}] 成功 {done} 个，失败 {failed} 个")
+        return stats
+
+
+def post_json(url, body):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body, ensure_ascii=False).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read() or b"null")
+
+
+if __name__ == "__main__":
+    pic = os.path.join(story_workflow.SAMPLE_PIC_4_STORYBOOK, "gqj2.jpg")
+    Storybook_pipeline(pic=pic).run(sys.argv[1:])
@@ -1,5 +1,8 @@
-from batch.local_llm_uti_customl import Local_llm
-from task_manager import Task_manager
+from local_llm_util import Local_llm
+import json_constraint
+import llm_cache
+from functools import partial
+from task_manager import get_task_manager
 import cloudinary_util
 import generate_storybooks
 import generate_stories
@@ -15,7 +18,7 @@ logger = get_logger(__name__)
 SAMPLE_PIC_4_STORYBOOK = os.getenv("SAMPLE_PIC_4_STORYBOOK")
 
 llm = Local_llm(llm_name="google/gemma-3-270m-it")
-tm = Task_manager()
+tm = get_task_manager()
 
 
 def generate_stories_tool(
@@ -27,7 +30,15 @@ def generate_stories_tool(
     generated_stories_1 = generate_stories.generate_stories_by_generation_func(
         topic=story_topic,
         number_of_stories=number_of_stories,
-        generation_func=llm.invoke,  # 直接把方法作为参数传入
+        # 按 schema 约束输出，保证返回的是 {"stories": [...]}
+        generation_func=llm_cache.cached(
+            partial(
+                llm.invoke_query_format1,
+                json_schema=json_constraint.stories_schema(number_of_stories),
+            ),
+            model=llm.llm_name,
+            validate=generate_stories.has_stories,
+        ),
     )
 
     if generated_stories_1:
@@ -42,20 +53,29 @@ def generate_stories_tool(
 
 
 def generate_images_tool():
-    tasks = tm.read_df_from_csv()
-    target_task = tasks.query("is_target == 1 and generate_storybook != 1")
+    target_task = tm.read_target_tasks("generate_storybook")
     logger.info("target_task", target_task)
+
+    def on_done(id, res):
+        if res:
+            tm.mark(id, "generate_storybook", 1)
+        else:
+            logger.error("生成绘本失败")
+
+    if generate_storybooks.STORYBOOK_TABS > 1:
+        # 多个标签页并发生成
+        generate_storybooks.run_pool(
+            [task for _, task in target_task.iterrows()], on_done=on_done
+        )
+        return [task for _, task in target_task.iterrows()]
+
     for _, task in target_task.iterrows():
         # prompt = "兔子托比在林间小溪上漂流,它沿途看到了很多鱼，它和其中一只叫波利的安康鱼做了朋友"
         prompt = task["text"]
         id = task["id"]
         pic = task["pic"]
         res = generate_storybooks.run(prompt=prompt, id=id, pic=pic)
-        if res:
-            tasks.loc[tasks["id"] == id, "generate_storybook"] = 1
-            tm.update_task(tasks)
-        else:
-            logger.error("生成绘本失败")
+        on_done(id, res)
     return [task for _, task in target_task.iterrows()]
 
 
@@ -66,6 +86,8 @@ def upload_images_to_cloudinary_tool():
 
 
 def update_d1():
+    # post_stories.js 直接读 asset/task.csv，先把状态同步过去
+    tm.flush()
     result = subprocess.run(
         ["node", "post_stories.js"], capture_output=True, text=True, encoding="utf-8"
     )
@@ -1,9 +1,17 @@
 import pandas as pd
-import os
+import os, sqlite3, json, threading
+from contextlib import closing
 from logger_config import get_logger
+import story_dedup
 
 logger = get_logger(__name__)
 
+# 各处理阶段对应的待处理任务条件 (pandas query 写法)
+TARGET_TASK_QUERIES = {
+    "generate_storybook": "is_target == 1 and generate_storybook != 1",
+    "upload_storybook": "is_target == 1 and generate_storybook == 1 and upload_storybook != 1",
+}
+
 
 class Task_manager:
     def __init__(
@@ -18,34 +26,93 @@ class Task_manager:
             "pic",
         ],
         encoding="utf-8-sig",
+        journal_path=None,
+        compact_every=50,
     ) -> None:
 
         # 定义 CSV 文件的路径和列名
         self.CSV_PATH = csv_path
         self.CSV_COLUMNS = csv_columns
         self.encoding = encoding
+        # mark 的修改先追加到日志文件，累计 compact_every 条后再合并进 CSV
+        self.JOURNAL_PATH = journal_path or f"{csv_path}.journal"
+        self.compact_every = compact_every
+        self._journal_count = None
+        # 可重入: compact / insert_task 持有锁时也会调用 read_df_from_csv
+        self._lock = threading.RLock()
 
     def read_df_from_csv(self):
-        return pd.read_csv(self.CSV_PATH, dtype={'number': 'Int64'})
+        # CSV 和日志要在同一把锁里读取，否则 compact 在两次读取之间替换 CSV、清空日志时会丢失修改
+        with self._lock:
+            df = pd.read_csv(self.CSV_PATH, dtype={'number': 'Int64'})
+            return self._apply_journal(df)
 
-    def insert_task(self, text_list: list[str],pic:str=None):
-        # 确保 asset 文件夹存在
-        os.makedirs(os.path.dirname(self.CSV_PATH), exist_ok=True)
+    @staticmethod
+    def _to_python(value):
+        # pandas/numpy 的值转换成 json/sqlite3 能直接保存的类型
+        if pd.isna(value):
+            return None
+        return value.item() if hasattr(value, "item") else value
 
-        start_id = 0
-        # 如果文件已存在，读取现有数据以确定新的 id 起始值
-        if os.path.exists(self.CSV_PATH):
-            try:
-                df_existing = self.read_df_from_csv()
-                if not df_existing.empty:
-                    start_id = df_existing["id"].max()
-            except pd.errors.EmptyDataError:
-                logger.debug(f"'{self.CSV_PATH}' 文件为空，将从头开始写入。")
-                df_existing = pd.DataFrame()
-        else:
-            df_existing = pd.DataFrame()
+    @classmethod
+    def _normalize_ids(cls, ids):
+        if isinstance(ids, (int, str)) or not hasattr(ids, "__iter__"):
+            ids = [ids]
+        return [cls._to_python(id) for id in ids]
+
+    def _check_status_column(self, column):
+        if column not in self.CSV_COLUMNS[2:5]:
+            raise ValueError(f"不支持更新的列: {column}")
 
-        # 根据输入的文本列表，创建新的数据
+    def _read_journal(self):
+        if not os.path.exists(self.JOURNAL_PATH):
+            return []
+        entries = []
+        with open(self.JOURNAL_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 写到一半中断的最后一行，直接丢弃
+                    logger.warning(f"忽略不完整的日志记录: {line!r}")
+        return entries
+
+    def _journal_needs_newline(self):
+        # 上次写到一半中断时最后一行没有换行，新记录要另起一行
+        if not os.path.exists(self.JOURNAL_PATH) or not os.path.getsize(self.JOURNAL_PATH):
+            return False
+        with open(self.JOURNAL_PATH, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b"\n"
+
+    def _apply_journal(self, df: pd.DataFrame):
+        for entry in self._read_journal():
+            df.loc[df["id"].isin(entry["ids"]), entry["column"]] = entry["value"]
+        return df
+
+    def _write_csv_atomic(self, df: pd.DataFrame):
+        # 先写临时文件再替换，写到一半中断也不会把 CSV 截断
+        tmp_path = f"{self.CSV_PATH}.tmp"
+        df.to_csv(
+            tmp_path,
+            mode="w",
+            header=True,
+            index=False,
+            encoding=self.encoding,
+        )
+        os.replace(tmp_path, self.CSV_PATH)
+
+    def _clear_journal(self):
+        if os.path.exists(self.JOURNAL_PATH):
+            os.remove(self.JOURNAL_PATH)
+        self._journal_count = 0
+
+    def read_target_tasks(self, stage="generate_storybook"):
+        """读取某个处理阶段 (generate_storybook / upload_storybook) 还没完成的任务"""
+        return self.read_df_from_csv().query(TARGET_TASK_QUERIES[stage])
+
+    def _build_new_rows(self, text_list: list[str], start_id, pic: str = None):
+        """根据输入的文本列表，创建新的数据"""
         new_data = []
         for i, text in enumerate(text_list, start=1):
             new_data.append(
@@ -58,26 +125,83 @@ class Task_manager:
                     self.CSV_COLUMNS[5]: pic if pic else 0,
                 }
             )
+        return new_data
 
-        if not new_data:
-            logger.warning("没有需要添加的新任务。")
-            return
-
-        # 将新数据转换为 DataFrame
-        df_new = pd.DataFrame(new_data, columns=self.CSV_COLUMNS)
-
-        # 将新数据追加到文件中
-        # 如果文件是第一次创建，mode='w' 会写入表头
-        # 如果是追加，mode='a' 和 header=False 可以避免重复写入表头
-        write_header = not os.path.exists(self.CSV_PATH) or df_existing.empty
-        df_new.to_csv(
-            self.CSV_PATH,
-            mode="a",
-            header=write_header,
-            index=False,
-            encoding=self.encoding,
+    def _dedup_rows(self, new_data, start_id, load_tasks, checkpoint):
+        """按 STORY_DEDUP 的设置标记或丢弃和已有任务相似的新任务，load_tasks / checkpoint 见 Story_dedup_index.sync"""
+        return story_dedup.dedup_rows(
+            new_data,
+            start_id,
+            load_tasks,
+            checkpoint,
+            id_column=self.CSV_COLUMNS[0],
+            text_column=self.CSV_COLUMNS[1],
+            target_column=self.CSV_COLUMNS[4],
         )
 
+    def insert_task(self, text_list: list[str],pic:str=None):
+        """
+        追加新任务。
+        设置 STORY_DEDUP=flag 时，和已有任务近似重复的故事以 is_target=0 插入 (不生成绘本也不上传)，
+        STORY_DEDUP=drop 时不插入；默认 off，所有故事都插入。
+        """
+        # 确保 asset 文件夹存在
+        os.makedirs(os.path.dirname(self.CSV_PATH), exist_ok=True)
+
+        # 和 mark 触发的 compact 互斥，避免追加的新任务在 compact 读取 CSV 和替换文件之间丢失
+        with self._lock:
+            start_id = 0
+            # 如果文件已存在，读取现有数据以确定新的 id 起始值
+            if os.path.exists(self.CSV_PATH):
+                try:
+                    df_existing = self.read_df_from_csv()
+                    if not df_existing.empty:
+                        start_id = df_existing["id"].max()
+                except pd.errors.EmptyDataError:
+                    logger.debug(f"'{self.CSV_PATH}' 文件为空，将从头开始写入。")
+                    df_existing = pd.DataFrame()
+            else:
+                df_existing = pd.DataFrame()
+
+            # 根据输入的文本列表，创建新的数据
+            new_data = self._build_new_rows(text_list, start_id, pic)
+
+            id_column, text_column = self.CSV_COLUMNS[0], self.CSV_COLUMNS[1]
+
+            def load_tasks(after_id):
+                if df_existing.empty:
+                    return []
+                df = df_existing[df_existing[id_column] > after_id]
+                return zip(df[id_column], df[text_column])
+
+            def checkpoint(upto_id):
+                if df_existing.empty:
+                    return story_dedup.checkpoint(0, None)
+                df = df_existing[df_existing[id_column] <= upto_id]
+                text = df.loc[df[id_column] == upto_id, text_column]
+                return story_dedup.checkpoint(len(df), text.iloc[0] if len(text) else None)
+
+            new_data = self._dedup_rows(new_data, start_id, load_tasks, checkpoint)
+
+            if not new_data:
+                logger.warning("没有需要添加的新任务。")
+                return
+
+            # 将新数据转换为 DataFrame
+            df_new = pd.DataFrame(new_data, columns=self.CSV_COLUMNS)
+
+            # 将新数据追加到文件中
+            # 如果文件是第一次创建，mode='w' 会写入表头
+            # 如果是追加，mode='a' 和 header=False 可以避免重复写入表头
+            write_header = not os.path.exists(self.CSV_PATH) or df_existing.empty
+            df_new.to_csv(
+                self.CSV_PATH,
+                mode="a",
+                header=write_header,
+                index=False,
+                encoding=self.encoding,
+            )
+
     def update_task(self, df: pd.DataFrame):
         # df_total = self.read_df_from_csv()
 
@@ -93,15 +217,237 @@ class Task_manager:
         #         index=False,
         #         encoding=self.encoding,
         #     )
-        df.to_csv(
-                self.CSV_PATH,
-                mode="w",
-                header=True,
-                index=False,
-                encoding=self.encoding,
-            )        
+        with self._lock:
+            self._write_csv_atomic(df)
+            # 传入的 df 已经包含了日志里的修改
+            self._clear_journal()
         logger.debug("修改成功。")
 
+    def mark(self, ids, column, value=1):
+        """
+        只更新指定 id 的某个状态列。
+        修改先追加到日志文件 JOURNAL_PATH，写入量只和修改的行数有关，
+        累计 compact_every 条后再一次性合并进 CSV。
+
+        Args:
+            ids: 单个 id 或 id 的列表。
+            column (str): 状态列名，例如 "generate_storybook"。
+            value: 要设置的值。
+
+        Returns:
+            int: 记录的 id 数。
+        """
+        self._check_status_column(column)
+        ids = self._normalize_ids(ids)
+        entry = {"ids": ids, "column": column, "value": self._to_python(value)}
+        with self._lock:
+            if self._journal_count is None:
+                self._journal_count = len(self._read_journal())
+            line = json.dumps(entry, ensure_ascii=False) + "\n"
+            if self._journal_needs_newline():
+                line = "\n" + line
+            with open(self.JOURNAL_PATH, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_count += 1
+            need_compact = self._journal_count >= self.compact_every
+        if need_compact:
+            self.compact()
+        return len(ids)
+
+    def compact(self):
+        """把日志里的修改合并进 CSV，然后清空日志"""
+        with self._lock:
+            if not os.path.exists(self.JOURNAL_PATH):
+                return
+            self._write_csv_atomic(self.read_df_from_csv())
+            self._clear_journal()
+        logger.debug(f"日志已合并到 '{self.CSV_PATH}'。")
+
+    def flush(self):
+        """把任务状态同步到 CSV_PATH，供 post_stories.js 等外部程序读取"""
+        self.compact()
+
+
+class Sqlite_task_manager(Task_manager):
+    """
+    把任务保存在本地 SQLite 文件里的 Task_manager。
+    insert_task / read_df_from_csv / update_task 的用法和 Task_manager 一样，
+    另外可以用 mark 只更新指定行的状态，不用每次重写整张表。
+    CSV 只作为导入/导出用，调用 flush 后 post_stories.js 仍然读 asset/task.csv。
+    """
+
+    TABLE_NAME = "tasks"
+    # 需要建索引的状态列
+    INDEX_COLUMNS = ["is_target", "generate_storybook", "upload_storybook"]
+    # 和 TARGET_TASK_QUERIES 对应的 SQL 条件
+    TARGET_TASK_WHERE = {
+        "generate_storybook": "is_target = 1 AND generate_storybook IS NOT 1",
+        "upload_storybook": "is_target = 1 AND generate_storybook = 1 AND upload_storybook IS NOT 1",
+    }
+
+    def __init__(self, db_path="asset/task.db", **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.DB_PATH = db_path
+        os.makedirs(os.path.dirname(self.DB_PATH) or ".", exist_ok=True)
+        self._init_db()
+
+        # 第一次使用时，从现有的 CSV 导入数据
+        if self._count() == 0 and os.path.exists(self.CSV_PATH):
+            self.import_csv()
+
+    def _connect(self):
+        return sqlite3.connect(self.DB_PATH, timeout=30)
+
+    def _init_db(self):
+        # id/状态列是整数，text 是字符串，pic 不指定类型(可能是 0 也可能是图片路径)
+        column_types = {
+            self.CSV_COLUMNS[0]: "INTEGER PRIMARY KEY",
+            self.CSV_COLUMNS[1]: "TEXT",
+            self.CSV_COLUMNS[2]: "INTEGER",
+            self.CSV_COLUMNS[3]: "INTEGER",
+            self.CSV_COLUMNS[4]: "INTEGER",
+        }
+        columns_sql = ", ".join(
+            f"{column} {column_types.get(column, '')}".strip()
+            for column in self.CSV_COLUMNS
+        )
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE_NAME} ({columns_sql})")
+            for column in self.INDEX_COLUMNS:
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{self.TABLE_NAME}_{column} "
+                    f"ON {self.TABLE_NAME} ({column})"
+                )
+
+    def _count(self):
+        with closing(self._connect()) as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM {self.TABLE_NAME}").fetchone()[0]
+
+    def _insert_rows(self, conn, rows: list[dict]):
+        placeholders = ", ".join("?" for _ in self.CSV_COLUMNS)
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {self.TABLE_NAME} ({', '.join(self.CSV_COLUMNS)}) "
+            f"VALUES ({placeholders})",
+            [
+                [self._to_python(row.get(column)) for column in self.CSV_COLUMNS]
+                for row in rows
+            ],
+        )
+
+    def _replace_all(self, df: pd.DataFrame):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"DELETE FROM {self.TABLE_NAME}")
+            self._insert_rows(conn, df.to_dict("records"))
+
+    def read_df_from_csv(self):
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(
+                f"SELECT {', '.join(self.CSV_COLUMNS)} FROM {self.TABLE_NAME} ORDER BY id",
+                conn,
+            )
+
+    def read_target_tasks(self, stage="generate_storybook"):
+        # 走状态列上的索引，不用读出整张表再过滤
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(
+                f"SELECT {', '.join(self.CSV_COLUMNS)} FROM {self.TABLE_NAME} "
+                f"WHERE {self.TARGET_TASK_WHERE[stage]} ORDER BY id",
+                conn,
+            )
+
+    def insert_task(self, text_list: list[str], pic: str = None):
+        with closing(self._connect()) as conn, conn:
+            start_id = conn.execute(
+                f"SELECT IFNULL(MAX(id), 0) FROM {self.TABLE_NAME}"
+            ).fetchone()[0]
+            new_data = self._build_new_rows(text_list, start_id, pic)
+            id_column, text_column = self.CSV_COLUMNS[0], self.CSV_COLUMNS[1]
+
+            def load_tasks(after_id):
+                return conn.execute(
+                    f"SELECT {id_column}, {text_column} FROM {self.TABLE_NAME} WHERE {id_column} > ?",
+                    (after_id,),
+                ).fetchall()
+
+            def checkpoint(upto_id):
+                count = conn.execute(
+                    f"SELECT COUNT(*) FROM {self.TABLE_NAME} WHERE {id_column} <= ?", (upto_id,)
+                ).fetchone()[0]
+                row = conn.execute(
+                    f"SELECT {text_column} FROM {self.TABLE_NAME} WHERE {id_column} = ?", (upto_id,)
+                ).fetchone()
+                return story_dedup.checkpoint(count, row[0] if row else None)
+
+            new_data = self._dedup_rows(new_data, start_id, load_tasks, checkpoint)
+            if not new_data:
+                logger.warning("没有需要添加的新任务。")
+                return
+            self._insert_rows(conn, new_data)
+
+    def update_task(self, df: pd.DataFrame):
+        # 兼容以前的用法：传入整张表时整体覆盖，并导出 CSV
+        self._replace_all(df)
+        self.export_csv()
+        logger.debug("修改成功。")
+
+    def mark(self, ids, column, value=1):
+        """
+        只更新指定 id 的某个状态列。
+
+        Args:
+            ids: 单个 id 或 id 的列表。
+            column (str): 状态列名，例如 "generate_storybook"。
+            value: 要设置的值。
+
+        Returns:
+            int: 被更新的行数。
+        """
+        self._check_status_column(column)
+        ids = self._normalize_ids(ids)
+        value = self._to_python(value)
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.executemany(
+                f"UPDATE {self.TABLE_NAME} SET {column} = ? WHERE id = ?",
+                [(value, id) for id in ids],
+            )
+            return cursor.rowcount
+
+    def import_csv(self, csv_path=None):
+        """把 CSV 的内容导入数据库(覆盖数据库中的数据)"""
+        csv_path = csv_path or self.CSV_PATH
+        try:
+            # 以前用 CSV 存储时可能还有没合并的日志，一起导入
+            df = self._apply_journal(pd.read_csv(csv_path, encoding=self.encoding))
+        except pd.errors.EmptyDataError:
+            logger.debug(f"'{csv_path}' 文件为空，不需要导入。")
+            return
+        self._replace_all(df)
+        logger.debug(f"从 '{csv_path}' 导入了 {len(df)} 条任务。")
+
+    def export_csv(self, csv_path=None):
+        """把数据库中的任务导出为 CSV，供 post_stories.js 使用"""
+        csv_path = csv_path or self.CSV_PATH
+        self.read_df_from_csv().to_csv(
+            csv_path,
+            mode="w",
+            header=True,
+            index=False,
+            encoding=self.encoding,
+        )
+        logger.debug(f"任务已导出到 '{csv_path}'。")
+
+    def flush(self):
+        self.export_csv()
+
+
+def get_task_manager(**kwargs) -> Task_manager:
+    """根据环境变量 TASK_STORE (csv / sqlite) 创建对应的 Task_manager"""
+    if os.getenv("TASK_STORE", "csv").lower() == "sqlite":
+        return Sqlite_task_manager(**kwargs)
+    return Task_manager(**kwargs)
+
 
 # --- 主程序入口 ---
 if __name__ == "__main__":